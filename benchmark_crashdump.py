@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+"""Benchmarks for the crashdump database access paths.
+
+Usage: benchmark_crashdump.py indexes [rows]
+       benchmark_crashdump.py status [rows]
+
+indexes: Creates an in-memory SQLite environment filled with `rows` crashes
+(default 1000000) and reports the time and query plan of the common crash
+queries without and with the secondary indexes of schema version 15.
+
+status: Closes `rows` crashes (default 10000) one by one through
+CrashDump.save_changes, as done when their last linked ticket is closed,
+and reports the time per status transition.
+"""
+
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from trac.test import EnvironmentStub
+
+from crashdump.model import CrashDump
+from crashdump.upgrades import db15
+
+_statuses = ['new', 'new', 'assigned', 'closed', 'closed', 'closed']
+_components = ['component%i' % i for i in range(20)]
+_applications = ['app%i' % i for i in range(50)]
+_products = [('product%i' % i, '1.%i' % j) for i in range(5) for j in range(10)]
+
+def create_env():
+    env = EnvironmentStub(enable=['trac.*', 'crashdump.*'])
+    env.path = tempfile.mkdtemp()
+    env.upgrade()
+    return env
+
+def fill_crashes(env, rows, batch_size=10000):
+    rnd = random.Random(42)
+    start_ts = 1500000000 * 1000000
+    step = 60 * 1000000
+    crashid = 0
+    while crashid < rows:
+        crashes = []
+        links = []
+        frames = []
+        for i in range(min(batch_size, rows - crashid)):
+            crashid += 1
+            ts = start_ts + crashid * step
+            productname, productversion = rnd.choice(_products)
+            crashes.append((crashid, str(uuid.UUID(int=rnd.getrandbits(128))),
+                            rnd.choice(_statuses), rnd.choice(_components),
+                            ts, ts + step, ts + 2 * step + rnd.randint(0, 1000) * step,
+                            rnd.choice(_applications), productname, productversion))
+            if crashid % 10 == 0:
+                links.append((crashid, crashid // 10))
+            if crashid % 100 == 0:
+                for frameno in range(20):
+                    frames.append((crashid, 1, frameno, 'module%i' % frameno, 'function%i' % frameno))
+        with env.db_transaction as db:
+            db.executemany("""INSERT INTO crashdump (id, uuid, status, component,
+                                crashtime, uploadtime, changetime,
+                                applicationname, productname, productversion)
+                              VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""", crashes)
+            if links:
+                db.executemany("INSERT INTO crashdump_ticket (crash, ticket) VALUES (%s, %s)", links)
+            if frames:
+                db.executemany("""INSERT INTO crashdump_stack (crash, threadid, frameno, module, function)
+                                  VALUES (%s, %s, %s, %s, %s)""", frames)
+    return start_ts, step
+
+def drop_indexes(env):
+    with env.db_transaction as db:
+        for table in db15.schema:
+            for index in table.indices:
+                db("DROP INDEX IF EXISTS %s_%s_idx" % (table.name, '_'.join(index.columns)))
+
+def create_indexes(env):
+    with env.db_transaction as db:
+        db15.do_upgrade(env, 15, db.cursor())
+        db("ANALYZE")
+
+def index_queries(rows, start_ts, step):
+    middle_ts = start_ts + (rows // 2) * step
+    recent_ts = start_ts + (rows - 1000) * step
+    return [
+        ('active crashes', "SELECT COUNT(*) FROM crashdump WHERE status<>'closed'", ()),
+        ('status filter', "SELECT COUNT(*) FROM crashdump WHERE status=%s", ('assigned',)),
+        ('active list page', "SELECT id,uuid,status FROM crashdump WHERE status<>'closed' ORDER BY changetime DESC LIMIT 100", ()),
+        ('purge by crashtime', "SELECT COUNT(*) FROM crashdump WHERE crashtime<%s", (start_ts + 1000 * step,)),
+        ('purge by uploadtime', "SELECT COUNT(*) FROM crashdump WHERE uploadtime<%s", (start_ts + 1000 * step,)),
+        ('crashlist since', "SELECT COUNT(*) FROM crashdump WHERE changetime>=%s", (recent_ts,)),
+        ('crash time range', "SELECT COUNT(*) FROM crashdump WHERE crashtime>=%s AND crashtime<%s", (middle_ts, middle_ts + 100 * step)),
+        ('product version', "SELECT COUNT(*) FROM crashdump WHERE productname=%s AND productversion=%s", _products[7]),
+        ('product', "SELECT COUNT(*) FROM crashdump WHERE productname=%s", (_products[7][0],)),
+        ('application', "SELECT COUNT(*) FROM crashdump WHERE applicationname=%s", (_applications[3],)),
+        ('component', "SELECT COUNT(*) FROM crashdump WHERE component=%s", (_components[3],)),
+        ('crashes of ticket', "SELECT crash FROM crashdump_ticket WHERE ticket=%s ORDER BY crash", (rows // 20,)),
+        ('stack of crash', "SELECT * FROM crashdump_stack WHERE crash=%s ORDER BY threadid, frameno", ((rows // 200) * 100,)),
+        ]
+
+def run_queries(env, queries, repeat=3):
+    ret = []
+    for name, sql, args in queries:
+        with env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, args)
+            plan = ' / '.join(row[-1] for row in cursor)
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            env.db_query(sql, args)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        ret.append((name, best, plan))
+    return ret
+
+def benchmark_indexes(rows=1000000):
+    env = create_env()
+    print('Filling %i crashes...' % rows)
+    start = time.time()
+    start_ts, step = fill_crashes(env, rows)
+    print('  %.1fs' % (time.time() - start))
+    queries = index_queries(rows, start_ts, step)
+
+    drop_indexes(env)
+    before = run_queries(env, queries)
+    start = time.time()
+    create_indexes(env)
+    print('Creating the indexes: %.1fs' % (time.time() - start))
+    after = run_queries(env, queries)
+
+    print('%-20s %12s %12s' % ('query', 'without [ms]', 'with [ms]'))
+    for (name, t_before, plan_before), (_, t_after, plan_after) in zip(before, after):
+        print('%-20s %12.2f %12.2f' % (name, t_before * 1000, t_after * 1000))
+        print('    without: %s' % plan_before)
+        print('    with:    %s' % plan_after)
+    env.shutdown()
+    shutil.rmtree(env.path)
+
+def benchmark_status(rows=10000):
+    env = create_env()
+    print('Filling %i crashes...' % rows)
+    fill_crashes(env, rows)
+    crash_ids = [crashid for crashid, in env.db_query(
+                 "SELECT id FROM crashdump WHERE status<>'closed' ORDER BY id")]
+    load_time = save_time = 0.0
+    for crashid in crash_ids:
+        with env.db_transaction as db:
+            start = time.time()
+            crashobj = CrashDump(env=env, id=crashid)
+            load_time += time.time() - start
+            start = time.time()
+            crashobj['closetime'] = crashobj['changetime']
+            crashobj['resolution'] = 'fixed'
+            crashobj['status'] = 'closed'
+            crashobj.save_changes(author='benchmark', comment='Ticket closed', db=db)
+            save_time += time.time() - start
+    num_changes, = env.db_query("SELECT COUNT(*) FROM crashdump_change")[0]
+    count = max(len(crash_ids), 1)
+    print('Closed %i crashes, %i change rows' % (len(crash_ids), num_changes))
+    print('  load:         %.3f ms per crash' % (load_time * 1000 / count))
+    print('  save_changes: %.3f ms per crash' % (save_time * 1000 / count))
+    env.shutdown()
+    shutil.rmtree(env.path)
+
+if __name__ == '__main__':
+    benchmarks = {
+        'indexes': (benchmark_indexes, 1000000),
+        'status': (benchmark_status, 10000),
+        }
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(__doc__.strip())
+        sys.exit(1)
+    func, rows = benchmarks[sys.argv[1]]
+    if len(sys.argv) > 2:
+        rows = int(sys.argv[2])
+    func(rows)
@@ -0,0 +1,651 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import os
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+from trac.core import *
+from trac.admin.api import AdminCommandError, IAdminCommandProvider
+from trac.config import PathOption, IntOption
+from trac.util import as_int
+from trac.util.datefmt import from_utimestamp, parse_date, to_utimestamp, utc
+from trac.util.text import printout
+
+from .api import CrashDumpSystem
+from .jobs import CrashDumpJobRunner, IMaintenanceJobProvider
+from .model import CrashDump, report_summary, report_modules, report_stacks, file_size_summary
+from .xmlreport import XMLReport
+from .storage import find_dump_file, compress_dump_file, resolve_compression_method, lock_crash, \
+    crash_lock_names, remove_crash_locks, crash_dir_name, crash_dir_names, split_item_name
+from .submit import CrashDumpSubmit
+from .retention import CrashDumpRetention
+from .scrub import CrashDumpScrubber
+from .fulltext import CrashDumpFullTextIndex
+from .utils import format_size
+
+class CrashDumpAdmin(Component):
+    """trac-admin commands for the crash dump data."""
+
+    implements(IAdminCommandProvider, IMaintenanceJobProvider)
+
+    dumpdata_dir = PathOption('crashdump', 'dumpdata_dir', default='../dumpdata',
+                      doc='Path to the crash dump data directory relative to the environment conf directory.')
+
+    admin_jobs = IntOption('crashdump', 'admin_jobs', 4,
+        """Number of worker threads used by the crashdump trac-admin commands
+        and maintenance jobs.""")
+
+    purge_days = IntOption('crashdump', 'purge_days', 0,
+        """Age in days after which the scheduled `purge` maintenance job
+        deletes crashes, see the `[crashdump-schedule]` section. The crashes
+        are never purged automatically if `0`.""")
+
+    # number of crashes updated per transaction by the backfill command
+    backfill_batch_size = 200
+    _backfill_checkpoint = 'crashdump_backfill_summary'
+
+    # number of crashes updated per transaction by the layout migration
+    migrate_batch_size = 500
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('crashdump compress', '[none|auto|gzip|zstd] [jobs]',
+               """Compress all stored crash dump files
+
+               Compresses all uncompressed crash dump files and reports in
+               the dump data directory. Uses zstd if available and gzip
+               otherwise when no method is given.
+               """,
+               self._complete_compress, self._do_compress)
+        yield ('crashdump backfill', '[resume|restart] [jobs]',
+               """Fill in the report summary of existing crashes
+
+               Reads the XML reports of all crashes and stores the exception
+               and report summary, the sizes and hashes of the files, the
+               loaded modules and the stacks of all threads in the
+               database. The progress is saved after every batch, so an
+               interrupted run continues where it stopped unless `restart`
+               is given.
+               """,
+               self._complete_backfill, self._do_backfill)
+        yield ('crashdump purge', '<date> [crashtime|uploadtime|changetime] [resume|restart] [jobs]',
+               """Delete all crashes older than the given date
+
+               Removes the files and the database records of all crashes
+               whose crash time (or upload or change time) is before
+               `date`. The crashes are deleted in batches and an
+               interrupted purge with the same date continues where it
+               stopped unless `restart` is given.
+               """,
+               self._complete_purge, self._do_purge)
+        yield ('crashdump sweep', '[jobs]',
+               """Archive and drop old crash dump files
+
+               Moves the minidump and core dump files of old crashes to the
+               archive directory and deletes them later according to the
+               rules in the [crashdump-retention] section. The reports and
+               the crash records are kept.
+               """,
+               None, self._do_sweep)
+        yield ('crashdump scrub', '[check|repair] [jobs]',
+               """Check the stored crash dump files against the database
+
+               Reports the files referenced by crashes which do not exist,
+               the crash directories and files which belong to no crash and
+               the space used per status and product. With `repair` the
+               references to missing files are cleared and the orphaned
+               files are deleted.
+               """,
+               self._complete_scrub, self._do_scrub)
+        yield ('crashdump usage', '',
+               """Show the space used by the crash dump files
+
+               Shows the number of crashes and the size of their files per
+               product and month of upload, as recorded in the database when
+               the files were uploaded. Run `crashdump backfill restart` to
+               record the files of crashes uploaded by older versions.
+               """,
+               None, self._do_usage)
+        yield ('crashdump reindex', '',
+               """Rebuild the full-text index of the crash search
+
+               Adds all crashes to the full-text index again. The index is
+               kept up to date when crashes are uploaded, changed or
+               deleted, so this is only needed after changing the crashes
+               directly in the database.
+               """,
+               None, self._do_reindex)
+        yield ('crashdump migrate-layout', '[jobs]',
+               """Move the crash directories to the configured storage layout
+
+               Moves the files of all crashes stored in another directory
+               layout to the one set by [crashdump] storage_layout and
+               updates the file names in the database. Uploads and
+               downloads keep working while the crashes are moved.
+               """,
+               None, self._do_migrate_layout)
+        yield ('crashdump jobs', '[list|run|cancel] [id]',
+               """Show, run or cancel the maintenance jobs
+
+               `list` shows the recent maintenance jobs, `run` queues the
+               scheduled jobs which are due and runs all queued jobs, and
+               `cancel` cancels the job with the given id.
+               """,
+               self._complete_jobs, self._do_jobs)
+
+    def _complete_compress(self, args):
+        if len(args) == 1:
+            return ['auto', 'gzip', 'zstd']
+
+    def _complete_backfill(self, args):
+        if len(args) == 1:
+            return ['resume', 'restart']
+
+    def _complete_purge(self, args):
+        if len(args) == 2:
+            return ['crashtime', 'uploadtime', 'changetime']
+        if len(args) == 3:
+            return ['resume', 'restart']
+
+    def _complete_scrub(self, args):
+        if len(args) == 1:
+            return ['check', 'repair']
+
+    def _complete_jobs(self, args):
+        if len(args) == 1:
+            return ['list', 'run', 'cancel']
+
+    def _get_jobs(self, jobs):
+        jobs = as_int(jobs, self.admin_jobs, min=1) if jobs else self.admin_jobs
+        return max(jobs, 1)
+
+    def _iter_dump_files(self):
+        """Yield the uuid and the absolute names of the files referenced by
+        every crash."""
+        for row in self.env.db_query("SELECT uuid, %s FROM crashdump" %
+                                     ','.join(CrashDump.dump_file_fields)):
+            yield (row[0], [os.path.join(self.env.path, self.dumpdata_dir, item_name)
+                            for item_name in row[1:] if item_name])
+
+    def compress(self, method, jobs=None, progress=None, error=None):
+        """Compress all uncompressed files referenced by crashes.
+
+        `progress` is called with the number of compressed files and their
+        sizes before and after every 100 files, `error` with the name of a
+        file which could not be compressed and the error message. Returns
+        the totals as (number of files, size before, size after) tuple.
+        """
+        def compress_file(filename):
+            stored_file, stored_method = find_dump_file(filename)
+            if stored_file is None or stored_method is not None:
+                return (filename, 0, 0, None)
+            size = os.path.getsize(stored_file)
+            try:
+                target = compress_dump_file(stored_file, method)
+            except (IOError, OSError) as e:
+                return (filename, size, size, str(e))
+            return (filename, size, os.path.getsize(target), None)
+
+        def compress(entry):
+            uuid, filenames = entry
+            if not filenames:
+                return []
+            # an upload of the crash may replace its files
+            with lock_crash(os.path.join(self.env.path, self.dumpdata_dir), uuid):
+                return [compress_file(filename) for filename in filenames]
+
+        num_files = 0
+        total_before = 0
+        total_after = 0
+        pool = ThreadPool(self._get_jobs(jobs))
+        try:
+            for filename, before, after, failure in \
+                    (result for results in pool.imap_unordered(compress, self._iter_dump_files())
+                     for result in results):
+                if failure:
+                    if error is not None:
+                        error(filename, failure)
+                elif before:
+                    num_files += 1
+                    total_before += before
+                    total_after += after
+                    if progress is not None and num_files % 100 == 0:
+                        progress(num_files, total_before, total_after)
+        finally:
+            pool.terminate()
+            pool.join()
+        return (num_files, total_before, total_after)
+
+    def _do_compress(self, method='auto', jobs=None):
+        try:
+            method = resolve_compression_method(method)
+        except ValueError as e:
+            raise AdminCommandError(str(e))
+        if method is None:
+            raise AdminCommandError('No compression method given.')
+
+        def error(filename, message):
+            printout('Failed to compress %s: %s' % (filename, message))
+
+        num_files, total_before, total_after = self.compress(method, jobs, error=error)
+        printout('Compressed %i files using %s: %s -> %s' %
+                 (num_files, method, format_size(total_before), format_size(total_after)))
+
+    def _get_backfill_checkpoint(self):
+        for value, in self.env.db_query("SELECT value FROM system WHERE name=%s",
+                                        (self._backfill_checkpoint,)):
+            return as_int(value, 0)
+        return 0
+
+    def _set_backfill_checkpoint(self, db, crashid):
+        cursor = db.cursor()
+        cursor.execute("UPDATE system SET value=%s WHERE name=%s",
+                       (str(crashid), self._backfill_checkpoint))
+        if not cursor.rowcount:
+            cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                           (self._backfill_checkpoint, str(crashid)))
+
+    def backfill(self, restart=False, jobs=None, progress=None, error=None):
+        """Fill in the report summary, the recorded file sizes and hashes, the
+        recorded modules and the stored stacks of all threads of all crashes
+        after the checkpoint.
+
+        `progress` is called with the number of updated crashes and the
+        number of remaining crashes after every batch, `error` with the id
+        of a crash whose report could not be read and the error message.
+        Returns the number of updated crashes.
+        """
+        dumpdata_dir = os.path.join(self.env.path, self.dumpdata_dir)
+        file_fields = CrashDump.dump_file_fields
+        # the files may have been archived or left in another layout
+        locate = CrashDumpRetention(self.env).dump_file_path
+
+        def summarize(row):
+            crashid = row[0]
+            values = dict(zip(file_fields, row[1:]))
+            summary = file_size_summary(dumpdata_dir, values, locate)
+            files = CrashDump.file_info(dumpdata_dir, values, locate=locate)
+            modules = None
+            stacks = None
+            xmlfile = values['minidumpreportxmlfile'] or values['coredumpreportxmlfile']
+            failure = None
+            if xmlfile:
+                try:
+                    xmlreport = XMLReport(locate(xmlfile))
+                    summary.update(report_summary(xmlreport))
+                    modules = report_modules(xmlreport)
+                    stacks = report_stacks(xmlreport)
+                except XMLReport.XMLReportException as e:
+                    failure = str(e)
+            return (crashid, summary, files, modules, stacks, failure)
+
+        last_id = 0 if restart else self._get_backfill_checkpoint()
+        num_crashes = 0
+        pool = ThreadPool(self._get_jobs(jobs))
+        try:
+            while True:
+                rows = self.env.db_query("SELECT id,%s FROM crashdump WHERE id>%%s ORDER BY id LIMIT %i" %
+                                         (','.join(file_fields), self.backfill_batch_size), (last_id,))
+                if not rows:
+                    break
+                results = pool.map(summarize, rows)
+                columns = CrashDump.summary_fields
+                # in transactions of their own, the shared module rows may
+                # be added concurrently by an upload
+                CrashDump.record_modules(self.env, dict((result[0], result[3]) for result in results
+                                                        if result[3] is not None))
+                with self.env.db_transaction as db:
+                    db.executemany("UPDATE crashdump SET %s WHERE id=%%s" %
+                                   ','.join('%s=%%s' % c for c in columns),
+                                   [[summary.get(c) for c in columns] + [crashid]
+                                    for crashid, summary, files, modules, stacks, failure in results])
+                    for crashid, summary, files, modules, stacks, failure in results:
+                        CrashDump.record_files(db, crashid, files)
+                        if modules is not None:
+                            # the report could be read
+                            CrashDump.record_stacks(db, crashid, stacks)
+                    last_id = rows[-1][0]
+                    self._set_backfill_checkpoint(db, last_id)
+                if error is not None:
+                    for crashid, summary, files, modules, stacks, failure in results:
+                        if failure:
+                            error(crashid, failure)
+                num_crashes += len(rows)
+                if progress is not None:
+                    for remaining, in self.env.db_query("SELECT COUNT(*) FROM crashdump WHERE id>%s",
+                                                        (last_id,)):
+                        progress(num_crashes, remaining)
+        finally:
+            pool.close()
+            pool.join()
+        return num_crashes
+
+    def _do_backfill(self, mode='resume', jobs=None):
+        if mode not in ('resume', 'restart'):
+            raise AdminCommandError('Unknown mode %s.' % mode)
+
+        def error(crashid, message):
+            printout('Failed to read the report of crash %i: %s' % (crashid, message))
+
+        num_crashes = self.backfill(mode == 'restart', jobs, error=error)
+        printout('Updated the summary of %i crashes.' % num_crashes)
+
+    def purge(self, threshold, column='crashtime', resume=True, jobs=None, progress=None):
+        """Delete all crashes older than `threshold`, see CrashDump.purge_old_data."""
+        dumpdata_dir = os.path.join(self.env.path, self.dumpdata_dir)
+        return CrashDump.purge_old_data(self.env, dumpdata_dir, threshold, column=column,
+                                        jobs=self._get_jobs(jobs), resume=resume,
+                                        progress=progress,
+                                        archive_dir=CrashDumpRetention(self.env).archive_dir)
+
+    def _do_purge(self, date, column='crashtime', mode='resume', jobs=None):
+        if column not in ('crashtime', 'uploadtime', 'changetime'):
+            raise AdminCommandError('Unknown time field %s.' % column)
+        if mode not in ('resume', 'restart'):
+            raise AdminCommandError('Unknown mode %s.' % mode)
+        threshold = parse_date(date, hint='datetime')
+
+        def progress(result):
+            printout('Deleted %i crashes so far (%s freed)' %
+                     (result['crashes'], format_size(result['bytes'])))
+
+        result = self.purge(threshold, column, mode == 'resume', jobs, progress)
+        if result['failed']:
+            printout('Failed to remove the files of %i crashes.' % result['failed'])
+        printout('Deleted %i crashes and %i files: %s freed' %
+                 (result['crashes'], result['files'], format_size(result['bytes'])))
+
+    def _do_sweep(self, jobs=None):
+        retention = CrashDumpRetention(self.env)
+        if not retention.get_rules():
+            raise AdminCommandError('No rules in the [crashdump-retention] section.')
+        result = retention.sweep(jobs=self._get_jobs(jobs))
+        if result['failed']:
+            printout('Failed to move or delete the files of %i crashes.' % result['failed'])
+        printout('Archived the files of %i crashes (%s), dropped the files of %i crashes (%s freed)' %
+                 (result['archived'], format_size(result['moved']),
+                  result['dropped'], format_size(result['freed'])))
+
+    def _do_scrub(self, mode='check', jobs=None):
+        if mode not in ('check', 'repair'):
+            raise AdminCommandError('Unknown mode %s.' % mode)
+
+        def found(kind, name, crashid, size):
+            if kind == 'missing':
+                printout('Missing file of crash %i: %s' % (crashid, name))
+            else:
+                printout('Orphaned: %s (%s)' % (name, format_size(size)))
+
+        result = CrashDumpScrubber(self.env).scrub(mode == 'repair', self._get_jobs(jobs), found=found)
+        usage = result['usage']
+        for status, product in sorted(usage, key=lambda key: -usage[key]):
+            printout('%-10s %-30s %s' % (status, product or '', format_size(usage[(status, product)])))
+        printout('Checked %i crashes: %i missing files, %i orphans (%s)' %
+                 (result['crashes'], result['missing'], result['orphans'], format_size(result['orphan_bytes'])))
+        if mode == 'repair':
+            printout('Cleared %i references and removed %i orphans, %i failed' %
+                     (result['repaired'], result['removed'], result['failed']))
+
+    def _do_usage(self):
+        total = 0
+        for product, month, num_crashes, size in CrashDump.storage_usage(self.env):
+            printout('%-30s %s %8i %s' % (product or '', month.strftime('%Y-%m'), num_crashes, format_size(size)))
+            total += size
+        printout('Total: %s' % format_size(total))
+
+    def _do_reindex(self):
+        index = CrashDumpFullTextIndex(self.env)
+        if not index.available:
+            raise AdminCommandError('The database has no full-text index.')
+
+        def progress(num_crashes):
+            printout('Indexed %i crashes' % num_crashes)
+
+        num_crashes = index.rebuild(progress=progress)
+        printout('Indexed %i crashes' % num_crashes)
+
+    def migrate_layout(self, layout, jobs=None, progress=None, error=None):
+        """Move the directories of all crashes to the storage `layout`.
+
+        The files of every crash are moved while holding the lock of its
+        upload directory, then the file names of a batch of crashes are
+        updated in one transaction; files are found in both layouts in the
+        meantime. `progress` is called with the numbers of checked and moved
+        crashes after every batch, `error` with the uuid of a crash which
+        could not be moved and the error message. Returns the numbers of
+        checked and moved crashes as tuple.
+        """
+        fields = CrashDump.dump_file_fields
+        roots = [os.path.join(self.env.path, self.dumpdata_dir)]
+        archive_dir = CrashDumpRetention(self.env).archive_dir
+        if archive_dir:
+            roots.append(archive_dir)
+
+        def move_entries(root, source, target):
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            for name in os.listdir(source):
+                if os.path.exists(os.path.join(target, name)):
+                    # stored in the new layout in the meantime, keep that one
+                    os.remove(os.path.join(source, name))
+                else:
+                    os.rename(os.path.join(source, name), os.path.join(target, name))
+            # remove the source and the empty shard directories above it
+            path = source
+            while path != root:
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    break
+                path = os.path.dirname(path)
+
+        def migrate(row):
+            crashid, uuid = row[:2]
+            target_name = crash_dir_name(uuid, layout)
+            sources = [(root, os.path.join(root, name)) for name in crash_dir_names(uuid) if name != target_name
+                       for root in roots if os.path.isdir(os.path.join(root, name))]
+            failure = None
+            if sources:
+                try:
+                    with lock_crash(roots[0], uuid):
+                        for root, source in sources:
+                            move_entries(root, source, os.path.join(root, target_name))
+                except OSError as e:
+                    failure = str(e)
+            updates = []
+            for field, item_name in zip(fields, row[2:]):
+                if item_name and failure is None:
+                    item_uuid, filename = split_item_name(item_name)
+                    if item_uuid == uuid and os.path.join(target_name, filename) != os.path.normpath(item_name):
+                        updates.append((field, os.path.join(target_name, filename), item_name))
+            return (crashid, uuid, bool(sources) and failure is None, updates, failure)
+
+        num_crashes = 0
+        num_moved = 0
+        last_id = 0
+        pool = ThreadPool(self._get_jobs(jobs))
+        try:
+            while True:
+                rows = self.env.db_query("SELECT id, uuid, %s FROM crashdump WHERE id>%%s ORDER BY id LIMIT %i" %
+                                         (','.join(fields), self.migrate_batch_size), (last_id,))
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                results = pool.map(migrate, rows)
+                updates = {}
+                for crashid, uuid, moved, changes, failure in results:
+                    if failure is not None and error is not None:
+                        error(uuid, failure)
+                    if moved:
+                        num_moved += 1
+                    for field, new_name, old_name in changes:
+                        updates.setdefault(field, []).append((new_name, crashid, old_name))
+                if updates:
+                    with self.env.db_transaction as db:
+                        for field, args in sorted(updates.items()):
+                            # unless the file has been replaced in the meantime
+                            db.executemany("UPDATE crashdump SET %s=%%s WHERE id=%%s AND %s=%%s" % (field, field),
+                                           args)
+                            db.executemany("UPDATE crashdump_file SET name=%s WHERE crash=%s AND name=%s", args)
+                num_crashes += len(rows)
+                if progress is not None:
+                    progress(num_crashes, num_moved)
+        finally:
+            pool.terminate()
+            pool.join()
+        return (num_crashes, num_moved)
+
+    def _do_migrate_layout(self, jobs=None):
+        layout = CrashDumpSubmit(self.env).storage_layout
+
+        def error(uuid, message):
+            printout('Failed to move the files of crash %s: %s' % (uuid, message))
+
+        num_crashes, num_moved = self.migrate_layout(layout, jobs, error=error)
+        printout('Moved %i of %i crashes to the %s layout.' % (num_moved, num_crashes, layout))
+
+    def _do_jobs(self, action='list', job_id=None):
+        runner = CrashDumpJobRunner(self.env)
+        if action == 'list':
+            for job in reversed(runner.get_jobs()):
+                printout('%5i %-10s %-10s %s' % (job['id'], job['name'], job['status'],
+                                                 job['message'] or ''))
+        elif action == 'run':
+            runner.schedule()
+            printout('Ran %i maintenance jobs.' % runner.run_pending())
+        elif action == 'cancel':
+            if not as_int(job_id, None):
+                raise AdminCommandError('No job id given.')
+            if not runner.cancel(int(job_id)):
+                raise AdminCommandError('Job %s is not queued or running.' % job_id)
+        else:
+            raise AdminCommandError('Unknown action %s.' % action)
+
+    # IMaintenanceJobProvider methods
+    def get_maintenance_jobs(self):
+        yield ('backfill', 'Fill in the report summary of all crashes')
+        yield ('compress', 'Compress the stored crash dump files')
+        yield ('expire-uploads', 'Remove abandoned chunked upload sessions and unused crash locks')
+        yield ('migrate-layout', 'Move the crash directories to the configured storage layout')
+        yield ('purge', 'Delete old crashes')
+        yield ('reindex', 'Rebuild the full-text index of the crash search')
+        yield ('scrub', 'Check the stored files against the database')
+        yield ('sweep', 'Archive and drop old crash dump files')
+        yield ('warmcache', 'Load the crash fields and the crash list')
+
+    def get_scheduled_job_args(self, name):
+        if name == 'purge':
+            if self.purge_days <= 0:
+                return None
+            threshold = datetime.now(utc) - timedelta(days=self.purge_days)
+            return [str(to_utimestamp(threshold)), 'crashtime']
+        elif name == 'sweep':
+            return [] if CrashDumpRetention(self.env).get_rules() else None
+        elif name == 'compress':
+            return ['auto']
+        elif name == 'backfill':
+            return ['resume']
+        elif name == 'scrub':
+            return ['check']
+        elif name == 'expire-uploads':
+            submit = CrashDumpSubmit(self.env)
+            if submit.upload_session_hours > 0 and submit.get_upload_sessions():
+                return []
+            return [] if crash_lock_names(os.path.join(self.env.path, self.dumpdata_dir)) else None
+        return []
+
+    def run_maintenance_job(self, name, args, job):
+        if name == 'purge':
+            threshold = from_utimestamp(int(args[0]))
+            column = args[1] if len(args) > 1 else 'crashtime'
+            total = CrashDump.query_count(self.env, threshold=(column, threshold))
+
+            def progress(result):
+                job.progress('Deleted %i crashes (%s freed)' % (result['crashes'], format_size(result['bytes'])),
+                             100 * (result['crashes'] + result['failed']) // max(total, 1))
+
+            result = self.purge(threshold, column, progress=progress)
+            return 'Deleted %i crashes and %i files, %s freed, %i failed' % \
+                   (result['crashes'], result['files'], format_size(result['bytes']), result['failed'])
+        elif name == 'backfill':
+            def progress(num_crashes, remaining):
+                job.progress('Updated %i crashes' % num_crashes,
+                             100 * num_crashes // max(num_crashes + remaining, 1))
+
+            def error(crashid, message):
+                self.log.warning('Failed to read the report of crash %i: %s', crashid, message)
+
+            num_crashes = self.backfill(bool(args) and args[0] == 'restart', progress=progress, error=error)
+            return 'Updated the summary of %i crashes' % num_crashes
+        elif name == 'compress':
+            method = resolve_compression_method(args[0] if args else 'auto')
+            if method is None:
+                raise TracError('No compression method given.')
+
+            def progress(num_files, before, after):
+                job.progress('Compressed %i files: %s -> %s' %
+                             (num_files, format_size(before), format_size(after)))
+
+            def error(filename, message):
+                self.log.warning('Failed to compress %s: %s', filename, message)
+
+            num_files, before, after = self.compress(method, progress=progress, error=error)
+            return 'Compressed %i files using %s: %s -> %s' % \
+                   (num_files, method, format_size(before), format_size(after))
+        elif name == 'sweep':
+            def progress(result):
+                job.progress('Archived %i and dropped %i crashes' % (result['archived'], result['dropped']))
+
+            result = CrashDumpRetention(self.env).sweep(jobs=self.admin_jobs, progress=progress)
+            return 'Archived the files of %i crashes (%s), dropped the files of %i crashes (%s freed)' % \
+                   (result['archived'], format_size(result['moved']),
+                    result['dropped'], format_size(result['freed']))
+        elif name == 'scrub':
+            repair = bool(args) and args[0] == 'repair'
+
+            def progress(result):
+                job.progress('Checked %i crashes: %i missing files, %i orphans' %
+                             (result['crashes'], result['missing'], result['orphans']))
+
+            result = CrashDumpScrubber(self.env).scrub(repair, self.admin_jobs, progress=progress)
+            message = 'Checked %i crashes: %i missing files, %i orphans (%s)' % \
+                      (result['crashes'], result['missing'], result['orphans'], format_size(result['orphan_bytes']))
+            if repair:
+                message += ', cleared %i references and removed %i orphans' % (result['repaired'], result['removed'])
+            return message
+        elif name == 'expire-uploads':
+            num_sessions, num_bytes = CrashDumpSubmit(self.env).expire_upload_sessions()
+            num_locks = remove_crash_locks(os.path.join(self.env.path, self.dumpdata_dir))
+            return 'Removed %i upload sessions (%s freed) and %i unused crash locks' % \
+                   (num_sessions, format_size(num_bytes), num_locks)
+        elif name == 'migrate-layout':
+            layout = CrashDumpSubmit(self.env).storage_layout
+
+            def progress(num_crashes, num_moved):
+                job.progress('Checked %i crashes, moved %i' % (num_crashes, num_moved))
+
+            def error(uuid, message):
+                self.log.warning('Failed to move the files of crash %s: %s', uuid, message)
+
+            num_crashes, num_moved = self.migrate_layout(layout, self.admin_jobs, progress=progress, error=error)
+            return 'Moved %i of %i crashes to the %s layout' % (num_moved, num_crashes, layout)
+        elif name == 'reindex':
+            index = CrashDumpFullTextIndex(self.env)
+            if not index.available:
+                raise TracError('The database has no full-text index.')
+            total = CrashDump.query_count(self.env)
+
+            def progress(num_crashes):
+                job.progress('Indexed %i crashes' % num_crashes, 100 * num_crashes // max(total, 1))
+
+            return 'Indexed %i crashes' % index.rebuild(progress=progress)
+        elif name == 'warmcache':
+            # the fields and the first page of the default crash list
+            CrashDumpSystem(self.env).get_crash_field_schema()
+            num_crashes = CrashDump.query_count(self.env)
+            CrashDump.query(self.env, order='id', desc=True,
+                            limit=self.config.getint('crashdump', 'items_per_page', 100))
+            return 'Loaded the crash fields and the crash list of %i crashes' % num_crashes
+        raise TracError('Unknown maintenance job %s' % name)
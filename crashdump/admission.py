@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import threading
+import time
+
+class AdmissionRejected(Exception):
+    """Raised if an upload cannot be accepted at the moment.
+
+    `retry_after` is the number of seconds after which the client should try
+    again.
+    """
+    def __init__(self, message, retry_after):
+        super(AdmissionRejected, self).__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket(object):
+    """Token bucket with `rate` tokens per second and a capacity of `burst` tokens."""
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        self.tokens = self.burst
+        self.stamp = now
+
+    def refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now, amount=1.0):
+        """Return the number of seconds until `amount` tokens are available."""
+        self.refill(now)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount=1.0):
+        self.tokens -= amount
+
+    def is_full(self):
+        return self.tokens >= self.burst
+
+class _Admission(object):
+    def __init__(self, controller, size):
+        self._controller = controller
+        self._size = size
+
+    def release(self):
+        if self._controller is not None:
+            self._controller._release(self._size)
+            self._controller = None
+
+class AdmissionController(object):
+    """Limits the number of concurrent uploads, the number of bytes being
+    uploaded at the same time and the upload rate per client.
+
+    The state is kept in memory, so the limits apply per server process.
+    """
+    def __init__(self, max_concurrent=0, max_inflight_bytes=0, busy_retry_after=10,
+                 max_buckets=10000, clock=time.time):
+        self.max_concurrent = max_concurrent
+        self.max_inflight_bytes = max_inflight_bytes
+        self.busy_retry_after = busy_retry_after
+        self.max_buckets = max_buckets
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._concurrent = 0
+        self._inflight_bytes = 0
+        self._buckets = {}
+
+    @property
+    def concurrent(self):
+        return self._concurrent
+
+    @property
+    def inflight_bytes(self):
+        return self._inflight_bytes
+
+    def admit(self, limits, size=0):
+        """Admit an upload of `size` bytes.
+
+        `limits` is a list of (key, rate, burst) tuples, one for every token
+        bucket the upload is accounted to (e.g. the client host or the
+        product). Entries with an empty key or a rate of zero are ignored.
+        Returns an object whose release() method has to be called once the
+        upload has been processed; raises AdmissionRejected if the upload
+        has to be retried later.
+        """
+        with self._lock:
+            now = self._clock()
+            if self.max_concurrent > 0 and self._concurrent >= self.max_concurrent:
+                raise AdmissionRejected('Too many concurrent uploads (%i).' % self._concurrent,
+                                        self.busy_retry_after)
+            # a single upload larger than the budget is still accepted when
+            # nothing else is in flight; max_upload_size limits these
+            if self.max_inflight_bytes > 0 and self._inflight_bytes > 0 and \
+                    self._inflight_bytes + size > self.max_inflight_bytes:
+                raise AdmissionRejected('Too many bytes being uploaded (%i).' % self._inflight_bytes,
+                                        self.busy_retry_after)
+
+            buckets = []
+            for (key, rate, burst) in limits:
+                if not key or rate <= 0:
+                    continue
+                bucket = self._get_bucket(key, rate, burst, now)
+                wait = bucket.wait_time(now)
+                if wait > 0:
+                    raise AdmissionRejected('Upload rate limit exceeded for %s.' % key, wait)
+                buckets.append(bucket)
+            for bucket in buckets:
+                bucket.take()
+
+            self._concurrent += 1
+            self._inflight_bytes += size
+            return _Admission(self, size)
+
+    def _release(self, size):
+        with self._lock:
+            self._concurrent -= 1
+            self._inflight_bytes -= size
+
+    def _get_bucket(self, key, rate, burst, now):
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.rate != rate or bucket.burst != max(burst, 1):
+            if len(self._buckets) >= self.max_buckets:
+                self._prune_buckets(now)
+            bucket = TokenBucket(rate, burst, now)
+            self._buckets[key] = bucket
+        return bucket
+
+    def _prune_buckets(self, now):
+        # full buckets carry no state, so they can be dropped
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.is_full():
+                del self._buckets[key]
+        if len(self._buckets) >= self.max_buckets:
+            self._buckets.clear()
@@ -4,6 +4,7 @@
 
 import re
 import copy
+import threading
 
 from trac.core import *
 from trac.env import IEnvironmentSetupParticipant
@@ -19,8 +20,32 @@ from trac.cache import cached
 from trac.util.datefmt import from_utimestamp
 
 import db_default
-from trac.ticket.model import Ticket
 from .links import CrashDumpTicketLinks
+from .fulltext import CrashDumpFullTextIndex, create_index
+
+class CrashFieldSchema(object):
+    """Immutable description of the crash fields in one locale.
+
+    One instance is shared by all crash rows returned by the bulk queries,
+    so the rows only need to keep their column values.
+    """
+    __slots__ = ('names', 'labels', 'types', 'std_fields', 'custom_fields', 'time_fields', '_label_map')
+
+    def __init__(self, fields, labels):
+        set_ = super(CrashFieldSchema, self).__setattr__
+        set_('names', tuple(f['name'] for f in fields))
+        set_('labels', tuple(labels))
+        set_('types', tuple(f['type'] for f in fields))
+        set_('std_fields', tuple(f['name'] for f in fields if not f.get('custom')))
+        set_('custom_fields', tuple(f['name'] for f in fields if f.get('custom')))
+        set_('time_fields', frozenset(f['name'] for f in fields if f['type'] == 'time'))
+        set_('_label_map', dict(zip(self.names, self.labels)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('CrashFieldSchema is read-only')
+
+    def label(self, name):
+        return self._label_map.get(name, name)
 
 class CrashDumpSystem(Component):
     """Central functionality for the CrashDump plugin."""
@@ -29,6 +54,10 @@ class CrashDumpSystem(Component):
 
     NUMBERS_RE = re.compile(r'\d+', re.U)
 
+    def __init__(self):
+        self._schemas = {}
+        self._schemas_source = None
+        self._schemas_lock = threading.Lock()
 
     @staticmethod
     def get_crash_id(s, default_id=None):
@@ -72,6 +101,8 @@ class CrashDumpSystem(Component):
         if dbm.needs_upgrade(db_default.version, db_default.name):
             if not dbm.get_database_version(db_default.name):
                 dbm.create_tables(db_default.tables)
+                with self.env.db_transaction as db:
+                    create_index(self.env, db.cursor())
                 dbm.set_database_version(db_default.version, db_default.name)
             else:
                 dbm.upgrade(db_default.version, db_default.name,
@@ -119,6 +150,23 @@ class CrashDumpSystem(Component):
             f[label] = gettext(f[label])
         return fields
 
+    def get_crash_field_schema(self):
+        """Return the shared CrashFieldSchema for the active locale.
+
+        Unlike `get_crash_fields` no copy of the field list is made; the
+        schema is rebuilt only after the field cache has been invalidated.
+        """
+        fields = self.fields
+        labels = tuple(gettext(f['label']) for f in fields)
+        with self._schemas_lock:
+            if self._schemas_source is not fields:
+                self._schemas = {}
+                self._schemas_source = fields
+            schema = self._schemas.get(labels)
+            if schema is None:
+                schema = self._schemas[labels] = CrashFieldSchema(fields, labels)
+        return schema
+
     def reset_crash_fields(self):
         """Invalidate crash field cache."""
         del self.fields
@@ -173,6 +221,22 @@ class CrashDumpSystem(Component):
         for (name, label) in simple_string_fields:
             fields.append({'name': name, 'type': 'text', 'label': label})
 
+        # Summary of the crash report, filled in on upload; the type of the
+        # numeric fields is the type of their column
+        summary_fields = [
+            ('exceptioncode', 'int64', N_('Exception code') ),
+            ('exceptionname', 'text', N_('Exception') ),
+            ('exceptionaddress', 'text', N_('Exception address') ),
+            ('exceptionmodule', 'text', N_('Faulting module') ),
+            ('exceptionfunction', 'text', N_('Faulting function') ),
+            ('threadcount', 'int', N_('Number of threads') ),
+            ('modulecount', 'int', N_('Number of modules') ),
+            ('dumpsize', 'int64', N_('Dump size') ),
+            ('reportsize', 'int64', N_('Report size') ),
+            ]
+        for (name, field_type, label) in summary_fields:
+            fields.append({'name': name, 'type': field_type, 'label': label})
+
         # Description
         fields.append({'name': 'description', 'type': 'textarea',
                        'label': N_('Description')})
@@ -280,34 +344,23 @@ class CrashDumpSystem(Component):
             links = self._prepare_links(tkt, db)
             links.save(author, comment, tkt['changetime'], db)
             from .model import CrashDump
-            if tkt['status'] == 'closed':
-                for crashid in links.crashes:
-                    try:
-                        crashobj = CrashDump(env=self.env, id=crashid)
-                    except ResourceNotFound:
-                        crashobj = None
-                        # No such component exists
-                        pass
-                    if crashobj is not None and crashobj['status'] != 'closed':
-                        all_ticket_for_crash = CrashDumpTicketLinks.tickets_for_crash(db, crashid)
-                        all_tickets_closed = True
-                        for crash_tkt_id in all_ticket_for_crash:
-                            if crash_tkt_id == tkt.id:
-                                continue
-                            else:
-                                try:
-                                    t = Ticket(self.env, crash_tkt_id)
-                                    if t['status'] != 'closed':
-                                        all_tickets_closed = False
-                                        break
-                                except ResourceNotFound:
-                                    # No such component exists
-                                    pass
-                        if all_tickets_closed:
-                            crashobj['closetime'] = tkt['changetime']
-                            crashobj['resolution'] = tkt['resolution']
-                            crashobj['status'] = 'closed'
-                            crashobj.save_changes(author=author, comment=comment, when=tkt['changetime'], db=db)
+            if tkt['status'] == 'closed' and links.crashes:
+                # crashes which are still open and have no other open ticket
+                crash_ids = sorted(links.crashes)
+                id_list = ','.join(['%s'] * len(crash_ids))
+                cursor = db.cursor()
+                cursor.execute("""SELECT c.id FROM crashdump AS c
+                                  WHERE c.id IN (%s) AND c.status<>'closed'
+                                    AND NOT EXISTS (SELECT 1 FROM crashdump_ticket AS ct
+                                        JOIN ticket AS t ON t.id=ct.ticket
+                                        WHERE ct.crash=c.id AND ct.ticket<>%%s AND t.status<>'closed')
+                                  ORDER BY c.id""" % id_list, crash_ids + [tkt.id])
+                for crashid, in cursor.fetchall():
+                    crashobj = CrashDump(env=self.env, id=crashid)
+                    crashobj['closetime'] = tkt['changetime']
+                    crashobj['resolution'] = tkt['resolution']
+                    crashobj['status'] = 'closed'
+                    crashobj.save_changes(author=author, comment=comment, when=tkt['changetime'], db=db)
 
             db.commit()
 
@@ -349,8 +402,10 @@ class CrashDumpSystem(Component):
             #self.log.debug('validate_ticket for %s: %s=%s' % (tid, field, ticket[field]))
 
 
-    # ISearchProvider methods
+    # the frame columns of the exception thread searched for the terms
+    search_frame_columns = ('function', 'module', 'source')
 
+    # ISearchProvider methods
     def get_search_filters(self, req):
         if 'TICKET_VIEW' not in req.perm:
             return
@@ -367,26 +422,52 @@ class CrashDumpSystem(Component):
         self.log.debug('search for %s and %s', terms, filters)
 
         #ticket_realm = Resource(self.realm)
+        fulltext = CrashDumpFullTextIndex(self.env)
+        columns = """id, uuid, summary, description, reporter, type,
+                     crashhostname, crashusername, applicationname, applicationfile, systemname,
+                     crashtime, reporttime, status, resolution"""
         with self.env.db_query as db:
-            sql, args = search_to_sql(db, ['summary', 'keywords',
-                                           'description', 'reporter', 'cc',
-                                           'applicationname', 'applicationfile',
-                                           'uploadhostname', 'uploadusername',
-                                           'crashhostname', 'crashusername',
-                                           'systemname',
-                                           'uuid',
-                                           db.cast('id', 'text')], terms)
+            # crashes with every term as function, module or source file
+            # of a frame, each looked up using the index of the column
+            frame_sql = ' AND '.join(['id IN (%s)' % ' UNION '.join(
+                                          'SELECT crash FROM crashdump_stack WHERE %s=%%s' % column
+                                          for column in self.search_frame_columns)] * len(terms))
+            frame_args = [term for term in terms for column in self.search_frame_columns]
+            ids = fulltext.search(terms)
+            if ids is not None:
+                # the best matches of the full-text index, then the
+                # remaining exact frame matches up to the limit
+                limit = fulltext.search_limit
+                if len(ids) < limit:
+                    found = set(ids)
+                    ids += [id for id, in db("SELECT id FROM crashdump WHERE %s ORDER BY id DESC LIMIT %i" %
+                                             (frame_sql, limit), frame_args)
+                            if id not in found][:limit - len(ids)]
+                rows = {}
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    for row in db("SELECT %s FROM crashdump WHERE id IN (%s)" %
+                                  (columns, ','.join(['%s'] * len(chunk))), chunk):
+                        rows[row[0]] = row
+                results = [rows[id] for id in ids if id in rows]
+            else:
+                sql, args = search_to_sql(db, ['summary', 'keywords',
+                                               'description', 'reporter', 'cc',
+                                               'applicationname', 'applicationfile',
+                                               'uploadhostname', 'uploadusername',
+                                               'crashhostname', 'crashusername',
+                                               'systemname',
+                                               'uuid',
+                                               db.cast('id', 'text')], terms)
+                results = db("""SELECT %s
+                                FROM crashdump
+                                WHERE id IN (
+                                    SELECT id FROM crashdump WHERE %s
+                                ) OR (%s)
+                                """ % (columns, sql, frame_sql), list(args) + frame_args)
             for id, uuid, summary, description, reporter, type, \
                 crashhostname, crashusername, applicationname, applicationfile, systemname, \
-                crashtime, reporttime, status, resolution in \
-                    db("""SELECT id, uuid, summary, description, reporter, type,
-                                 crashhostname, crashusername, applicationname, applicationfile, systemname,
-                                 crashtime, reporttime, status, resolution
-                          FROM crashdump
-                          WHERE id IN (
-                              SELECT id FROM crashdump WHERE %s
-                          )
-                          """ % (sql), args):
+                crashtime, reporttime, status, resolution in results:
                 if 'TICKET_VIEW' in req.perm:
 
                     # The events returned by this function must be tuples of the form (href, title, date, author, excerpt).
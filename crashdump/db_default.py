@@ -5,7 +5,7 @@
 from trac.db import Table, Column, Index
 
 name = 'crashdump_version'
-version = 13
+version = 22
 tables = [
     Table('crashdump', key=('id'))[
         Column('id', type='int', auto_increment=True),
@@ -56,8 +56,31 @@ tables = [
         Column('coredumpreporttextfile', size=256),
         Column('coredumpreportxmlfile', size=256),
         Column('coredumpreporthtmlfile', size=256),
+
+        # version 14
+        Column('exceptioncode', type='int64'),
+        Column('exceptionname', size=64),
+        Column('exceptionaddress', size=32),
+        Column('exceptionmodule', size=256),
+        Column('exceptionfunction'),
+        Column('threadcount', type='int'),
+        Column('modulecount', type='int'),
+        Column('dumpsize', type='int64'),
+        Column('reportsize', type='int64'),
+        # version 16
+        Column('archivetime', type='int64'),
         Index(['id'], unique=True),
         Index(['uuid'], unique=True),
+        Index(['exceptioncode']),
+        Index(['exceptionmodule']),
+        # version 15
+        Index(['status']),
+        Index(['component']),
+        Index(['crashtime']),
+        Index(['uploadtime']),
+        Index(['changetime']),
+        Index(['applicationname']),
+        Index(['productname', 'productversion']),
     ],
     Table('crashdump_change', key=('crash', 'time', 'field'))[
         Column('crash', type='int'),
@@ -71,7 +94,9 @@ tables = [
     Table('crashdump_ticket', key=('crash', 'ticket'))[
         Column('crash', type='int'),
         Column('ticket', type='int'),
-        Index(['crash', 'ticket'], unique=True)
+        Index(['crash', 'ticket'], unique=True),
+        # version 15
+        Index(['ticket']),
     ],
     # version 13
     Table('crashdump_stack', key=('crash', 'threadid', 'frameno') )[
@@ -86,7 +111,58 @@ tables = [
         Column('lineoff', type='int'),
         Index(['crash', 'frameno']),
         Index(['crash', 'threadid', 'frameno'], unique=True),
+        # version 21
+        Index(['function']),
+        Index(['module']),
+        Index(['source', 'line']),
+    ],
+    # version 17
+    Table('crashdump_job', key=('id'))[
+        Column('id', type='int', auto_increment=True),
+        Column('name', size=32),
+        Column('args'),
+        Column('status', size=16),
+        Column('author', size=256),
+        Column('created', type='int64'),
+        Column('started', type='int64'),
+        Column('updated', type='int64'),
+        Column('finished', type='int64'),
+        Column('progress', type='int'),
+        Column('message'),
+        Column('cancel', type='int'),
+        Index(['status']),
+        Index(['name', 'created']),
+    ],
+    # version 18
+    Table('crashdump_file', key=('crash', 'field'))[
+        Column('crash', type='int'),
+        Column('field', size=32),
+        Column('name', size=256),
+        Column('size', type='int64'),
+        Column('sha256', size=64),
+        Index(['sha256']),
+    ],
+    # version 19
+    Table('crashdump_module_version', key=('id'))[
+        Column('id', type='int', auto_increment=True),
+        Column('name', size=256),
+        Column('version', size=64),
+        Index(['name', 'version'], unique=True),
+    ],
+    Table('crashdump_crash_module', key=('crash', 'module'))[
+        Column('crash', type='int'),
+        Column('module', type='int'),
+        Index(['module']),
+    ],
+    # version 20
+    Table('crashdump_thread_stacks', key=('crash'))[
+        Column('crash', type='int'),
+        Column('threadcount', type='int'),
+        Column('framecount', type='int'),
+        Column('data'),
     ],
+    # version 22: the full-text index crashdump_fts depends on the database
+    # and is created by crashdump.fulltext.create_index()
 ]
 
 # (table, (column1, column2), ((row1col1, row1col2), (row2col1, row2col2)))
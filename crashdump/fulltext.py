@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import re
+
+from trac.core import *
+from trac.config import IntOption
+from trac.db.api import DatabaseManager
+
+# the indexed text of a crash: the title and body columns of the crash and
+# the functions and modules of the stack frames of the exception thread
+title_columns = ('summary', 'keywords', 'applicationname', 'exceptionmodule', 'exceptionfunction')
+body_columns = ('description', 'reporter', 'cc', 'applicationfile', 'uploadhostname', 'uploadusername',
+                'crashhostname', 'crashusername', 'systemname', 'uuid')
+indexed_columns = frozenset(title_columns + body_columns)
+
+# relative weights of the title, the body and the frames when ranking
+_sqlite_weights = (10.0, 1.0, 5.0)
+_postgres_weights = ('A', 'C', 'B')
+
+# terms without a letter or digit give no tokens
+_token_re = re.compile(r'\w', re.UNICODE)
+
+def get_dialect(env):
+    """Return the scheme of the database connection string, e.g. `sqlite`
+    or `postgres`."""
+    return DatabaseManager(env).connection_uri.split(':', 1)[0]
+
+def _text_sql(columns):
+    return " || ' ' || ".join("COALESCE(c.%s,'')" % name for name in columns)
+
+def _frames_sql(dialect):
+    frame = "COALESCE(s.function,'') || ' ' || COALESCE(s.module,'')"
+    if dialect == 'postgres':
+        aggregate = "string_agg(%s, ' ')" % frame
+    else:
+        aggregate = "group_concat(%s, ' ')" % frame
+    return "COALESCE((SELECT %s FROM crashdump_stack s WHERE s.crash=c.id),'')" % aggregate
+
+def create_index(env, cursor):
+    """Create the full-text index table if the database supports it.
+
+    SQLite needs the FTS5 extension, PostgreSQL uses a tsvector column with
+    a GIN index. Returns whether the index has been created.
+    """
+    dialect = get_dialect(env)
+    if dialect == 'sqlite':
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE crashdump_fts USING fts5(title, body, frames)")
+        except env.db_exc.OperationalError as e:
+            env.log.warning('SQLite FTS5 is not available, the crash search uses no full-text index: %s', e)
+            return False
+    elif dialect == 'postgres':
+        # named rowid like the implicit column of the FTS5 table
+        cursor.execute("CREATE TABLE crashdump_fts (rowid integer PRIMARY KEY, document tsvector)")
+        cursor.execute("CREATE INDEX crashdump_fts_document_idx ON crashdump_fts USING GIN (document)")
+    else:
+        return False
+    return True
+
+def populate_index(env, cursor, crash_ids=None):
+    """Add the crashes `crash_ids` (all if None) to the full-text index.
+
+    The crashes must not be in the index yet.
+    """
+    dialect = get_dialect(env)
+    title = _text_sql(title_columns)
+    body = _text_sql(body_columns) + " || ' ' || CAST(c.id AS text)"
+    frames = _frames_sql(dialect)
+    if dialect == 'postgres':
+        document = ' || '.join("setweight(to_tsvector('simple', %s), '%s')" % (sql, weight)
+                               for sql, weight in zip((title, body, frames), _postgres_weights))
+        sql = "INSERT INTO crashdump_fts (rowid, document) SELECT c.id, %s FROM crashdump c" % document
+    else:
+        sql = "INSERT INTO crashdump_fts (rowid, title, body, frames) SELECT c.id, %s, %s, %s FROM crashdump c" % \
+            (title, body, frames)
+    if crash_ids is None:
+        cursor.execute(sql)
+    else:
+        cursor.execute(sql + " WHERE c.id IN (%s)" % ','.join(['%s'] * len(crash_ids)), crash_ids)
+
+class CrashDumpFullTextIndex(Component):
+    """Full-text index of the crashes used by the crash search.
+
+    The index is updated whenever a crash is inserted, changed or deleted.
+    Databases without full-text support (SQLite without FTS5, MySQL) have
+    no index and the search falls back to scanning the crashes.
+    """
+
+    search_limit = IntOption('crashdump', 'search_limit', 200,
+        """Maximum number of crashes returned by the search, the best
+        matches first.""")
+
+    # number of crashes added to the index per transaction by rebuild()
+    rebuild_batch_size = 1000
+
+    def __init__(self):
+        self._available = False
+
+    @property
+    def available(self):
+        """Whether the database has a full-text index."""
+        # only a positive result is cached, the index may be created by an
+        # upgrade later on. has_table() is not used since the PRAGMA it runs
+        # on SQLite commits the open transaction.
+        if not self._available:
+            with self.env.db_query as db:
+                self._available = 'crashdump_fts' in db.get_table_names()
+        return self._available
+
+    def update(self, db, crash_ids):
+        """Replace the indexed text of the crashes `crash_ids`."""
+        if not crash_ids or not self.available:
+            return
+        crash_ids = [int(crashid) for crashid in crash_ids]
+        cursor = db.cursor()
+        self._remove(cursor, crash_ids)
+        populate_index(self.env, cursor, crash_ids)
+
+    def remove(self, db, crash_ids):
+        """Remove the crashes `crash_ids` from the index."""
+        if not crash_ids or not self.available:
+            return
+        self._remove(db.cursor(), [int(crashid) for crashid in crash_ids])
+
+    def _remove(self, cursor, crash_ids):
+        cursor.execute("DELETE FROM crashdump_fts WHERE rowid IN (%s)" % ','.join(['%s'] * len(crash_ids)),
+                       crash_ids)
+
+    def rebuild(self, progress=None):
+        """Rebuild the whole index in batches. `progress` is called with the
+        number of indexed crashes after every batch. Returns the number of
+        indexed crashes."""
+        if not self.available:
+            return 0
+        with self.env.db_transaction as db:
+            db("DELETE FROM crashdump_fts")
+        ret = 0
+        last_id = 0
+        while True:
+            ids = [crashid for crashid, in self.env.db_query(
+                        "SELECT id FROM crashdump WHERE id>%%s ORDER BY id LIMIT %i" % self.rebuild_batch_size,
+                        (last_id,))]
+            if not ids:
+                break
+            with self.env.db_transaction as db:
+                self.update(db, ids)
+            last_id = ids[-1]
+            ret += len(ids)
+            if progress is not None:
+                progress(ret)
+        return ret
+
+    def search(self, terms, limit=None):
+        """Return the ids of the crashes matching all `terms`, the best
+        matches first, at most `limit` (default `search_limit`).
+
+        Returns None if there is no index.
+        """
+        if not self.available:
+            return None
+        if limit is None:
+            limit = self.search_limit
+        terms = [term for term in terms if _token_re.search(term)]
+        if not terms:
+            return []
+        if get_dialect(self.env) == 'postgres':
+            query = ' && '.join(["phraseto_tsquery('simple', %s)"] * len(terms))
+            return [crashid for crashid, in self.env.db_query("""
+                    SELECT rowid FROM crashdump_fts, (SELECT %s AS query) q
+                    WHERE document @@ q.query
+                    ORDER BY ts_rank(document, q.query) DESC, rowid DESC LIMIT %i
+                    """ % (query, limit), terms)]
+        else:
+            # every term is a phrase of its tokens, the last one matching
+            # as prefix
+            query = ' AND '.join('"%s" *' % term.replace('"', '""') for term in terms)
+            return [crashid for crashid, in self.env.db_query("""
+                    SELECT rowid FROM crashdump_fts WHERE crashdump_fts MATCH %%s
+                    ORDER BY bm25(crashdump_fts, %s), rowid DESC LIMIT %i
+                    """ % (', '.join(str(w) for w in _sqlite_weights), limit), (query,))]
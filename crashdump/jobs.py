@@ -0,0 +1,345 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+from trac.core import *
+from trac.config import ConfigSection, IntOption
+from trac.env import env_cache, env_cache_lock
+from trac.util import as_int
+from trac.util.datefmt import from_utimestamp, to_utimestamp, utc
+from trac.web.api import IRequestFilter
+
+from .fulltext import get_dialect
+
+# the runner with a background worker thread of every environment path
+_workers = {}
+_workers_lock = threading.Lock()
+
+class JobCancelled(Exception):
+    """Raised by MaintenanceJob.progress() once the job has been cancelled."""
+
+class IMaintenanceJobProvider(Interface):
+    """Extension point interface for components providing maintenance jobs
+    run in the background by the CrashDumpJobRunner."""
+
+    def get_maintenance_jobs():
+        """Return an iterable of (name, label) tuples of the provided jobs."""
+
+    def get_scheduled_job_args(name):
+        """Return the arguments of a scheduled run of the job `name`, or
+        None if the job should not be scheduled now."""
+
+    def run_maintenance_job(name, args, job):
+        """Run the job `name` with the list of string `args`.
+
+        `job` is a MaintenanceJob whose progress() method should be called
+        regularly; it raises JobCancelled once the job has been cancelled,
+        so progress() must only be called where the job can stop safely.
+        Returns a message describing the result.
+        """
+
+class MaintenanceJob(object):
+    """Handle of a running job, passed to the job provider."""
+
+    def __init__(self, env, id, name, args):
+        self.env = env
+        self.id = id
+        self.name = name
+        self.args = args
+
+    def progress(self, message, percent=None):
+        """Store the progress of the job and check whether it has been
+        cancelled."""
+        with self.env.db_transaction as db:
+            db("UPDATE crashdump_job SET message=%s, progress=%s, updated=%s WHERE id=%s",
+               (message, percent, to_utimestamp(datetime.now(utc)), self.id))
+        for cancel, in self.env.db_query("SELECT cancel FROM crashdump_job WHERE id=%s", (self.id,)):
+            if cancel:
+                raise JobCancelled(message)
+
+class CrashDumpJobRunner(Component):
+    """Runs the crashdump maintenance jobs (purge, summary backfill, storage
+    compaction, retention sweep, ...) in a background thread of the web
+    server.
+
+    The jobs are queued in the crashdump_job table, either by the admin
+    panel or by the schedule of the `[crashdump-schedule]` section, and
+    picked up by whichever server process gets to them first.
+    """
+
+    implements(IRequestFilter)
+
+    providers = ExtensionPoint(IMaintenanceJobProvider)
+
+    poll_interval = IntOption('crashdump', 'job_poll_interval', 10,
+        """Number of seconds between two checks for queued maintenance jobs
+        by the background job runner. Set to `0` to disable the background
+        job runner and run `trac-admin crashdump jobs run` instead.""")
+
+    schedule_section = ConfigSection('crashdump-schedule',
+        """Schedule of the crashdump maintenance jobs. Every option names a
+        job and gives the number of hours between two runs:
+        {{{
+        [crashdump-schedule]
+        compress = 24
+        purge = 168
+        }}}
+        The jobs are `purge`, `backfill`, `compress`, `sweep`, `scrub`,
+        `migrate-layout`, `reindex`, `warmcache` and `expire-uploads`. The retention sweep runs every 24 hours by default when
+        retention rules are configured and the abandoned upload sessions and
+        unused crash locks are checked every 6 hours while there are any. See `[crashdump] purge_days` for the
+        scheduled purge.
+        """)
+
+    # a running job whose progress has not been updated for this number of
+    # seconds is considered to be interrupted
+    stale_timeout = 3600
+
+    # finished jobs are kept for this number of days
+    history_days = 30
+
+    def __init__(self):
+        self._worker_lock = threading.Lock()
+        self._worker = None
+        self._stop = threading.Event()
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        if self.poll_interval > 0 and self._worker is None:
+            self._start_worker()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type, method=None):
+        return template, data, content_type, method
+
+    # Public API
+    def get_job_names(self):
+        """Return a list of (name, label) tuples of all available jobs."""
+        ret = []
+        for provider in self.providers:
+            ret.extend(provider.get_maintenance_jobs())
+        return sorted(ret)
+
+    def _get_provider(self, name):
+        for provider in self.providers:
+            for job_name, label in provider.get_maintenance_jobs():
+                if job_name == name:
+                    return provider
+        return None
+
+    def submit(self, name, args=None, author=None):
+        """Queue the job `name` and return its id."""
+        if self._get_provider(name) is None:
+            raise TracError('Unknown maintenance job %s' % name)
+        now = to_utimestamp(datetime.now(utc))
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("""INSERT INTO crashdump_job
+                                (name, args, status, author, created, updated, cancel)
+                              VALUES (%s, %s, 'queued', %s, %s, %s, 0)""",
+                           (name, json.dumps(list(args or [])), author, now, now))
+            return db.get_last_id(cursor, 'crashdump_job')
+
+    def _submit_scheduled(self, name, args, due):
+        """Queue the job `name` unless it has been queued after `due`.
+        Returns its id, or None if another process queued it first."""
+        now = to_utimestamp(datetime.now(utc))
+        # MySQL needs a table for a SELECT with a WHERE clause
+        from_clause = ' FROM DUAL' if get_dialect(self.env) == 'mysql' else ''
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            # only one process wins the schedule slot
+            cursor.execute("""INSERT INTO crashdump_job
+                                (name, args, status, author, created, updated, cancel)
+                              SELECT %%s, %%s, 'queued', NULL, %%s, %%s, 0%s
+                              WHERE NOT EXISTS (SELECT * FROM crashdump_job
+                                                WHERE name=%%s AND created>%%s)""" % from_clause,
+                           (name, json.dumps(list(args)), now, now, name, due))
+            if cursor.rowcount <= 0:
+                return None
+            return db.get_last_id(cursor, 'crashdump_job')
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job. Returns False if the job has
+        already finished."""
+        now = to_utimestamp(datetime.now(utc))
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("""UPDATE crashdump_job SET status='cancelled', finished=%s, cancel=1
+                              WHERE id=%s AND status='queued'""", (now, job_id))
+            if cursor.rowcount:
+                return True
+            cursor.execute("UPDATE crashdump_job SET cancel=1 WHERE id=%s AND status='running'",
+                           (job_id,))
+            return cursor.rowcount > 0
+
+    _job_columns = ('id', 'name', 'args', 'status', 'author', 'created', 'started',
+                    'updated', 'finished', 'progress', 'message', 'cancel')
+
+    def get_jobs(self, limit=20):
+        """Return the most recent jobs as list of dicts."""
+        ret = []
+        for row in self.env.db_query("SELECT %s FROM crashdump_job ORDER BY id DESC LIMIT %i" %
+                                     (','.join(self._job_columns), limit)):
+            job = dict(zip(self._job_columns, row))
+            job['args'] = json.loads(job['args'] or '[]')
+            for name in ('created', 'started', 'updated', 'finished'):
+                job[name] = from_utimestamp(job[name]) if job[name] else None
+            job['cancel'] = bool(job['cancel'])
+            ret.append(job)
+        return ret
+
+    def run_pending(self):
+        """Run all queued jobs in the current thread. Returns the number of
+        jobs run."""
+        ret = 0
+        self._fail_stale_jobs()
+        while True:
+            job = self._claim_next_job()
+            if job is None:
+                break
+            self._run(job)
+            ret += 1
+        return ret
+
+    def schedule(self, now=None):
+        """Queue the scheduled jobs which are due. Returns their ids."""
+        if now is None:
+            now = datetime.now(utc)
+        ret = []
+        for name, hours in self.get_schedule().items():
+            if hours <= 0:
+                continue
+            due = to_utimestamp(now - timedelta(hours=hours))
+            for last, in self.env.db_query("SELECT MAX(created) FROM crashdump_job WHERE name=%s",
+                                           (name,)):
+                break
+            if last is not None and last > due:
+                continue
+            provider = self._get_provider(name)
+            if provider is None:
+                continue
+            args = provider.get_scheduled_job_args(name)
+            if args is not None:
+                job_id = self._submit_scheduled(name, args, due)
+                if job_id is not None:
+                    ret.append(job_id)
+        return ret
+
+    def get_schedule(self):
+        """Return a dict mapping the names of the scheduled jobs to the
+        number of hours between two runs."""
+        ret = {}
+        for name, value in self.schedule_section.options():
+            hours = as_int(value, 0, min=0)
+            if hours:
+                ret[name] = hours
+        if 'sweep' not in self.schedule_section:
+            ret['sweep'] = 24
+        if 'expire-uploads' not in self.schedule_section:
+            ret['expire-uploads'] = 6
+        return ret
+
+    # Internal methods
+    def _claim_next_job(self):
+        """Mark the oldest queued job as running and return it, or None."""
+        while True:
+            rows = self.env.db_query("""SELECT id, name, args FROM crashdump_job
+                                        WHERE status='queued' ORDER BY id LIMIT 1""")
+            if not rows:
+                return None
+            job_id, name, args = rows[0]
+            now = to_utimestamp(datetime.now(utc))
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                # only one process wins the job
+                cursor.execute("""UPDATE crashdump_job SET status='running', started=%s, updated=%s
+                                  WHERE id=%s AND status='queued'""", (now, now, job_id))
+                claimed = cursor.rowcount > 0
+            if claimed:
+                return MaintenanceJob(self.env, job_id, name, json.loads(args or '[]'))
+
+    def _finish(self, job, status, message):
+        with self.env.db_transaction as db:
+            now = to_utimestamp(datetime.now(utc))
+            cursor = db.cursor()
+            # the job may have been failed as stale in the meantime
+            cursor.execute("""UPDATE crashdump_job SET status=%s, message=%s, finished=%s, updated=%s
+                              WHERE id=%s AND status='running'""", (status, message, now, now, job.id))
+            finished = cursor.rowcount > 0
+        if not finished:
+            self.log.warning('Maintenance job %i (%s) is no longer running, the result "%s" is dropped',
+                             job.id, job.name, message)
+
+    def _run(self, job):
+        provider = self._get_provider(job.name)
+        if provider is None:
+            self._finish(job, 'failed', 'Unknown maintenance job %s' % job.name)
+            return
+        self.log.info('Running maintenance job %i: %s %s', job.id, job.name, ' '.join(job.args))
+        try:
+            message = provider.run_maintenance_job(job.name, job.args, job)
+        except JobCancelled as e:
+            self._finish(job, 'cancelled', str(e))
+        except Exception as e:
+            self.log.error('Maintenance job %i (%s) failed: %s', job.id, job.name, e)
+            self._finish(job, 'failed', str(e))
+        else:
+            self._finish(job, 'done', message)
+
+    def _fail_stale_jobs(self):
+        now = datetime.now(utc)
+        stale = to_utimestamp(now - timedelta(seconds=self.stale_timeout))
+        expired = to_utimestamp(now - timedelta(days=self.history_days))
+        with self.env.db_transaction as db:
+            db("""UPDATE crashdump_job SET status='failed', message='Interrupted', finished=%s
+                  WHERE status='running' AND updated<%s""", (to_utimestamp(now), stale))
+            db("DELETE FROM crashdump_job WHERE finished<%s", (expired,))
+
+    def _is_cached(self):
+        """Return whether the environment is in the environment cache of the
+        web server, it is removed from there when it is shut down."""
+        with env_cache_lock:
+            return any(env is self.env for env in env_cache.values())
+
+    def _start_worker(self):
+        with self._worker_lock:
+            if self._worker is not None:
+                return
+            stop = self._stop
+
+            def run():
+                cached = self._is_cached()
+                while not stop.is_set():
+                    if cached and not self._is_cached():
+                        self.log.info('Maintenance job runner stopped, the environment has been shut down')
+                        break
+                    try:
+                        self.schedule()
+                        self.run_pending()
+                    except Exception as e:
+                        self.log.error('Maintenance job runner failed: %s', e)
+                    stop.wait(self.poll_interval)
+
+            with _workers_lock:
+                # the runner of a reloaded environment replaces the runner
+                # of the old environment
+                previous = _workers.get(self.env.path)
+                _workers[self.env.path] = self
+            if previous is not None and previous is not self:
+                previous._stop.set()
+            self._worker = threading.Thread(target=run, name='crashdump-jobs')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def stop(self):
+        """Stop the background job runner, the running job is completed."""
+        self._stop.set()
+        with _workers_lock:
+            if _workers.get(self.env.path) is self:
+                del _workers[self.env.path]
@@ -3,9 +3,14 @@
 # kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
 
 import copy
+from trac.notification.api import NotificationSystem
+from trac.resource import ResourceNotFound
 from trac.util.compat import set, sorted
 from trac.util.datefmt import from_utimestamp, to_utimestamp, utc, utcmax
+from trac.util.text import exception_to_unicode
+from trac.ticket.api import TicketSystem
 from trac.ticket.model import Ticket
+from trac.ticket.notification import TicketChangeEvent
 from datetime import datetime
 
 class CrashDumpTicketLinks(object):
@@ -140,6 +145,136 @@ class CrashDumpTicketLinks(object):
         if handle_commit:
             db.commit()
 
+    @staticmethod
+    def existing_tickets(db, ticket_ids):
+        """Return the subset of `ticket_ids` which exist, using a single query."""
+        ticket_ids = [int(t) for t in ticket_ids]
+        if not ticket_ids:
+            return set()
+        cursor = db.cursor()
+        cursor.execute('SELECT id FROM ticket WHERE id IN (%s)' % ','.join(['%s'] * len(ticket_ids)),
+                       ticket_ids)
+        return set([int(num) for num, in cursor])
+
+    @staticmethod
+    def link_crash(db, crashid, updates, author, when=None, field='linked_crash', ticket_changes=None):
+        """Link the crash `crashid` to several tickets at once.
+
+        `updates` is a list of (ticket id, comment) tuples. All linked
+        tickets are fetched with one query and all changes are written in
+        the transaction of `db`. The `field` custom field and the
+        crashdump_ticket table are only written for tickets not already
+        linked to the crash; a change entry is only added to a ticket if its
+        field value changes or a comment is given. Returns the ids of the
+        existing tickets in the order of `updates`.
+
+        The changes are written directly, bypassing `Ticket.save_changes`.
+        If `ticket_changes` is a list, the changes of the tickets are
+        appended to it; pass it to `notify_changes` once the transaction is
+        committed.
+        """
+        if when is None:
+            when = datetime.now(utc)
+        when_ts = to_utimestamp(when)
+        crashid = int(crashid)
+
+        comments = {}
+        order = []
+        for tkt_id, comment in updates:
+            tkt_id = int(tkt_id)
+            if tkt_id not in comments:
+                order.append(tkt_id)
+                comments[tkt_id] = comment
+        if not order:
+            return []
+
+        cursor = db.cursor()
+        id_list = ','.join(['%s'] * len(order))
+        cursor.execute('SELECT t.id, c.name, c.value FROM ticket AS t '
+                       'LEFT JOIN ticket_custom AS c ON c.ticket=t.id AND c.name=%s '
+                       'WHERE t.id IN (%s)' % ('%s', id_list), [field] + order)
+        old_values = {}
+        has_custom = set()
+        for tkt_id, name, value in cursor:
+            old_values[int(tkt_id)] = value
+            if name is not None:
+                has_custom.add(int(tkt_id))
+        cursor.execute('SELECT ticket FROM crashdump_ticket WHERE crash=%%s AND ticket IN (%s)' % id_list,
+                       [crashid] + order)
+        already_linked = set([int(num) for num, in cursor])
+        # same numbering as Ticket.save_changes for the new comments
+        cursor.execute("SELECT ticket, oldvalue FROM ticket_change WHERE field='comment' AND ticket IN (%s)" % id_list,
+                       order)
+        last_cnum = {}
+        for tkt_id, cnum in cursor:
+            try:
+                cnum = int((cnum or '').rsplit('.', 1)[-1])
+            except ValueError:
+                continue
+            tkt_id = int(tkt_id)
+            last_cnum[tkt_id] = max(last_cnum.get(tkt_id, 0), cnum)
+
+        ret = [linked_id for linked_id in order if linked_id in old_values]
+        new_links = []
+        custom_updates = []
+        custom_inserts = []
+        changes = []
+        touched = []
+        for tkt_id in ret:
+            old_value = old_values[tkt_id]
+            changed = False
+            if tkt_id not in already_linked:
+                new_links.append((crashid, tkt_id))
+                crashes = set([CrashDumpTicketLinks.get_crash_id(x) for x in (old_value or '').split(',') if x.strip()])
+                if crashid not in crashes:
+                    crashes.add(crashid)
+                    new_value = ', '.join(str(x) for x in sorted(crashes))
+                    if tkt_id not in has_custom:
+                        custom_inserts.append((tkt_id, field, new_value))
+                    else:
+                        custom_updates.append((new_value, tkt_id, field))
+                    changes.append((tkt_id, when_ts, author, field, old_value, new_value))
+                    changed = True
+            comment = comments[tkt_id]
+            if changed or comment:
+                changes.append((tkt_id, when_ts, author, 'comment',
+                                str(last_cnum.get(tkt_id, 0) + 1), comment or ''))
+                touched.append((when_ts, tkt_id))
+                if ticket_changes is not None:
+                    ticket_changes.append((tkt_id, when, author, comment or '',
+                                           {field: old_value} if changed else {}))
+
+        if new_links:
+            cursor.executemany('INSERT INTO crashdump_ticket (crash, ticket) VALUES (%s, %s)', new_links)
+        if custom_updates:
+            cursor.executemany('UPDATE ticket_custom SET value=%s WHERE ticket=%s AND name=%s', custom_updates)
+        if custom_inserts:
+            cursor.executemany('INSERT INTO ticket_custom (ticket, name, value) VALUES (%s, %s, %s)', custom_inserts)
+        if changes:
+            cursor.executemany('INSERT INTO ticket_change (ticket, time, author, field, oldvalue, newvalue) VALUES (%s, %s, %s, %s, %s, %s)',
+                               changes)
+        if touched:
+            cursor.executemany('UPDATE ticket SET changetime=%s WHERE id=%s', touched)
+        return ret
+
+    @staticmethod
+    def notify_changes(env, ticket_changes):
+        """Call the ticket change listeners and send the notifications for
+        the changes recorded by `link_crash`."""
+        for tkt_id, when, author, comment, old_values in ticket_changes:
+            try:
+                ticket = Ticket(env, tkt_id)
+            except ResourceNotFound:
+                continue
+            for listener in TicketSystem(env).change_listeners:
+                listener.ticket_changed(ticket, comment, author, old_values)
+            event = TicketChangeEvent('changed', ticket, when, author, comment)
+            try:
+                NotificationSystem(env).notify(event)
+            except Exception as e:
+                env.log.error("Failure sending notification on change to ticket #%s: %s",
+                              tkt_id, exception_to_unicode(e))
+
     @staticmethod
     def tickets_for_crash(db, crashid):
         cursor = db.cursor()
@@ -8,6 +8,7 @@ from fastprotect_version_info import FastprotectVersionInfo
 
 from exception_info import exception_code_names_per_platform_type, exception_info_per_platform_type
 from utils import format_version_number, FixedOffset
+from storage import open_dump_file
 
 class Structure(object):
     def __init__(self):
@@ -587,7 +588,7 @@ class CONTEXT_arm32(Structure):
 class MiniDump(object):
     def __init__(self, path, autoparse=True):
         self.path = path
-        self.fd = open(self.path, "rb")
+        self.fd = open_dump_file(self.path, seekable=True)
         
         self.memory_data = {}
         self.memory_query = {}
@@ -5,14 +5,21 @@
 import re
 import copy
 import os
+import shutil
+from multiprocessing.pool import ThreadPool
 from trac.resource import Resource, ResourceNotFound
 from trac.util.translation import _
-from trac.util.datefmt import from_utimestamp, to_utimestamp, utc, utcmax
+from trac.util.datefmt import from_utimestamp, to_datetime, to_utimestamp, utc, utcmax
 from trac.util.compat import set, sorted
 from trac.util.text import empty
 from trac.ticket.model import Ticket
 
 from .api import CrashDumpSystem
+from . import db_default
+from .storage import stored_dump_files, get_dump_file_size, crash_dir_names, alternative_item_names, \
+    dump_file_info
+from .stackcodec import encode_stacks, ThreadStacks
+from .fulltext import CrashDumpFullTextIndex, indexed_columns, get_dialect
 from uuid import UUID
 from datetime import datetime
 
@@ -24,11 +31,114 @@ def _fixup_cc_list(cc_value):
             cclist.append(cc)
     return ', '.join(cclist)
 
+def report_summary(xmlreport):
+    """Return the values of the report summary fields of `xmlreport`."""
+    ret = {
+        'exceptioncode': None,
+        'exceptionname': None,
+        'exceptionaddress': None,
+        'exceptionmodule': None,
+        'exceptionfunction': None,
+        'threadcount': len(xmlreport.threads or []),
+        'modulecount': len(xmlreport.modules or []),
+        }
+    ex = xmlreport.exception
+    if ex is not None:
+        ret['exceptioncode'] = ex.code
+        if ex.code is not None:
+            try:
+                ret['exceptionname'] = ex.name
+            except (TypeError, ValueError):
+                pass
+        if ex.address is not None:
+            ret['exceptionaddress'] = '0x%x' % ex.address
+        thread = ex.thread
+        if thread is not None:
+            stackdump = thread.simplified_stackdump if thread.simplified_stackdump is not None else thread.stackdump
+            frame = stackdump.top if stackdump is not None else None
+            if frame is not None:
+                ret['exceptionmodule'] = frame.module
+                ret['exceptionfunction'] = frame.function
+    return ret
+
+def report_modules(xmlreport):
+    """Return the sorted (name, version) tuples of the modules loaded by
+    the crashed process of `xmlreport`; the name is the base name of the
+    module file and the version is the file version, or the product version
+    if the module has no file version, or an empty string."""
+    ret = set()
+    for m in xmlreport.modules or []:
+        name = m.basename
+        if name:
+            # the report gives 'None' for missing version numbers
+            versions = [v for v in (m.file_version, m.product_version) if v and v != 'None']
+            ret.add((name[:256], versions[0][:64] if versions else ''))
+    return sorted(ret)
+
+def report_stacks(xmlreport):
+    """Return the (number of threads, number of frames, encoded blob) of
+    the stacks of all threads of `xmlreport`, or None if the report has no
+    stacks."""
+    stackdumps = [dump for dump in xmlreport.stackdumps or [] if not dump.simplified]
+    if not stackdumps:
+        return None
+    return (len(stackdumps), sum(len(dump.callstack or []) for dump in stackdumps), encode_stacks(stackdumps))
+
+def file_size_summary(dumpdata_dir, values, locate=None):
+    """Return the values of the size summary fields for the files of a crash.
+
+    `values` maps the file fields to the names of the files relative to
+    `dumpdata_dir`. `locate` returns the absolute name of a file from its
+    name instead, for files which may have been moved elsewhere. The sizes
+    of the stored (possibly compressed) files are used.
+    """
+    if locate is None:
+        locate = lambda item_name: os.path.join(dumpdata_dir, item_name)
+    def size(fields):
+        ret = None
+        for field in fields:
+            if values.get(field):
+                try:
+                    ret = (ret or 0) + get_dump_file_size(locate(values[field]))
+                except OSError:
+                    pass
+        return ret
+    return {
+        'dumpsize': size(('minidumpfile', 'coredumpfile')),
+        'reportsize': size(('minidumpreportxmlfile', 'coredumpreportxmlfile')),
+        }
+
 class CrashDump(object):
 
     # Fields that must not be modified directly by the user
     protected_fields = ('resolution', 'status', 'time', 'changetime')
 
+    # Fields referencing files in the dump data directory
+    dump_file_fields = (
+        'minidumpfile',
+        'minidumpreporttextfile',
+        'minidumpreportxmlfile',
+        'minidumpreporthtmlfile',
+        'coredumpfile',
+        'coredumpreporttextfile',
+        'coredumpreportxmlfile',
+        'coredumpreporthtmlfile',
+        )
+
+    # Fields summarizing the crash report, filled in when the crash is
+    # uploaded so lists never need to open the report files
+    summary_fields = (
+        'exceptioncode',
+        'exceptionname',
+        'exceptionaddress',
+        'exceptionmodule',
+        'exceptionfunction',
+        'threadcount',
+        'modulecount',
+        'dumpsize',
+        'reportsize',
+        )
+
     __db_fields = [
         'uuid',
         'type',
@@ -73,6 +183,15 @@ class CrashDump(object):
         'coredumpreporttextfile',
         'coredumpreportxmlfile',
         'coredumpreporthtmlfile',
+        'exceptioncode',
+        'exceptionname',
+        'exceptionaddress',
+        'exceptionmodule',
+        'exceptionfunction',
+        'threadcount',
+        'modulecount',
+        'dumpsize',
+        'reportsize',
         ]
 
     @staticmethod
@@ -90,12 +209,13 @@ class CrashDump(object):
             except:
                 return False
 
-    def __init__(self, id=None, uuid=None, env=None, version=None, must_exist=True, row=None):
+    def __init__(self, id=None, uuid=None, env=None, version=None, must_exist=True, row=None, row_fields=None):
         self.id = None
         self.status = None
         self.uuid = uuid
         self.env = env
         self._changes = None
+        self._linked_tickets = None
         self.resource = Resource('crash', uuid, version)
         self.fields = CrashDumpSystem(self.env).get_crash_fields()
         self.std_fields, self.custom_fields, self.time_fields = [], [], []
@@ -116,7 +236,7 @@ class CrashDump(object):
                                         id=id), _("Invalid crash identifier"))
             self._fetch_crash_by_id(crash_id, must_exist=must_exist)
         elif row is not None:
-            self._load_from_record(row)
+            self._load_from_record(row, row_fields)
         else:
             self._init_defaults()
         self._old = {}
@@ -199,21 +319,19 @@ class CrashDump(object):
             if name[9:] not in values:
                 self[name[9:]] = '0'
 
-    def _load_from_record(self, row):
-        for i, field in enumerate(self.std_fields):
-            #print('_load_from_record %i, %s=%s' % (i, field, row[i+1]))
-            if i == 0:
-                self.id = row[0]
-            elif field == 'uuid':
-                self.uuid = row[i + 1]
+    def _load_from_record(self, row, fields=None):
+        if fields is None:
+            fields = self.std_fields
+        self.id = row[0]
+        for field, value in zip(fields, row[1:]):
+            if field == 'uuid':
+                self.uuid = value
+            elif value is None:
+                self.values[field] = empty
+            elif field in self.time_fields:
+                self.values[field] = from_utimestamp(value)
             else:
-                value = row[i + 1]
-                if value is None:
-                    self.values[field] = empty
-                elif field in self.time_fields:
-                    self.values[field] = from_utimestamp(value)
-                else:
-                    self.values[field] = value
+                self.values[field] = value
 
     def _fetch_crash_by_id(self, id, must_exist=True):
         row = None
@@ -307,6 +425,8 @@ class CrashDump(object):
                        VALUES (%s, %s, %s)
                     """, [(crash_id, c, self[c]) for c in custom_fields])
 
+            CrashDumpFullTextIndex(self.env).update(db, [crash_id])
+
         self.id = crash_id
         self.resource = self.resource(id=crash_id)
         self._old = {}
@@ -330,11 +450,12 @@ class CrashDump(object):
             self['cc'] = _fixup_cc_list(self.values['cc'])
 
         # Perform type conversions
+        values = dict(self.values)
         for field in self.time_fields:
-            if field in self.values:
-                self.values[field] = to_utimestamp(self.values[field])
+            if field in values:
+                values[field] = to_utimestamp(values[field])
 
-        props_unchanged = all(self.values.get(k) == v
+        props_unchanged = all(values.get(k) == v
                               for k, v in self._old.iteritems())
         if (not comment or not comment.strip()) and props_unchanged:
             return False # Not modified
@@ -363,9 +484,6 @@ class CrashDump(object):
                     pass
 
         with self.env.db_transaction as db:
-            db("UPDATE crashdump SET changetime=%s WHERE id=%s",
-               (when_ts, self.id))
-
             # find cnum if it isn't provided
             if not cnum:
                 num = 0
@@ -387,35 +505,48 @@ class CrashDump(object):
                 if replyto:
                     cnum = '%s.%s' % (replyto, cnum)
 
-            # store fields
-            for name in self._old.keys():
-                if name in self.custom_fields:
-                    for row in db("""SELECT * FROM crash_custom
-                                     WHERE crash=%s and name=%s
-                                     """, (self.id, name)):
-                        db("""UPDATE crash_custom SET value=%s
-                              WHERE crash=%s AND name=%s
-                              """, (self[name], self.id, name))
-                        break
-                    else:
-                        db("""INSERT INTO crash_custom (crash,name,value)
-                              VALUES(%s,%s,%s)
-                              """, (self.id, name, self[name]))
-                else:
-                    db("UPDATE crashdump SET %s=%%s WHERE id=%%s"
-                       % name, (self[name], self.id))
-                db("""INSERT INTO crashdump_change
-                        (crash,time,author,field,oldvalue,newvalue)
-                      VALUES (%s, %s, %s, %s, %s, %s)
-                      """, (self.id, when_ts, author, name, self._old[name],
-                            self[name]))
+            # store all changed standard fields and the change time with a
+            # single statement
+            std_changes = [name for name in self._old if name not in self.custom_fields]
+            custom_changes = [name for name in self._old if name in self.custom_fields]
+            updates = [(name, values.get(name)) for name in std_changes]
+            if 'changetime' not in self._old:
+                updates.append(('changetime', when_ts))
+            db("UPDATE crashdump SET %s WHERE id=%%s"
+               % ','.join('%s=%%s' % name for name, value in updates),
+               [value for name, value in updates] + [self.id])
+
+            if custom_changes:
+                existing = set(name for name, in db("""
+                        SELECT name FROM crashdump_custom
+                        WHERE crash=%%s AND name IN (%s)
+                        """ % ','.join(['%s'] * len(custom_changes)),
+                        [self.id] + custom_changes))
+                custom_updates = [(values.get(name), self.id, name)
+                                  for name in custom_changes if name in existing]
+                custom_inserts = [(self.id, name, values.get(name))
+                                  for name in custom_changes if name not in existing]
+                if custom_updates:
+                    db.executemany("""UPDATE crashdump_custom SET value=%s
+                                      WHERE crash=%s AND name=%s
+                                      """, custom_updates)
+                if custom_inserts:
+                    db.executemany("""INSERT INTO crashdump_custom (crash,name,value)
+                                      VALUES (%s,%s,%s)
+                                      """, custom_inserts)
 
             # always save comment, even if empty
             # (numbering support for timeline)
-            db("""INSERT INTO crashdump_change
-                    (crash,time,author,field,oldvalue,newvalue)
-                  VALUES (%s,%s,%s,'comment',%s,%s)
-                  """, (self.id, when_ts, author, cnum, comment))
+            changes = [(self.id, when_ts, author, name, self._old[name], values.get(name))
+                       for name in self._old]
+            changes.append((self.id, when_ts, author, 'comment', cnum, comment))
+            db.executemany("""INSERT INTO crashdump_change
+                                (crash,time,author,field,oldvalue,newvalue)
+                              VALUES (%s, %s, %s, %s, %s, %s)
+                              """, changes)
+
+            if indexed_columns.intersection(self._old):
+                CrashDumpFullTextIndex(self.env).update(db, [self.id])
 
         old_values = self._old
         self._old = {}
@@ -472,40 +603,455 @@ class CrashDump(object):
                 self.env.db_query(sql, args)]
 
     @staticmethod
-    def query(env, status=None, threshold=None):
-        ret = []
-        where_clause = ''
-        if status is not None:
-            if status == 'active':
-                where_clause = ' WHERE status<>\'closed\''
-            elif status == 'closed':
-                where_clause = ' WHERE status=\'closed\''
-            elif status == 'new':
-                where_clause = ' WHERE status=\'new\''
+    def _status_condition(status):
+        """Return the SQL condition and its arguments for the given status filter."""
+        if status is None:
+            return None, []
+        elif status == 'active':
+            return "status<>'closed'", []
+        elif status == 'closed':
+            return "status='closed'", []
+        else:
+            return "status=%s", [status]
+
+    # all columns of the crashdump table
+    db_columns = frozenset(c.name for c in db_default.tables[0].columns)
+
+    # the frame fields which can be searched by the `stack` filter of
+    # `query`, all of them are indexed
+    stack_filter_fields = ('function', 'module', 'source', 'line')
+
+    @staticmethod
+    def _stack_condition(stack):
+        """Return the SQL condition and its arguments selecting the crashes
+        with a frame matching the `stack` filter of `query`."""
+        conditions = []
+        args = []
+        for name, value in sorted(stack.items()):
+            if name == 'depth':
+                if value is not None:
+                    conditions.append('frameno<%s')
+                    args.append(int(value))
+            elif name in CrashDump.stack_filter_fields:
+                conditions.append('%s=%%s' % name)
+                args.append(value)
             else:
-                where_clause = ' WHERE status=\'%s\'' % status
+                raise ValueError('Invalid stack filter field %s' % name)
+        if not conditions:
+            raise ValueError('Empty stack filter')
+        return ("id IN (SELECT crash FROM crashdump_stack WHERE %s)" % ' AND '.join(conditions)), args
+
+    @staticmethod
+    def _query_conditions(env, status=None, threshold=None, filters=None, module=None, stack=None):
+        """Return the SQL conditions and their arguments for `query`."""
+        conditions = []
+        args = []
+        status_sql, status_args = CrashDump._status_condition(status)
+        if status_sql:
+            conditions.append(status_sql)
+            args += status_args
+
+        if module is not None:
+            if isinstance(module, tuple):
+                (module_name, module_version) = module
+            else:
+                (module_name, module_version) = (module, None)
+            module_sql = "SELECT id FROM crashdump_module_version WHERE name=%s"
+            args.append(module_name)
+            if module_version is not None:
+                module_sql += " AND version=%s"
+                args.append(module_version)
+            conditions.append("id IN (SELECT crash FROM crashdump_crash_module WHERE module IN (%s))" % module_sql)
+
+        if stack is not None:
+            stack_sql, stack_args = CrashDump._stack_condition(stack)
+            conditions.append(stack_sql)
+            args += stack_args
 
         if threshold is not None:
             (threshold_column, threshold_time) = threshold
-            if where_clause:
-                where_clause += ' AND %s < %i' % (threshold_column, to_utimestamp(threshold_time))
-            else:
-                where_clause = ' WHERE %s < %i' % (threshold_column, to_utimestamp(threshold_time))
+            if threshold_column not in ('crashtime', 'reporttime', 'uploadtime', 'changetime', 'closetime'):
+                raise ValueError('Invalid threshold column %s' % threshold_column)
+            conditions.append('%s<%%s' % threshold_column)
+            args.append(to_utimestamp(threshold_time))
+
+        if filters:
+            for name, value in sorted(filters.items()):
+                if name not in CrashDump.db_columns:
+                    raise ValueError('Invalid filter field %s' % name)
+                if isinstance(value, (list, tuple, set)):
+                    value = list(value)
+                    if not value:
+                        conditions.append('1=0')
+                        continue
+                    conditions.append('%s IN (%s)' % (name, ','.join(['%s'] * len(value))))
+                    args += value
+                elif value is None:
+                    conditions.append('%s IS NULL' % name)
+                else:
+                    conditions.append('%s=%%s' % name)
+                    args.append(value)
+        return conditions, args
 
-        fields = CrashDumpSystem(env).get_crash_fields()
-        std_fields = []
-        for f in fields:
-            if f.get('custom'):
-                pass
+    @staticmethod
+    def query(env, status=None, threshold=None, filters=None, order=None, desc=False,
+              limit=None, offset=None, after=None, fields=None, module=None, stack=None):
+        """Return the matching crashes as list of read-only CrashDumpRow objects.
+
+        `filters` maps field names to a value or a list of values. `module`
+        selects the crashes which loaded a module, given by the base name of
+        the module file or a (name, version) tuple. `stack` selects the
+        crashes with a frame in the stack of the exception thread matching
+        all values of a dict with the keys 'function', 'module', 'source'
+        and 'line'; with 'depth' only the given number of top frames is
+        searched. The crashes are sorted by the `order` field (and by id
+        for equal values) and only `limit` crashes starting at `offset` are
+        returned. Instead of an offset, the `after` keyset cursor can be
+        given to continue after a previous page: the id of the last crash
+        when sorted by id, otherwise a (value, id) tuple of the last crash
+        with the database value of the `order` field, None for NULL.
+        `fields` limits the fetched columns; all standard fields are fetched
+        by default.
+        """
+        if fields is None:
+            fields = CrashDumpSystem(env).get_crash_field_schema().std_fields
+        else:
+            for name in fields:
+                if name not in CrashDump.db_columns:
+                    raise ValueError('Invalid field %s' % name)
+        if order is not None and order not in CrashDump.db_columns:
+            raise ValueError('Invalid sort field %s' % order)
+
+        conditions, args = CrashDump._query_conditions(env, status=status, threshold=threshold, filters=filters,
+                                                       module=module, stack=stack)
+        direction = ' DESC' if desc else ''
+        cmp_op = '<' if desc else '>'
+        if order is None or order == 'id':
+            if after is not None:
+                conditions.append('id%s%%s' % cmp_op)
+                args.append(after)
+            order_clause = ' ORDER BY id' + direction
+        else:
+            if after is not None:
+                (after_value, after_id) = after
+                # NULL sorts first in ascending order on SQLite and MySQL,
+                # last on PostgreSQL
+                nulls_first = (get_dialect(env) == 'postgres') == desc
+                if after_value is None:
+                    condition = '%s IS NULL AND id%s%%s' % (order, cmp_op)
+                    if nulls_first:
+                        condition = '(%s) OR %s IS NOT NULL' % (condition, order)
+                    args.append(after_id)
+                else:
+                    condition = '%s%s%%s OR (%s=%%s AND id%s%%s)' % (order, cmp_op, order, cmp_op)
+                    if not nulls_first:
+                        condition += ' OR %s IS NULL' % order
+                    args += [after_value, after_value, after_id]
+                conditions.append('(%s)' % condition)
+            order_clause = ' ORDER BY %s%s,id%s' % (order, direction, direction)
+        where_clause = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        limit_clause = ''
+        if limit:
+            limit_clause = ' LIMIT %i' % limit
+            if offset:
+                limit_clause += ' OFFSET %i' % offset
+
+        schema = CrashDumpSystem(env).get_crash_field_schema()
+        index = dict((name, i + 1) for i, name in enumerate(fields))
+        return [CrashDumpRow(env, schema, index, row)
+                for row in env.db_query("SELECT id,%s FROM crashdump%s%s%s" %
+                                        (','.join(fields), where_clause, order_clause, limit_clause), args)]
+
+    @staticmethod
+    def query_count(env, status=None, threshold=None, filters=None, module=None, stack=None, limit=None):
+        """Return the number of crashes `query` finds without limit. With
+        `limit` at most that many crashes are counted."""
+        conditions, args = CrashDump._query_conditions(env, status=status, threshold=threshold, filters=filters,
+                                                       module=module, stack=stack)
+        where_clause = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        if limit:
+            sql = "SELECT COUNT(*) FROM (SELECT id FROM crashdump%s LIMIT %i) c" % (where_clause, limit)
+        else:
+            sql = "SELECT COUNT(*) FROM crashdump%s" % where_clause
+        for count, in env.db_query(sql, args):
+            return count
+        return 0
+
+    @staticmethod
+    def prefetch_linked_tickets(env, crashes):
+        """Fetch the linked tickets of all `crashes` with a single query."""
+        by_id = dict((crash.id, crash) for crash in crashes)
+        if not by_id:
+            return
+        for crash in crashes:
+            crash._linked_tickets = []
+        ids = sorted(by_id.keys())
+        for crashid, ticket in env.db_query(
+                "SELECT crash, ticket FROM crashdump_ticket WHERE crash IN (%s) ORDER BY crash, ticket" %
+                ','.join(['%s'] * len(ids)), ids):
+            by_id[crashid]._linked_tickets.append(int(ticket))
+
+    @staticmethod
+    def record_files(db, crashid, files):
+        """Store the size and hash of the files of a crash.
+
+        `files` maps the file fields to (item name, size, sha256) tuples as
+        returned by `file_info`.
+        """
+        if not files:
+            return
+        fields = sorted(files)
+        db("DELETE FROM crashdump_file WHERE crash=%%s AND field IN (%s)" % ','.join(['%s'] * len(fields)),
+           [crashid] + fields)
+        db.executemany("INSERT INTO crashdump_file (crash, field, name, size, sha256) VALUES (%s, %s, %s, %s, %s)",
+                       [(crashid, field) + tuple(files[field]) for field in fields])
+
+    @staticmethod
+    def file_info(dumpdata_dir, values, fields=None, locate=None):
+        """Return the (item name, size, sha256) tuples of the stored files
+        referenced by `values` as dict, for `record_files`. `locate` is
+        used as by `file_size_summary`."""
+        if locate is None:
+            locate = lambda item_name: os.path.join(dumpdata_dir, item_name)
+        ret = {}
+        for field in CrashDump.dump_file_fields if fields is None else fields:
+            item_name = values.get(field)
+            if item_name:
+                info = dump_file_info(locate(item_name))
+                if info is not None:
+                    ret[field] = (item_name,) + info
+        return ret
+
+    @staticmethod
+    def get_file_info(env, crashes):
+        """Return the recorded sizes and hashes of the files of `crashes`.
+
+        `crashes` maps the crash ids to the crashes or their values. Files
+        which have been replaced or removed since they were recorded are
+        left out. Returns a dict mapping the crash ids to dicts mapping the
+        file fields to dicts with 'size' and 'sha256'.
+        """
+        ret = {}
+        ids = sorted(crashes)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            for crashid, field, name, size, sha256 in env.db_query(
+                    "SELECT crash, field, name, size, sha256 FROM crashdump_file WHERE crash IN (%s)" %
+                    ','.join(['%s'] * len(chunk)), chunk):
+                if field in CrashDump.dump_file_fields and name and crashes[crashid][field] == name:
+                    ret.setdefault(crashid, {})[field] = {'size': size, 'sha256': sha256}
+        return ret
+
+    def get_files(self):
+        """Return the recorded sizes and hashes of the files of this crash,
+        see `get_file_info`."""
+        if self.id is None:
+            return {}
+        return CrashDump.get_file_info(self.env, {self.id: self}).get(self.id, {})
+
+    @staticmethod
+    def _module_version_ids(env, modules):
+        """Return a dict mapping the (name, version) tuples of `modules` to
+        the ids of their rows in crashdump_module_version, adding the
+        missing rows."""
+        def lookup(modules):
+            ret = {}
+            names = sorted(set(name for name, version in modules))
+            for start in range(0, len(names), 500):
+                chunk = names[start:start + 500]
+                for id, name, version in env.db_query(
+                        "SELECT id, name, version FROM crashdump_module_version WHERE name IN (%s)" %
+                        ','.join(['%s'] * len(chunk)), chunk):
+                    if (name, version) in modules:
+                        ret[(name, version)] = id
+            return ret
+
+        modules = set(modules)
+        ret = lookup(modules)
+        missing = sorted(modules.difference(ret))
+        if missing:
+            # rows added by a concurrent upload are skipped by the database,
+            # an IntegrityError would abort the whole transaction the modules
+            # are recorded in on PostgreSQL
+            dialect = get_dialect(env)
+            if dialect == 'postgres':
+                sql = "INSERT INTO crashdump_module_version (name, version) VALUES (%s, %s) ON CONFLICT DO NOTHING"
+            elif dialect == 'mysql':
+                sql = "INSERT IGNORE INTO crashdump_module_version (name, version) VALUES (%s, %s)"
             else:
-                std_fields.append(f['name'])
+                sql = "INSERT OR IGNORE INTO crashdump_module_version (name, version) VALUES (%s, %s)"
+            with env.db_transaction as db:
+                db.executemany(sql, missing)
+            ret.update(lookup(set(missing)))
+        return ret
+
+    @staticmethod
+    def record_modules(env, crashes):
+        """Replace the recorded modules of crashes.
 
-        # Fetch the standard crashdump fields
-        for row in env.db_query("SELECT id,%s FROM crashdump %s" % (','.join(std_fields), where_clause)):
-            crash = CrashDump(env=env, must_exist=True, row=row)
-            ret.append(crash)
+        `crashes` maps the crash ids to lists of (name, version) tuples as
+        returned by `report_modules`. Every distinct module and version is
+        stored only once, the crashes refer to it by id.
+        """
+        if not crashes:
+            return
+        ids = CrashDump._module_version_ids(env, set(module for modules in crashes.values() for module in modules))
+        crash_ids = sorted(crashes)
+        with env.db_transaction as db:
+            for start in range(0, len(crash_ids), 500):
+                chunk = crash_ids[start:start + 500]
+                db("DELETE FROM crashdump_crash_module WHERE crash IN (%s)" % ','.join(['%s'] * len(chunk)), chunk)
+            db.executemany("INSERT INTO crashdump_crash_module (crash, module) VALUES (%s, %s)",
+                           [(crashid, id) for crashid in crash_ids
+                            for id in sorted(set(ids[module] for module in crashes[crashid]))])
+
+    def get_modules(self):
+        """Return the sorted (name, version) tuples of the recorded modules
+        of this crash."""
+        if self.id is None:
+            return []
+        return sorted(self.env.db_query("""
+                SELECT m.name, m.version FROM crashdump_crash_module c
+                INNER JOIN crashdump_module_version m ON m.id=c.module
+                WHERE c.crash=%s""", (self.id,)))
+
+    @staticmethod
+    def module_versions(env, name):
+        """Return the sorted (version, number of crashes) tuples of the
+        recorded versions of the module `name`."""
+        return sorted(env.db_query("""
+                SELECT m.version, COUNT(c.crash) FROM crashdump_module_version m
+                INNER JOIN crashdump_crash_module c ON c.module=m.id
+                WHERE m.name=%s GROUP BY m.version""", (name,)))
+
+    @staticmethod
+    def record_stacks(db, crashid, stacks):
+        """Replace the stored stacks of all threads of a crash by `stacks`
+        as returned by `report_stacks`."""
+        db("DELETE FROM crashdump_thread_stacks WHERE crash=%s", (crashid,))
+        if stacks is not None:
+            db("INSERT INTO crashdump_thread_stacks (crash, threadcount, framecount, data) VALUES (%s, %s, %s, %s)",
+               (crashid,) + tuple(stacks))
+
+    def get_thread_stacks(self):
+        """Return the stored stacks of all threads of this crash as
+        ThreadStacks, or None if none have been stored.
+
+        The frames of a thread are only decoded when they are accessed.
+        """
+        if self.id is None:
+            return None
+        for data, in self.env.db_query("SELECT data FROM crashdump_thread_stacks WHERE crash=%s", (self.id,)):
+            return ThreadStacks(data)
+        return None
+
+    @staticmethod
+    def storage_usage(env, tz=utc):
+        """Return the space used by the recorded files of the crashes per
+        product and month of upload.
+
+        Returns a sorted list of (product, month, number of crashes, bytes)
+        tuples; `month` is the first day of the month in `tz`. The sizes of
+        the uncompressed files are counted.
+        """
+        for first, last in env.db_query("SELECT MIN(uploadtime), MAX(uploadtime) FROM crashdump"):
+            break
+        if first is None:
+            return []
+        # only the files still referenced by their crash count
+        current_name = 'CASE f.field %s END' % ' '.join("WHEN '%s' THEN c.%s" % (field, field)
+                                                        for field in CrashDump.dump_file_fields)
+        sql = """SELECT c.productname, COUNT(DISTINCT c.id), SUM(f.size)
+                 FROM crashdump c INNER JOIN crashdump_file f ON f.crash=c.id
+                 WHERE c.uploadtime>=%%s AND c.uploadtime<%%s AND f.name=%s
+                 GROUP BY c.productname""" % current_name
+        start = from_utimestamp(first).astimezone(tz)
+        month = to_datetime(datetime(start.year, start.month, 1), tz)
+        last = from_utimestamp(last)
+        ret = []
+        while month <= last:
+            if month.month == 12:
+                next_month = to_datetime(datetime(month.year + 1, 1, 1), tz)
+            else:
+                next_month = to_datetime(datetime(month.year, month.month + 1, 1), tz)
+            for product, num_crashes, size in env.db_query(sql, (to_utimestamp(month), to_utimestamp(next_month))):
+                ret.append((product, month, num_crashes, size or 0))
+            month = next_month
+        ret.sort(key=lambda row: (row[0] or '', row[1]))
         return ret
 
+    @staticmethod
+    def _crashlist_conditions(status=None, since=None):
+        conditions = []
+        args = []
+        status_sql, status_args = CrashDump._status_condition(status)
+        if status_sql:
+            conditions.append(status_sql)
+            args += status_args
+        if since is not None:
+            conditions.append('changetime>=%s')
+            args.append(to_utimestamp(since))
+        return conditions, args
+
+    @staticmethod
+    def crashlist_state(env, status=None, since=None):
+        """Return the number of matching crashes, their latest change time and
+        the number of their ticket links.
+
+        The values change whenever the result of `iter_crashlist` changes
+        and are used to answer conditional requests.
+        """
+        conditions, args = CrashDump._crashlist_conditions(status, since)
+        where_clause = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        for count, changetime in env.db_query(
+                "SELECT COUNT(*), MAX(changetime) FROM crashdump%s" % where_clause, args):
+            break
+        for num_links, in env.db_query(
+                "SELECT COUNT(*) FROM crashdump_ticket"
+                " WHERE crash IN (SELECT id FROM crashdump%s)" % where_clause, args):
+            break
+        return count, from_utimestamp(changetime) if changetime else None, num_links
+
+    @staticmethod
+    def iter_crashlist(env, fields, status=None, since=None, after_id=None, limit=None):
+        """Yield (id, values, linked_tickets) for the matching crashes ordered by id.
+
+        `fields` lists the crashdump columns to fetch. Only crashes with an id
+        greater than `after_id` are returned, so the last id returned can be
+        passed to continue with the next page. The linked tickets are fetched
+        in the same query.
+        """
+        conditions, args = CrashDump._crashlist_conditions(status, since)
+        if after_id is not None:
+            conditions.append('id>%s')
+            args.append(after_id)
+        where_clause = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        limit_clause = ' LIMIT %i' % limit if limit else ''
+        sql = """SELECT c.id,%s,t.ticket FROM
+                    (SELECT id,%s FROM crashdump%s ORDER BY id%s) AS c
+                 LEFT OUTER JOIN crashdump_ticket AS t ON t.crash=c.id
+                 ORDER BY c.id,t.ticket""" % (
+                    ','.join('c.' + f for f in fields), ','.join(fields), where_clause, limit_clause)
+
+        crash_id = None
+        values = None
+        tickets = []
+        with env.db_query as db:
+            # iterate the cursor instead of fetching all rows at once
+            cursor = db.cursor()
+            cursor.execute(sql, args)
+            for row in cursor:
+                if row[0] != crash_id:
+                    if crash_id is not None:
+                        yield crash_id, values, tickets
+                    crash_id = row[0]
+                    values = dict(zip(fields, row[1:-1]))
+                    tickets = []
+                if row[-1] is not None:
+                    tickets.append(int(row[-1]))
+        if crash_id is not None:
+            yield crash_id, values, tickets
+
     @staticmethod
     def find_by_uuid(env, uuid):
         ret = CrashDump(env=env, uuid=uuid, must_exist=False)
@@ -526,25 +1072,33 @@ class CrashDump(object):
                 ret = True
         return ret
 
-    def delete(self, dumpdata_dir):
-        ret = False
+    def delete(self, dumpdata_dir, archive_dir=None):
+        ret = CrashDump._delete_crash_files(self, dumpdata_dir, archive_dir)[0]
         with self.env.db_transaction as db:
-            cursor = db.cursor()
-
-            ret = CrashDump._delete_crash_files(self, dumpdata_dir)
-
-            sql = "DELETE FROM crashdump_change WHERE crash='%s'" % self.id
-            cursor = db.cursor()
-            sql = "DELETE FROM crashdump_ticket WHERE crash='%s'" % self.id
-            cursor.execute(sql)
-            sql = "DELETE FROM crashdump_stack WHERE crash='%s'" % self.id
-            cursor.execute(sql)
-            # finally delete the crash itself
-            sql = "DELETE FROM crashdump WHERE uuid='%s'" % self.uuid
-            cursor.execute(sql)
-
+            CrashDump.delete_rows(self.env, db, [self.id])
         return ret
 
+    @staticmethod
+    def delete_rows(env, db, crash_ids):
+        """Delete the database rows of the given crashes, without their files."""
+        crash_ids = [int(crashid) for crashid in crash_ids]
+        if not crash_ids:
+            return
+        CrashDumpFullTextIndex(env).remove(db, crash_ids)
+        id_list = ','.join(['%s'] * len(crash_ids))
+        cursor = db.cursor()
+        # the shared rows of crashdump_module_version are kept
+        tables = ['crashdump_change', 'crashdump_ticket', 'crashdump_stack', 'crashdump_file',
+                  'crashdump_crash_module', 'crashdump_thread_stacks']
+        # the values of custom fields, the table is not part of the default
+        # schema
+        if 'crashdump_custom' in db.get_table_names():
+            tables.append('crashdump_custom')
+        for table in tables:
+            cursor.execute("DELETE FROM %s WHERE crash IN (%s)" % (table, id_list), crash_ids)
+        # finally delete the crashes themselves
+        cursor.execute("DELETE FROM crashdump WHERE id IN (%s)" % id_list, crash_ids)
+
     @property
     def changes(self):
         if self._changes is None:
@@ -553,6 +1107,8 @@ class CrashDump(object):
 
     @property
     def linked_tickets(self):
+        if self._linked_tickets is not None:
+            return self._linked_tickets
         ret = []
         with self.env.db_transaction as db:
             cursor = db.cursor()
@@ -567,46 +1123,188 @@ class CrashDump(object):
         return CrashDump.query(env=env, threshold=(column, threshold))
 
     @staticmethod
-    def _delete_crash_files(crashobj, dumpdata_dir):
+    def _delete_crash_files(crashobj, dumpdata_dir, archive_dir=None):
+        """Remove all files of a crash, including the files moved to
+        `archive_dir`.
+
+        Returns a (success, number of files, bytes freed) tuple.
+        """
         ret = True
-        _crash_file_fields = [
-                'minidumpfile',
-                'minidumpreporttextfile',
-                'minidumpreportxmlfile',
-                'minidumpreporthtmlfile',
-                'coredumpfile',
-                'coredumpreporttextfile',
-                'coredumpreportxmlfile',
-                'coredumpreporthtmlfile',
-            ]
-        crash_dir = os.path.join(dumpdata_dir, crashobj.uuid)
-        for field in _crash_file_fields:
+        num_files = 0
+        num_bytes = 0
+        crash_dirs = [os.path.join(dumpdata_dir, name) for name in crash_dir_names(crashobj.uuid)]
+        if archive_dir:
+            crash_dirs += [os.path.join(archive_dir, name) for name in crash_dir_names(crashobj.uuid)]
+        paths = []
+        for field in CrashDump.dump_file_fields:
             if crashobj[field]:
-                crash_file = os.path.join(crash_dir, crashobj[field])
-                if os.path.isfile(crash_file):
-                    try:
-                        os.remove(crash_file)
-                    except:
-                        ret = False
-        if os.path.isdir(crash_dir):
+                for item_name in [crashobj[field]] + alternative_item_names(crashobj[field]):
+                    paths += stored_dump_files(os.path.join(dumpdata_dir, item_name))
+                    if archive_dir:
+                        paths += stored_dump_files(os.path.join(archive_dir, item_name))
+        for crash_dir in crash_dirs:
+            if os.path.isdir(crash_dir):
+                for dirpath, dirnames, filenames in os.walk(crash_dir):
+                    paths += [os.path.join(dirpath, f) for f in filenames]
+        for path in sorted(set(paths)):
             try:
-                import shutil
-                shutil.rmtree(crash_dir)
-            except:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
                 ret = False
-        return ret
+                continue
+            num_files += 1
+            num_bytes += size
+        for crash_dir in crash_dirs:
+            if os.path.isdir(crash_dir):
+                try:
+                    shutil.rmtree(crash_dir)
+                except OSError:
+                    ret = False
+        return (ret, num_files, num_bytes)
 
+    # number of crashes deleted per transaction by purge_old_data
+    purge_batch_size = 500
+    _purge_checkpoint = 'crashdump_purge'
 
     @staticmethod
-    def purge_old_data(env, dumpdata_dir, threshold, column='crashtime'):
-        ret = True
-        crashes = CrashDump.query(env=env, threshold=(column, threshold))
-        for crashobj in crashes:
-            if not CrashDump._delete_crash_files(crashobj, dumpdata_dir):
-                ret = False
+    def _get_purge_checkpoint(env, key):
+        for value, in env.db_query("SELECT value FROM system WHERE name=%s",
+                                   (CrashDump._purge_checkpoint,)):
+            checkpoint_key, _sep, last_id = value.rpartition(':')
+            if checkpoint_key == key:
+                return int(last_id)
+        return 0
+
+    @staticmethod
+    def _set_purge_checkpoint(db, key, last_id):
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM system WHERE name=%s", (CrashDump._purge_checkpoint,))
+        if key is not None:
+            cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                           (CrashDump._purge_checkpoint, '%s:%i' % (key, last_id)))
+
+    @staticmethod
+    def purge_old_data(env, dumpdata_dir, threshold, column='crashtime',
+                       batch_size=None, jobs=1, resume=True, progress=None,
+                       archive_dir=None):
+        """Delete all crashes older than `threshold` including their files.
+
+        The crashes are processed in batches of `batch_size` crashes: the
+        files of a batch are removed by `jobs` threads, then the database
+        rows of the batch are deleted in one transaction which also stores
+        the last processed id. An interrupted purge with the same threshold
+        continues after that id if `resume` is set. Crashes whose files
+        could not be removed are kept. Files moved to `archive_dir` are
+        removed as well. `progress` is called with the totals after every
+        batch.
+
+        Returns a dict with the number of deleted 'crashes', the number of
+        removed 'files', the 'bytes' freed and the number of crashes which
+        'failed'.
+        """
+        batch_size = batch_size or CrashDump.purge_batch_size
+        key = '%s:%i' % (column, to_utimestamp(threshold))
+        last_id = CrashDump._get_purge_checkpoint(env, key) if resume else 0
+        ret = {'crashes': 0, 'files': 0, 'bytes': 0, 'failed': 0}
+
+        def remove(crashobj):
+            return CrashDump._delete_crash_files(crashobj, dumpdata_dir, archive_dir)
+
+        pool = ThreadPool(jobs) if jobs > 1 else None
+        try:
+            while True:
+                crashes = CrashDump.query(env=env, threshold=(column, threshold),
+                                          order='id', limit=batch_size, after=last_id,
+                                          fields=['uuid'] + list(CrashDump.dump_file_fields))
+                if not crashes:
+                    break
+                results = pool.map(remove, crashes) if pool is not None else map(remove, crashes)
+                deleted = []
+                for crashobj, (success, num_files, num_bytes) in zip(crashes, results):
+                    ret['files'] += num_files
+                    ret['bytes'] += num_bytes
+                    if success:
+                        deleted.append(crashobj.id)
+                    else:
+                        ret['failed'] += 1
+                last_id = crashes[-1].id
+                with env.db_transaction as db:
+                    CrashDump.delete_rows(env, db, deleted)
+                    CrashDump._set_purge_checkpoint(db, key, last_id)
+                ret['crashes'] += len(deleted)
+                if progress is not None:
+                    progress(ret)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        with env.db_transaction as db:
+            CrashDump._set_purge_checkpoint(db, None, 0)
         return ret
 
 
+class CrashDumpRow(object):
+    """Read-only crash as returned by the bulk queries.
+
+    The row only keeps the fetched column values; the field schema and the
+    column positions are shared by all rows of a query. Use `crashdump()`
+    to get the full CrashDump model for editing.
+    """
+    __slots__ = ('env', 'schema', '_index', '_row', '_linked_tickets')
+
+    exists = True
+
+    def __init__(self, env, schema, index, row):
+        self.env = env
+        self.schema = schema
+        self._index = index
+        self._row = row
+        self._linked_tickets = None
+
+    id = property(lambda self: self._row[0])
+    uuid = property(lambda self: self.get_raw('uuid'))
+    resource = property(lambda self: Resource('crash', self.uuid))
+
+    has_minidump = property(lambda self: any(self[f] for f in CrashDump.dump_file_fields[:4]))
+    has_coredump = property(lambda self: any(self[f] for f in CrashDump.dump_file_fields[4:]))
+
+    def get_raw(self, name):
+        """Return the database value of a field, None if it was not fetched."""
+        pos = self._index.get(name)
+        return self._row[pos] if pos is not None else None
+
+    def __getitem__(self, name):
+        # same conversions as CrashDump._load_from_record
+        pos = self._index.get(name)
+        if pos is None:
+            return None
+        value = self._row[pos]
+        if value is None:
+            return empty
+        elif name in self.schema.time_fields:
+            return from_utimestamp(value)
+        return value
+
+    @property
+    def values(self):
+        return dict((name, self[name]) for name in self._index)
+
+    @property
+    def linked_tickets(self):
+        if self._linked_tickets is not None:
+            return self._linked_tickets
+        return [int(ticket) for ticket, in self.env.db_query(
+                "SELECT ticket FROM crashdump_ticket WHERE crash=%s ORDER BY ticket", (self.id,))]
+
+    def crashdump(self):
+        """Return the full CrashDump model of this crash."""
+        return CrashDump(env=self.env, id=self.id)
+
+    def __repr__(self):
+        return '<%s #%s %s>' % (self.__class__.__name__, self.id, self.uuid)
+
+
 class CrashDumpStackFrame(object):
 
     __db_fields = [
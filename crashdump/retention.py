@@ -0,0 +1,268 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import os
+import errno
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+from trac.core import *
+from trac.config import ConfigSection, Option, PathOption
+from trac.util import as_int
+from trac.util.datefmt import to_utimestamp, utc
+
+from .storage import stored_dump_files, dump_file_exists, compress_dump_file, \
+    resolve_compression_method, alternative_item_names, lock_crash
+
+class CrashDumpRetention(Component):
+    """Moves the raw dump files of old crashes to an archive directory and
+    drops them later, keeping the reports and the crash records.
+
+    The rules are read from the `[crashdump-retention]` section; the sweep
+    runs as the `sweep` maintenance job.
+    """
+
+    dumpdata_dir = PathOption('crashdump', 'dumpdata_dir', default='../dumpdata',
+                      doc='Path to the crash dump data directory relative to the environment conf directory.')
+
+    archive_dir = PathOption('crashdump', 'archive_dir', '',
+        """Directory to which the raw dump files of old crashes are moved,
+        relative to the environment conf directory. The files are looked up
+        there when they are no longer in the dump data directory. Archiving
+        is disabled if empty.""")
+
+    archive_compression = Option('crashdump', 'archive_compression', 'none',
+        """Compression method for the files moved to the archive directory:
+        `none`, `auto`, `gzip` or `zstd`.""")
+
+    retention_section = ConfigSection('crashdump-retention',
+        """Retention rules for the raw dump files (minidump and core dump) of
+        the crashes. The reports and the crash records are always kept.
+
+        Every rule has a name and the attributes `product` and `status`
+        selecting the crashes it applies to (all crashes if not given),
+        `archive_days` after which the files are moved to the
+        `[crashdump] archive_dir` and `drop_days` after which they are
+        deleted. The age of a crash is counted from its upload. If several
+        rules match a crash, the one naming both product and status wins
+        over the one naming the product, which wins over the one naming the
+        status and the rules without product and status; missing values are
+        taken from the less specific rules.
+        {{{
+        [crashdump-retention]
+        default.archive_days = 30
+        default.drop_days = 365
+        closed.status = closed
+        closed.drop_days = 90
+        myapp.product = MyApp
+        myapp.archive_days = 7
+        }}}
+        """)
+
+    # number of crashes handled per transaction by the sweep
+    sweep_batch_size = 500
+
+    def get_rules(self):
+        """Return the retention rules as a list of dicts."""
+        rules = {}
+        for option, value in self.retention_section.options():
+            name, sep, attr = option.rpartition('.')
+            if not sep or attr not in ('product', 'status', 'archive_days', 'drop_days'):
+                continue
+            rule = rules.setdefault(name, {'name': name, 'product': None, 'status': None,
+                                           'archive_days': None, 'drop_days': None})
+            if attr in ('archive_days', 'drop_days'):
+                rule[attr] = as_int(value, None, min=0)
+            else:
+                rule[attr] = value.strip() or None
+        return [rules[rule_name] for rule_name in sorted(rules)]
+
+    @staticmethod
+    def get_policy(rules, product, status):
+        """Return the (archive days, drop days) of a crash according to
+        `rules`; None means the files are never archived or dropped."""
+        matching = [rule for rule in rules
+                    if rule['product'] in (None, product) and rule['status'] in (None, status)]
+        # most specific rules first, the sort is stable for equal rules
+        matching.sort(key=lambda rule: (rule['product'] is None, rule['status'] is None))
+        archive_days = drop_days = None
+        for rule in matching:
+            if archive_days is None:
+                archive_days = rule['archive_days']
+            if drop_days is None:
+                drop_days = rule['drop_days']
+        return archive_days, drop_days
+
+    def dump_file_path(self, item_name):
+        """Return the absolute name of a dump file, in the archive directory
+        if it has been moved there.
+
+        Files which are not found under `item_name` are looked up in the
+        other storage layouts, where they may have been moved by the layout
+        migration.
+        """
+        primary = os.path.join(self.env.path, self.dumpdata_dir, item_name)
+        if dump_file_exists(primary):
+            return primary
+        roots = [os.path.join(self.env.path, self.dumpdata_dir)]
+        if self.archive_dir:
+            roots.append(self.archive_dir)
+        for name in [item_name] + alternative_item_names(item_name):
+            for root in roots:
+                path = os.path.join(root, name)
+                if dump_file_exists(path):
+                    return path
+        return primary
+
+    def _archive_file(self, item_name, method):
+        """Move all stored variants of a dump file to the archive directory.
+
+        Returns the number of bytes moved.
+        """
+        ret = 0
+        primary = os.path.join(self.env.path, self.dumpdata_dir, item_name)
+        target = os.path.join(self.archive_dir, item_name)
+        target_dir = os.path.dirname(target)
+        try:
+            os.makedirs(target_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        for path in stored_dump_files(primary):
+            size = os.path.getsize(path)
+            archived = target + path[len(primary):]
+            # copy under a temporary name first, the archive may be on
+            # another volume
+            fd, tmpname = tempfile.mkstemp(prefix='.archive-', dir=target_dir)
+            try:
+                with os.fdopen(fd, 'wb') as out, open(path, 'rb') as src:
+                    shutil.copyfileobj(src, out, 1024 * 1024)
+                shutil.copymode(path, tmpname)
+                os.rename(tmpname, archived)
+            except:
+                try:
+                    os.remove(tmpname)
+                except OSError:
+                    pass
+                raise
+            if method is not None and archived == target:
+                compress_dump_file(archived, method)
+            os.remove(path)
+            ret += size
+        return ret
+
+    def _drop_file(self, item_name):
+        """Delete all stored variants of a dump file. Returns the number of
+        bytes freed."""
+        ret = 0
+        paths = stored_dump_files(os.path.join(self.env.path, self.dumpdata_dir, item_name))
+        if self.archive_dir:
+            paths += stored_dump_files(os.path.join(self.archive_dir, item_name))
+        for path in paths:
+            size = os.path.getsize(path)
+            os.remove(path)
+            ret += size
+        return ret
+
+    def sweep(self, now=None, jobs=1, progress=None):
+        """Archive and drop the raw dump files according to the rules.
+
+        The candidate crashes are read in batches; the files of a batch are
+        moved or deleted by `jobs` threads. Every crash is processed and
+        its record updated with the crash locked, crashes whose files have
+        been changed by an upload since they were read are left for the
+        next sweep. Returns a dict with the numbers of 'archived' and
+        'dropped' crashes, the bytes 'moved' and 'freed' and the number of
+        crashes which 'failed'.
+        """
+        ret = {'archived': 0, 'dropped': 0, 'moved': 0, 'freed': 0, 'failed': 0}
+        rules = self.get_rules()
+        days = [rule[attr] for rule in rules for attr in ('archive_days', 'drop_days')
+                if rule[attr] is not None]
+        if not days:
+            return ret
+        if now is None:
+            now = datetime.now(utc)
+        now_ts = to_utimestamp(now)
+        cutoff = to_utimestamp(now - timedelta(days=min(days)))
+        day = 24 * 3600 * 1000000
+        method = resolve_compression_method(self.archive_compression)
+        dumpdata_dir = os.path.join(self.env.path, self.dumpdata_dir)
+
+        def process(entry):
+            crashid, uuid, action, item_names = entry
+            size = 0
+            try:
+                with lock_crash(dumpdata_dir, uuid):
+                    rows = self.env.db_query("""SELECT minidumpfile, coredumpfile, archivetime
+                                                FROM crashdump WHERE id=%s""", (crashid,))
+                    if not rows or [f for f in rows[0][:2] if f] != item_names or \
+                            (action == 'archive' and rows[0][2] is not None):
+                        self.log.debug('Crash %i has been changed, skipping it', crashid)
+                        return (crashid, action, 0, None)
+                    for item_name in item_names:
+                        if action == 'archive':
+                            size += self._archive_file(item_name, method)
+                        else:
+                            size += self._drop_file(item_name)
+                    with self.env.db_transaction as db:
+                        if action == 'archive':
+                            db("UPDATE crashdump SET archivetime=%s WHERE id=%s", (now_ts, crashid))
+                        else:
+                            db("UPDATE crashdump SET minidumpfile=NULL, coredumpfile=NULL WHERE id=%s",
+                               (crashid,))
+                            db("""DELETE FROM crashdump_file
+                                  WHERE crash=%s AND field IN ('minidumpfile', 'coredumpfile')""", (crashid,))
+            except (IOError, OSError) as e:
+                self.log.warning('Failed to %s the files of crash %i: %s', action, crashid, e)
+                return (crashid, action, size, False)
+            return (crashid, action, size, True)
+
+        last_id = 0
+        pool = ThreadPool(jobs) if jobs > 1 else None
+        try:
+            while True:
+                rows = self.env.db_query("""
+                        SELECT id, uuid, productname, status, uploadtime, archivetime,
+                               minidumpfile, coredumpfile
+                        FROM crashdump
+                        WHERE id>%%s AND uploadtime<%%s
+                          AND (COALESCE(minidumpfile,'')<>'' OR COALESCE(coredumpfile,'')<>'')
+                        ORDER BY id LIMIT %i""" % self.sweep_batch_size, (last_id, cutoff))
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                entries = []
+                for crashid, uuid, product, status, uploadtime, archivetime, minidumpfile, coredumpfile in rows:
+                    archive_days, drop_days = self.get_policy(rules, product, status)
+                    item_names = [f for f in (minidumpfile, coredumpfile) if f]
+                    age = now_ts - uploadtime
+                    if drop_days is not None and age >= drop_days * day:
+                        entries.append((crashid, uuid, 'drop', item_names))
+                    elif archive_days is not None and archivetime is None and \
+                            self.archive_dir and age >= archive_days * day:
+                        entries.append((crashid, uuid, 'archive', item_names))
+                if not entries:
+                    continue
+                results = pool.map(process, entries) if pool is not None else map(process, entries)
+                for crashid, action, size, success in results:
+                    if success is None:
+                        pass
+                    elif not success:
+                        ret['failed'] += 1
+                    elif action == 'archive':
+                        ret['archived'] += 1
+                        ret['moved'] += size
+                    else:
+                        ret['dropped'] += 1
+                        ret['freed'] += size
+                if progress is not None:
+                    progress(ret)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return ret
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import os
+import shutil
+import time
+from multiprocessing.pool import ThreadPool
+from uuid import UUID
+
+from trac.core import *
+from trac.config import PathOption
+
+from .model import CrashDump
+from .retention import CrashDumpRetention
+from .storage import stored_dump_files, strip_compression_suffix, scan_directory, directory_size, \
+    crash_dir_name, split_item_name, alternative_item_names, lock_crash
+
+def _is_uuid(name):
+    try:
+        return str(UUID(name)) == name
+    except ValueError:
+        return False
+
+def _references(item_names):
+    """Return the names of the files referenced by the item names of a
+    crash."""
+    # the files of a crash may be in the directory of any layout while the
+    # crashes are migrated
+    return set(split_item_name(item_name)[1] for item_name in item_names if item_name)
+
+def _find_crash_dirs(root):
+    """Return the crash directories below `root` in all storage layouts,
+    relative to `root`."""
+    ret = []
+    for name, is_dir, size, mtime in scan_directory(root):
+        if not is_dir:
+            continue
+        if _is_uuid(name):
+            ret.append(name)
+        elif len(name) == 2:
+            for name2, is_dir2, size2, mtime2 in scan_directory(os.path.join(root, name)):
+                if not is_dir2 or len(name2) != 2:
+                    continue
+                for uuid, is_dir3, size3, mtime3 in scan_directory(os.path.join(root, name, name2)):
+                    if is_dir3 and _is_uuid(uuid) and crash_dir_name(uuid, 'sharded') == os.path.join(name, name2, uuid):
+                        ret.append(os.path.join(name, name2, uuid))
+    return sorted(ret)
+
+class CrashDumpScrubber(Component):
+    """Checks the crash dump storage against the crash records.
+
+    Reports the files referenced by crashes which no longer exist, the
+    crash directories and files in the dump data and archive directories
+    which belong to no crash and the space used by the crashes of every
+    status and product. Only the directories named after a crash uuid, in
+    any storage layout, are checked; hidden entries like the upload staging
+    directory are skipped.
+    """
+
+    dumpdata_dir = PathOption('crashdump', 'dumpdata_dir', default='../dumpdata',
+                      doc='Path to the crash dump data directory relative to the environment conf directory.')
+
+    # number of crashes or crash directories checked per transaction
+    scrub_batch_size = 500
+
+    # entries modified within this number of seconds are never reported as
+    # orphaned, they may belong to an upload in progress
+    grace_period = 3600
+
+    def scrub(self, repair=False, jobs=1, progress=None, found=None, now=None):
+        """Check the crash records and the storage directories.
+
+        With `repair` the references to missing files are cleared and the
+        orphaned files and directories are deleted, one batch at a time.
+        The files are checked by `jobs` threads. `found` is called with the
+        kind ('missing' or 'orphan'), the name of the file, the crash id (if
+        any) and the size of every problem found, `progress` with the
+        result after every batch. Returns a dict with the numbers of checked
+        'crashes', 'missing' files, 'repaired' references, 'orphans',
+        'removed' orphans and 'failed' removals, the 'orphan_bytes' and the
+        bytes used per (status, product) in 'usage'.
+        """
+        ret = {'crashes': 0, 'missing': 0, 'repaired': 0, 'orphans': 0, 'orphan_bytes': 0,
+               'removed': 0, 'failed': 0, 'usage': {}}
+        if now is None:
+            now = time.time()
+        pool = ThreadPool(jobs) if jobs > 1 else None
+        try:
+            self._scrub_records(ret, repair, pool, progress, found)
+            archive_dir = CrashDumpRetention(self.env).archive_dir
+            for root in [os.path.join(self.env.path, self.dumpdata_dir)] + ([archive_dir] if archive_dir else []):
+                self._scrub_directory(root, ret, repair, pool, progress, found, now - self.grace_period)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return ret
+
+    def _scrub_records(self, ret, repair, pool, progress, found):
+        fields = CrashDump.dump_file_fields
+        dumpdata_dir = os.path.join(self.env.path, self.dumpdata_dir)
+        archive_dir = CrashDumpRetention(self.env).archive_dir
+        roots = [dumpdata_dir] + ([archive_dir] if archive_dir else [])
+
+        def check(row):
+            crashid, status, product = row[:3]
+            missing = []
+            size = 0
+            for field, item_name in zip(fields, row[3:]):
+                if not item_name:
+                    continue
+                paths = []
+                for name in [item_name] + alternative_item_names(item_name):
+                    for root in roots:
+                        paths = stored_dump_files(os.path.join(root, name))
+                        if paths:
+                            break
+                    if paths:
+                        break
+                if not paths:
+                    missing.append((field, item_name))
+                for path in paths:
+                    try:
+                        size += os.path.getsize(path)
+                    except OSError:
+                        pass
+            return (crashid, status, product, missing, size)
+
+        usage = ret['usage']
+        last_id = 0
+        while True:
+            rows = self.env.db_query("SELECT id, status, productname, %s FROM crashdump WHERE id>%%s "
+                                     "ORDER BY id LIMIT %i" % (','.join(fields), self.scrub_batch_size),
+                                     (last_id,))
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            results = pool.map(check, rows) if pool is not None else map(check, rows)
+            dangling = {}
+            for crashid, status, product, missing, size in results:
+                usage[(status, product)] = usage.get((status, product), 0) + size
+                for field, item_name in missing:
+                    ret['missing'] += 1
+                    if found is not None:
+                        found('missing', item_name, crashid, 0)
+                    dangling.setdefault(field, []).append((crashid, item_name))
+            if repair and dangling:
+                with self.env.db_transaction as db:
+                    for field, references in sorted(dangling.items()):
+                        # only clear the reference if the file has not been
+                        # replaced in the meantime
+                        db.executemany("UPDATE crashdump SET %s=NULL WHERE id=%%s AND %s=%%s" % (field, field),
+                                       references)
+                        ret['repaired'] += len(references)
+            ret['crashes'] += len(rows)
+            if progress is not None:
+                progress(ret)
+
+    def _get_crash(self, uuid):
+        """Return the id and the referenced file names of the crash `uuid`,
+        None if it does not exist."""
+        for row in self.env.db_query("SELECT id, %s FROM crashdump WHERE uuid=%%s" %
+                                     ','.join(CrashDump.dump_file_fields), (uuid,)):
+            return (row[0], _references(row[1:]))
+        return None
+
+    def _scrub_directory(self, root, ret, repair, pool, progress, found, cutoff):
+        if not os.path.isdir(root):
+            return
+        fields = CrashDump.dump_file_fields
+        names = _find_crash_dirs(root)
+        dumpdata_dir = os.path.join(self.env.path, self.dumpdata_dir)
+
+        def remove(path, is_dir):
+            try:
+                if is_dir:
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                self.log.warning('Failed to remove %s: %s', path, e)
+                return False
+            return True
+
+        def check(entry):
+            name, crash = entry
+            path = os.path.join(root, name)
+            orphans = []
+            try:
+                if crash is None:
+                    if os.stat(path).st_mtime < cutoff:
+                        orphans.append((path, True, None, directory_size(path)))
+                else:
+                    crashid, references = crash
+                    for entry_name, is_dir, size, mtime in scan_directory(path):
+                        if mtime >= cutoff:
+                            continue
+                        if not is_dir and strip_compression_suffix(entry_name) in references:
+                            continue
+                        entry_path = os.path.join(path, entry_name)
+                        orphans.append((entry_path, is_dir, crashid, directory_size(entry_path) if is_dir else size))
+            except OSError:
+                # removed concurrently
+                return []
+            if not repair or not orphans:
+                return [(orphan_path, orphan_crashid, size, None)
+                        for orphan_path, is_dir, orphan_crashid, size in orphans]
+            result = []
+            uuid = os.path.basename(name)
+            with lock_crash(dumpdata_dir, uuid):
+                # an upload may have added the crash or its files since the
+                # crashes were read
+                crash = self._get_crash(uuid)
+                for orphan_path, is_dir, orphan_crashid, size in orphans:
+                    if crash is None or orphan_path == path:
+                        orphaned = crash is None
+                    else:
+                        orphaned = is_dir or strip_compression_suffix(os.path.basename(orphan_path)) not in crash[1]
+                    if orphaned:
+                        result.append((orphan_path, orphan_crashid, size, remove(orphan_path, is_dir)))
+            return result
+
+        for start in range(0, len(names), self.scrub_batch_size):
+            chunk = names[start:start + self.scrub_batch_size]
+            crashes = {}
+            uuids = [os.path.basename(name) for name in chunk]
+            for row in self.env.db_query("SELECT id, uuid, %s FROM crashdump WHERE uuid IN (%s)" %
+                                         (','.join(fields), ','.join(['%s'] * len(uuids))), uuids):
+                crashes[row[1]] = (row[0], _references(row[2:]))
+            entries = [(name, crashes.get(os.path.basename(name))) for name in chunk]
+            results = pool.map(check, entries) if pool is not None else map(check, entries)
+            for orphans in results:
+                for path, crashid, size, removed in orphans:
+                    ret['orphans'] += 1
+                    ret['orphan_bytes'] += size
+                    if removed:
+                        ret['removed'] += 1
+                    elif removed is not None:
+                        ret['failed'] += 1
+                    if found is not None:
+                        found('orphan', path, crashid, size)
+            if progress is not None:
+                progress(ret)
@@ -0,0 +1,282 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+"""Compact encoding of the stacks of all threads of a crash.
+
+The stacks are stored as one blob per crash: a table of all module,
+function, source file and thread name strings, a directory of the threads
+and the frames of every thread as varints referring to the string table.
+The blob is zlib compressed and base64 encoded, so it fits into a text
+column of every database backend. Only the directory is decoded up front,
+the frames of a thread are decoded when they are accessed.
+"""
+
+import base64
+import zlib
+
+# version of the blob format, stored as first varint
+FORMAT_VERSION = 1
+
+# integer and string fields of the frames, in the order they are encoded
+_frame_int_fields = ('addr', 'retaddr', 'trust_level', 'funcoff', 'line', 'lineoff')
+_frame_string_fields = ('module', 'function', 'source')
+
+# bits of the thread flags
+_FLAG_EXCEPTION = 1
+_FLAG_MAIN_THREAD = 2
+_FLAG_RPC_THREAD = 4
+
+class StackCodecError(Exception):
+    """Raised for blobs which cannot be decoded."""
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varint(data, pos):
+    ret = 0
+    shift = 0
+    while True:
+        try:
+            b = data[pos]
+        except IndexError:
+            raise StackCodecError('Truncated stack data')
+        pos += 1
+        ret |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return ret, pos
+        shift += 7
+
+def _write_optional_int(out, value):
+    # 0 for None, all other values zigzag encoded and shifted by one
+    if value is None:
+        _write_varint(out, 0)
+    else:
+        value = int(value)
+        _write_varint(out, ((value << 1) if value >= 0 else ((-value << 1) - 1)) + 1)
+
+def _read_optional_int(data, pos):
+    value, pos = _read_varint(data, pos)
+    if value == 0:
+        return None, pos
+    value -= 1
+    return ((value >> 1) if not value & 1 else -((value + 1) >> 1)), pos
+
+def encode_stacks(stackdumps):
+    """Return the encoded blob of the stacks of `stackdumps`.
+
+    `stackdumps` is an iterable of stack dumps like the non-simplified
+    `XMLReport.stackdumps`, each with the `threadid`, the `exception` flag,
+    the `thread` and the `callstack` list of frames.
+    """
+    strings = {}
+    string_list = []
+
+    def intern(value):
+        if value is None:
+            return 0
+        if not isinstance(value, unicode):
+            value = str(value).decode('utf-8', 'replace')
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(string_list)
+            string_list.append(value)
+        return index + 1
+
+    threads = []
+    for dump in stackdumps:
+        thread = getattr(dump, 'thread', None)
+        flags = 0
+        if dump.exception:
+            flags |= _FLAG_EXCEPTION
+        if thread is not None and getattr(thread, 'main_thread', None):
+            flags |= _FLAG_MAIN_THREAD
+        if thread is not None and getattr(thread, 'rpc_thread', None):
+            flags |= _FLAG_RPC_THREAD
+        name = intern(thread.name) if thread is not None else 0
+        frames = bytearray()
+        callstack = dump.callstack or []
+        for frame in callstack:
+            for field in _frame_int_fields:
+                _write_optional_int(frames, getattr(frame, field, None))
+            for field in _frame_string_fields:
+                _write_varint(frames, intern(getattr(frame, field, None)))
+        threads.append((dump.threadid or 0, flags, name, len(callstack), frames))
+
+    out = bytearray()
+    _write_varint(out, FORMAT_VERSION)
+    _write_varint(out, len(string_list))
+    for value in string_list:
+        value = value.encode('utf-8')
+        _write_varint(out, len(value))
+        out.extend(value)
+    _write_varint(out, len(threads))
+    for threadid, flags, name, num_frames, frames in threads:
+        _write_varint(out, threadid)
+        _write_varint(out, flags)
+        _write_varint(out, name)
+        _write_varint(out, num_frames)
+        _write_varint(out, len(frames))
+    for threadid, flags, name, num_frames, frames in threads:
+        out.extend(frames)
+    return base64.b64encode(zlib.compress(str(out), 9))
+
+class StoredThread(object):
+    """The thread information kept with the stack of a thread."""
+
+    def __init__(self, stacks, id, name, flags):
+        self._stacks = stacks
+        self._name = name
+        self.id = id
+        self.exception = bool(flags & _FLAG_EXCEPTION)
+        self.main_thread = bool(flags & _FLAG_MAIN_THREAD)
+        self.rpc_thread = bool(flags & _FLAG_RPC_THREAD)
+
+    @property
+    def name(self):
+        return self._stacks._get_string(self._name)
+
+class StoredStackFrame(object):
+    """A frame decoded from the blob, with the attributes used by the stack
+    dump templates."""
+
+    params = []
+    module_base = None
+
+    def __init__(self, num, values):
+        self.num = num
+        for field, value in zip(_frame_int_fields + _frame_string_fields, values):
+            setattr(self, field, value)
+
+    @property
+    def source_url(self):
+        if self.source:
+            return 'file:///' + self.source
+        else:
+            return None
+
+class StoredStackDump(object):
+    """The stack of a thread, decoded on first access of the `callstack`."""
+
+    simplified = False
+
+    def __init__(self, stacks, threadid, flags, name, num_frames, offset):
+        self._stacks = stacks
+        self.threadid = threadid
+        self.exception = bool(flags & _FLAG_EXCEPTION)
+        self.thread = StoredThread(stacks, threadid, name, flags)
+        self.num_frames = num_frames
+        self._offset = offset
+        self._callstack = None
+
+    @property
+    def callstack(self):
+        if self._callstack is None:
+            self._callstack = self._stacks._decode_frames(self._offset, self.num_frames)
+        return self._callstack
+
+    @property
+    def top(self):
+        callstack = self.callstack
+        return callstack[0] if callstack else None
+
+    @property
+    def involved_modules(self):
+        ret = []
+        for frame in self.callstack:
+            if frame.module and frame.module not in ret:
+                ret.append(frame.module)
+        return ret
+
+class ThreadStacks(object):
+    """The stacks of all threads of a crash, decoded from the blob.
+
+    Can be used like the `XMLReport.stackdumps` list: iterating gives the
+    stack dumps and the stack of a thread is looked up by its id.
+    """
+
+    def __init__(self, blob):
+        try:
+            self._data = bytearray(zlib.decompress(base64.b64decode(blob)))
+        except (TypeError, zlib.error) as e:
+            raise StackCodecError('Invalid stack data: %s' % e)
+        version, pos = _read_varint(self._data, 0)
+        if version != FORMAT_VERSION:
+            raise StackCodecError('Unsupported stack data version %i' % version)
+        self._num_strings, pos = _read_varint(self._data, pos)
+        self._strings_pos = pos
+        self._strings = None
+        # skip the string table, it is only decoded along with the frames
+        for i in range(self._num_strings):
+            length, pos = _read_varint(self._data, pos)
+            pos += length
+        num_threads, pos = _read_varint(self._data, pos)
+        directory = []
+        for i in range(num_threads):
+            entry = []
+            for j in range(5):
+                value, pos = _read_varint(self._data, pos)
+                entry.append(value)
+            directory.append(entry)
+        self._dumps = []
+        for threadid, flags, name, num_frames, size in directory:
+            self._dumps.append(StoredStackDump(self, threadid, flags, name, num_frames, pos))
+            pos += size
+        if pos != len(self._data):
+            raise StackCodecError('Truncated stack data')
+
+    def _get_string(self, index):
+        """Return the string `index` of the string table, 0 is None."""
+        if not index:
+            return None
+        if self._strings is None:
+            strings = []
+            pos = self._strings_pos
+            for i in range(self._num_strings):
+                length, pos = _read_varint(self._data, pos)
+                strings.append(str(self._data[pos:pos + length]).decode('utf-8'))
+                pos += length
+            self._strings = strings
+        try:
+            return self._strings[index - 1]
+        except IndexError:
+            raise StackCodecError('Invalid string index %i' % index)
+
+    def _decode_frames(self, pos, num_frames):
+        ret = []
+        for num in range(num_frames):
+            values = []
+            for field in _frame_int_fields:
+                value, pos = _read_optional_int(self._data, pos)
+                values.append(value)
+            for field in _frame_string_fields:
+                index, pos = _read_varint(self._data, pos)
+                values.append(self._get_string(index))
+            ret.append(StoredStackFrame(num, values))
+        return ret
+
+    def __len__(self):
+        return len(self._dumps)
+
+    def __iter__(self):
+        return iter(self._dumps)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __getitem__(self, key):
+        ret = self._find(key)
+        if ret is None:
+            raise KeyError(key)
+        return ret
+
+    def _find(self, key):
+        for dump in self._dumps:
+            if key == 'exception' and dump.exception:
+                return dump
+            elif isinstance(key, (int, long)) and dump.threadid == key:
+                return dump
+        return None
@@ -0,0 +1,553 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import os
+import gzip
+import hashlib
+import errno
+import shutil
+import stat
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# supported compression methods and the suffix added to the compressed files,
+# in the order in which they are looked up.
+compression_suffixes = [
+    ('zstd', '.zst'),
+    ('gzip', '.gz'),
+    ]
+
+# HTTP content coding names of the compression methods
+content_encodings = {
+    'zstd': 'zstd',
+    'gzip': 'gzip',
+    }
+
+# layouts of the crash directories below the dump data directory: `flat`
+# puts every crash in <uuid>/, `sharded` in ab/cd/<uuid>/ from the first
+# characters of the uuid.
+storage_layouts = ['flat', 'sharded']
+
+_copy_bufsize = 1024 * 1024
+
+_decompress_errors = (zlib.error,) if zstandard is None else (zlib.error, zstandard.ZstdError)
+
+def available_compression_methods():
+    ret = []
+    if zstandard is not None:
+        ret.append('zstd')
+    ret.append('gzip')
+    return ret
+
+def resolve_compression_method(method):
+    """Return the compression method to use for the given configured method.
+
+    Returns None if compression is disabled. zstd falls back to gzip if the
+    zstandard module is not available.
+    """
+    if not method or method == 'none':
+        return None
+    if method == 'auto' or method == 'zstd':
+        return 'zstd' if zstandard is not None else 'gzip'
+    if method == 'gzip':
+        return 'gzip'
+    raise ValueError('Unknown compression method %s' % method)
+
+def compression_suffix(method):
+    for m, suffix in compression_suffixes:
+        if m == method:
+            return suffix
+    return ''
+
+def find_dump_file(filename):
+    """Return the actual file and its compression method for a dump file.
+
+    `filename` is the name of the uncompressed file as stored in the
+    database. Returns (None, None) if neither the file nor a compressed
+    variant of it exists.
+    """
+    if not filename:
+        return (None, None)
+    if os.path.isfile(filename):
+        return (filename, None)
+    for method, suffix in compression_suffixes:
+        if os.path.isfile(filename + suffix):
+            if method == 'zstd' and zstandard is None:
+                continue
+            return (filename + suffix, method)
+    return (None, None)
+
+def crash_dir_name(uuid, layout='flat'):
+    """Return the directory of a crash relative to the dump data directory."""
+    uuid = str(uuid)
+    if layout == 'sharded':
+        return os.path.join(uuid[0:2], uuid[2:4], uuid)
+    return uuid
+
+def crash_dir_names(uuid):
+    """Return the directories of a crash in all layouts."""
+    return [crash_dir_name(uuid, layout) for layout in storage_layouts]
+
+def split_item_name(item_name):
+    """Split the name of a dump file relative to the dump data directory
+    into the uuid of the crash and the name of the file in the crash
+    directory. Returns (None, None) if the name matches no layout."""
+    parts = os.path.normpath(item_name).split(os.sep)
+    if len(parts) >= 2 and len(parts[0]) > 4:
+        uuid, rest = parts[0], parts[1:]
+    elif len(parts) >= 4 and parts[2][0:2] == parts[0] and parts[2][2:4] == parts[1]:
+        uuid, rest = parts[2], parts[3:]
+    else:
+        return (None, None)
+    return (uuid, os.path.join(*rest))
+
+def alternative_item_names(item_name):
+    """Return the names of a dump file in the other layouts."""
+    uuid, filename = split_item_name(item_name)
+    if uuid is None:
+        return []
+    item_name = os.path.normpath(item_name)
+    return [name for name in (os.path.join(dirname, filename) for dirname in crash_dir_names(uuid))
+            if name != item_name]
+
+def dump_file_exists(filename):
+    return find_dump_file(filename)[0] is not None
+
+def stored_dump_files(filename):
+    """Return the existing files of a dump file: the file itself and all
+    compressed variants of it."""
+    return [path for path in [filename] + [filename + suffix for (method, suffix) in compression_suffixes]
+            if os.path.isfile(path)]
+
+def strip_compression_suffix(filename):
+    """Return the name of the uncompressed dump file of a stored file."""
+    for method, suffix in compression_suffixes:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+def scan_directory(path):
+    """Return the entries of the directory `path` as list of (name, is
+    directory, size, modification time) tuples.
+
+    Uses scandir() where available, which saves a stat() call per entry
+    on most platforms.
+    """
+    ret = []
+    if scandir is not None:
+        for entry in scandir(path):
+            st = entry.stat(follow_symlinks=False)
+            ret.append((entry.name, entry.is_dir(follow_symlinks=False), st.st_size, st.st_mtime))
+    else:
+        for name in os.listdir(path):
+            st = os.lstat(os.path.join(path, name))
+            ret.append((name, stat.S_ISDIR(st.st_mode), st.st_size, st.st_mtime))
+    return ret
+
+def directory_size(path):
+    """Return the total size of all files below the directory `path`."""
+    ret = 0
+    for name, is_dir, size, mtime in scan_directory(path):
+        ret += directory_size(os.path.join(path, name)) if is_dir else size
+    return ret
+
+def remove_dump_file(filename, keep=None):
+    """Remove the dump file and all compressed variants of it except `keep`."""
+    ret = True
+    for path in stored_dump_files(filename):
+        if path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                ret = False
+    return ret
+
+_path_locks = {}
+_path_locks_guard = threading.Lock()
+
+@contextmanager
+def _thread_lock(path, blocking=True):
+    """Hold the lock of `path` within this process. Yields whether the
+    lock has been acquired, which is always the case if `blocking`."""
+    with _path_locks_guard:
+        entry = _path_locks.get(path)
+        if entry is None:
+            entry = _path_locks[path] = [threading.Lock(), 0]
+        entry[1] += 1
+    acquired = entry[0].acquire(blocking)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            entry[0].release()
+        with _path_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _path_locks[path]
+
+@contextmanager
+def lock_directory(path):
+    """Hold an exclusive lock on the directory `path`, creating it if needed.
+
+    The lock is taken with flock() on the directory itself, which serializes
+    all processes on this host. Threads of this process are serialized as
+    well on platforms without flock().
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    with _thread_lock(os.path.abspath(path)):
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # closing the descriptor releases the lock
+            os.close(fd)
+
+def _crash_lock_dir(dumpdata_dir):
+    return os.path.join(dumpdata_dir, '.incoming', 'locks')
+
+def _open_locked(path, flags):
+    """Open and flock() the lock file `path`. Returns the descriptor, or
+    None if the lock is not free and LOCK_NB is in `flags`."""
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | flags)
+        except IOError as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        # the file may have been removed by remove_crash_locks while
+        # waiting for the lock, the lock is only valid on the current file
+        try:
+            current = os.stat(path).st_ino
+        except OSError:
+            current = None
+        if current == os.fstat(fd).st_ino:
+            return fd
+        os.close(fd)
+
+@contextmanager
+def lock_crash(dumpdata_dir, uuid):
+    """Hold an exclusive lock on the files of the crash `uuid`.
+
+    The lock is a file in the staging directory below `dumpdata_dir`, so no
+    crash directory is created for a crash which is never stored. Like
+    lock_directory it serializes all processes on this host and the
+    threads of this process.
+    """
+    lock_dir = _crash_lock_dir(dumpdata_dir)
+    try:
+        os.makedirs(lock_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    path = os.path.join(lock_dir, str(uuid).lower())
+    with _thread_lock(os.path.abspath(path)):
+        if fcntl is None:
+            yield
+            return
+        fd = _open_locked(path, 0)
+        try:
+            yield
+        finally:
+            # closing the descriptor releases the lock
+            os.close(fd)
+
+def crash_lock_names(dumpdata_dir):
+    """Return the names of the lock files of `lock_crash`."""
+    try:
+        return os.listdir(_crash_lock_dir(dumpdata_dir))
+    except OSError:
+        return []
+
+def remove_crash_locks(dumpdata_dir):
+    """Remove the lock files of `lock_crash` which are not in use. Returns
+    the number of removed files."""
+    lock_dir = _crash_lock_dir(dumpdata_dir)
+    ret = 0
+    for name in crash_lock_names(dumpdata_dir):
+        path = os.path.join(lock_dir, name)
+        with _thread_lock(os.path.abspath(path), blocking=False) as acquired:
+            if not acquired:
+                continue
+            if fcntl is None:
+                fd = None
+            else:
+                fd = _open_locked(path, fcntl.LOCK_NB)
+                if fd is None:
+                    continue
+            try:
+                os.remove(path)
+                ret += 1
+            except OSError:
+                pass
+            finally:
+                if fd is not None:
+                    os.close(fd)
+    return ret
+
+def get_dump_file_size(filename):
+    """Return the size of the stored (possibly compressed) dump file."""
+    path, method = find_dump_file(filename)
+    if path is None:
+        raise OSError(2, 'No such file or directory', filename)
+    return os.path.getsize(path)
+
+def open_compressed_file(path, method):
+    """Open the compressed file `path` with a streaming decompressor."""
+    if method is None:
+        return open(path, 'rb')
+    elif method == 'gzip':
+        return gzip.open(path, 'rb')
+    elif method == 'zstd':
+        fileobj = open(path, 'rb')
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=True)
+    raise ValueError('Unknown compression method %s' % method)
+
+def open_dump_file(filename, seekable=False):
+    """Open a dump file for reading, decompressing it on the fly.
+
+    If `seekable` is set, compressed data is decompressed into a temporary
+    file first, since the streaming decompressors only support reading
+    sequentially.
+    """
+    path, method = find_dump_file(filename)
+    if path is None:
+        raise IOError(2, 'No such file or directory', filename)
+    fileobj = open_compressed_file(path, method)
+    if method is None or not seekable:
+        return fileobj
+    tmp = tempfile.TemporaryFile(prefix='crashdump-')
+    try:
+        shutil.copyfileobj(fileobj, tmp, _copy_bufsize)
+    finally:
+        fileobj.close()
+    tmp.seek(0)
+    return tmp
+
+def iter_dump_file(filename, chunk_size=65536):
+    """Yield the uncompressed content of a dump file in chunks."""
+    fileobj = open_dump_file(filename)
+    try:
+        while True:
+            data = fileobj.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        fileobj.close()
+
+def hash_dump_file(filename, algorithm='sha256'):
+    """Return the hex digest of the uncompressed content of a dump file."""
+    h = hashlib.new(algorithm)
+    for data in iter_dump_file(filename, chunk_size=_copy_bufsize):
+        h.update(data)
+    return h.hexdigest()
+
+def dump_file_info(filename, algorithm='sha256'):
+    """Return the size and the hex digest of the uncompressed content of a
+    dump file as tuple, or None if the file does not exist."""
+    if find_dump_file(filename)[0] is None:
+        return None
+    h = hashlib.new(algorithm)
+    size = 0
+    for data in iter_dump_file(filename, chunk_size=_copy_bufsize):
+        h.update(data)
+        size += len(data)
+    return (size, h.hexdigest())
+
+def compress_dump_file(filename, method, level=None):
+    """Compress the given file in place.
+
+    The compressed data is written to a temporary file next to the original
+    which is then renamed to `filename` + suffix. The uncompressed file is
+    removed afterwards. Returns the name of the compressed file.
+    """
+    method = resolve_compression_method(method)
+    if method is None:
+        return filename
+    target = filename + compression_suffix(method)
+    dirname = os.path.dirname(filename)
+    fd, tmpname = tempfile.mkstemp(prefix='.compress-', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as out, open(filename, 'rb') as src:
+            if method == 'gzip':
+                gz = gzip.GzipFile(filename=os.path.basename(filename), mode='wb',
+                                   compresslevel=level if level is not None else 6,
+                                   fileobj=out)
+                try:
+                    shutil.copyfileobj(src, gz, _copy_bufsize)
+                finally:
+                    gz.close()
+            else:
+                cctx = zstandard.ZstdCompressor(level=level if level is not None else 3)
+                cctx.copy_stream(src, out, read_size=_copy_bufsize, write_size=_copy_bufsize)
+        os.chmod(tmpname, os.stat(filename).st_mode & 0777)
+        os.rename(tmpname, target)
+    except:
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        raise
+    os.remove(filename)
+    return target
+
+def content_encoding_method(coding):
+    """Return the compression method for a HTTP content coding.
+
+    Returns None if the coding is not supported.
+    """
+    coding = (coding or '').strip().lower()
+    for method in available_compression_methods():
+        if content_encodings[method] == coding:
+            return method
+    return None
+
+class _BoundedInput(object):
+    """File-like object reading at most `length` bytes from `fileobj`."""
+    def __init__(self, fileobj, length=None):
+        self._fileobj = fileobj
+        self._remaining = length
+
+    def read(self, size=-1):
+        if self._remaining is not None:
+            size = self._remaining if size < 0 else min(size, self._remaining)
+            if size <= 0:
+                return b''
+        data = self._fileobj.read(size)
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        return data
+
+class DecompressingReader(object):
+    """File-like object decompressing the data read from `fileobj` on the fly.
+
+    At most `length` bytes are read from `fileobj` if given. An IOError with
+    errno EFBIG is raised once more than `max_size` bytes have been
+    decompressed, unless `max_size` is zero. The data is decompressed in
+    bounded steps, so the limit holds before the data is kept in memory.
+    """
+    def __init__(self, fileobj, method, length=None, max_size=0):
+        self._input = _BoundedInput(fileobj, length)
+        self._max_size = max_size
+        self._size = 0
+        self._buffer = b''
+        self._eof = False
+        # compressed data not yet decompressed by zlib
+        self._pending = b''
+        if method == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._reader = None
+        elif method == 'zstd':
+            self._decompressor = None
+            self._reader = zstandard.ZstdDecompressor().stream_reader(self._input, read_size=_copy_bufsize)
+        else:
+            raise ValueError('Unknown compression method %s' % method)
+
+    def _decompress(self, max_length):
+        """Return at most `max_length` bytes of decompressed data, an empty
+        string at the end of the data."""
+        if self._reader is not None:
+            return self._reader.read(max_length)
+        while True:
+            if not self._pending:
+                self._pending = self._input.read(_copy_bufsize)
+                if not self._pending:
+                    return self._decompressor.flush()
+            data = self._decompressor.decompress(self._pending, max_length)
+            self._pending = self._decompressor.unconsumed_tail
+            if data:
+                return data
+
+    def _fill(self, size):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            max_length = _copy_bufsize
+            if self._max_size > 0:
+                max_length = min(max_length, self._max_size - self._size + 1)
+            try:
+                data = self._decompress(max_length)
+            except _decompress_errors as e:
+                raise IOError(errno.EINVAL, 'Invalid compressed data: %s' % e)
+            if not data:
+                self._eof = True
+                break
+            self._size += len(data)
+            if self._max_size > 0 and self._size > self._max_size:
+                raise IOError(errno.EFBIG, 'Decompressed data exceeds %i bytes' % self._max_size)
+            self._buffer += data
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        start = 0
+        while True:
+            pos = self._buffer.find(b'\n', start)
+            if pos >= 0 and (size < 0 or pos < size):
+                end = pos + 1
+                break
+            if size >= 0 and len(self._buffer) >= size:
+                end = size
+                break
+            if self._eof:
+                end = len(self._buffer)
+                break
+            start = len(self._buffer)
+            self._fill(len(self._buffer) + 1)
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+def accepts_encoding(accept_encoding, method):
+    """Check if the Accept-Encoding header value allows the given method."""
+    if not accept_encoding or method is None:
+        return False
+    coding = content_encodings.get(method)
+    for item in accept_encoding.split(','):
+        params = item.strip().split(';')
+        if params[0].strip().lower() != coding:
+            continue
+        for p in params[1:]:
+            p = p.strip()
+            if p.startswith('q='):
+                try:
+                    return float(p[2:]) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
@@ -4,9 +4,10 @@
 
 from trac.core import *
 from trac.util.html import html
-from trac.util.datefmt import utc, to_utimestamp, parse_date
+from trac.util.datefmt import utc, from_utimestamp, parse_date, http_date
 from trac.web import IRequestHandler, IRequestFilter
-from trac.web.api import arg_list_to_args, RequestDone, HTTPNotFound, HTTPMethodNotAllowed, HTTPForbidden
+from trac.web.api import arg_list_to_args, RequestDone, HTTPNotFound, HTTPMethodNotAllowed, HTTPForbidden, \
+    HTTPBadRequest, HTTPConflict, HTTPRequestEntityTooLarge, HTTPServiceUnavailable, HTTPUnsupportedMediaType
 
 try:
     from trac.web.api import HTTPInternalError as HTTPInternalServerError
@@ -15,10 +16,11 @@ except ImportError:  # Trac 1.3.1+
 
 from trac.web.chrome import ITemplateProvider, INavigationContributor,add_script, add_stylesheet
 
-from trac.config import Option, IntOption, BoolOption, PathOption
+from trac.config import Option, IntOption, FloatOption, BoolOption, PathOption, ChoiceOption
 from trac.resource import ResourceNotFound
 from trac.ticket.model import Ticket, Component as TicketComponent, Milestone, Version
 from trac.util import get_pkginfo
+from trac.util.text import exception_to_unicode
 from trac.util.html import html as tag
 
 from pkg_resources import resource_filename, get_distribution
@@ -27,15 +29,170 @@ import os
 import shutil
 import re
 import time
-import datetime
+from datetime import datetime
 import cgi
-from xml.sax.saxutils import escape
-
-from .model import CrashDump, CrashDumpStackFrame
+import io
+import json
+import math
+import errno
+import tempfile
+import threading
+from collections import OrderedDict
+from xml.sax.saxutils import XMLGenerator
+
+from .api import CrashDumpSystem
+from .model import CrashDump, CrashDumpStackFrame, report_summary, report_modules, report_stacks, \
+    file_size_summary
 from .links import CrashDumpTicketLinks
 from .xmlreport import XMLReport
+from .admission import AdmissionController, AdmissionRejected
+from .retention import CrashDumpRetention
+from .fulltext import CrashDumpFullTextIndex
+from .storage import compress_dump_file, remove_dump_file, lock_directory, dump_file_exists, hash_dump_file, \
+    available_compression_methods, compression_suffix, content_encodings, content_encoding_method, \
+    DecompressingReader, storage_layouts, crash_dir_name, lock_crash, remove_crash_locks
 from .utils import *
 
+class UploadSizeExceeded(IOError):
+    """Raised while streaming an upload once the size limit is reached."""
+    def __init__(self, size, limit):
+        super(UploadSizeExceeded, self).__init__('Upload size %i bytes exceed the upload limit of %i bytes' % (size, limit))
+        self.size = size
+        self.limit = limit
+
+class UnsupportedContentEncoding(ValueError):
+    """Raised if the request body uses a content coding which is not supported."""
+    def __init__(self, coding):
+        super(UnsupportedContentEncoding, self).__init__('Content-Encoding %s not supported' % coding)
+        self.coding = coding
+
+class _StagedFile(object):
+    """File object for an upload which is already stored in the staging directory.
+
+    The file is located on the same file system as the final crash dump
+    files, so it can later be renamed into place instead of being copied.
+    """
+    def __init__(self, fileobj, path):
+        self._fileobj = fileobj
+        self.upload_path = path
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+class _StagedUploadFile(_StagedFile):
+    """File object used for uploaded form parts."""
+    def __init__(self, context, fileobj, path):
+        super(_StagedUploadFile, self).__init__(fileobj, path)
+        self._context = context
+
+    def write(self, data):
+        self._context.account(len(data))
+        self._fileobj.write(data)
+
+class _SessionUploadField(object):
+    """Uploaded file of a chunked upload session, used like a cgi.FieldStorage."""
+    def __init__(self, filename, path):
+        self.filename = filename
+        self.file = _StagedFile(open(path, 'rb'), path)
+
+class _BatchItemRequest(object):
+    """Request used to process a single crash of a batch submit.
+
+    The request arguments are taken from the batch manifest and the response
+    is recorded instead of being sent to the client. Deferred ticket updates
+    are collected in `deferred_updates` and the changes of the tickets
+    updated right away in `ticket_changes` until the batch group is
+    committed.
+    """
+    def __init__(self, req, args, deferred_updates, ticket_changes=None):
+        self._req = req
+        self.args = args
+        self.deferred_updates = deferred_updates
+        self.ticket_changes = ticket_changes if ticket_changes is not None else []
+        self.status = None
+        self.headers = {}
+        self.body = ''
+
+    def __getattr__(self, name):
+        return getattr(self._req, name)
+
+    def send_response(self, code=200):
+        self.status = code
+
+    def send_header(self, name, value):
+        self.headers[name] = value
+
+    def end_headers(self):
+        pass
+
+    def _send_cookie_headers(self):
+        pass
+
+    def write(self, data):
+        self.body += data
+
+    def redirect(self, url, permanent=False):
+        self.status = 301 if permanent else 303
+        self.headers['Location'] = url
+        raise RequestDone
+
+class _UploadContext(object):
+    """Keeps track of all staged files and the total size of a single upload request."""
+    def __init__(self, staging_dir, max_size=0):
+        self.staging_dir = staging_dir
+        self.max_size = max_size
+        self.size = 0
+        self.files = []
+
+    def account(self, nbytes):
+        self.size += nbytes
+        if self.max_size > 0 and self.size > self.max_size:
+            raise UploadSizeExceeded(self.size, self.max_size)
+
+    def make_file(self):
+        if not os.path.isdir(self.staging_dir):
+            try:
+                os.makedirs(self.staging_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd, path = tempfile.mkstemp(prefix='upload-', dir=self.staging_dir)
+        self.files.append(path)
+        return _StagedUploadFile(self, os.fdopen(fd, 'w+b'), path)
+
+    def cleanup(self):
+        for path in self.files:
+            try:
+                os.remove(path)
+            except OSError:
+                # already moved into the crash directory
+                pass
+        self.files = []
+
+class _UploadFieldStorage(cgi.FieldStorage):
+    """FieldStorage which streams all file parts into the staging directory."""
+    upload_context = None
+
+    def make_file(self, binary=None):
+        return self.upload_context.make_file()
+
+    def read_multi(self, *args, **kwargs):
+        try:
+            cgi.FieldStorage.read_multi(self, *args, **kwargs)
+        except ValueError:
+            # same as trac.web.api._FieldStorage
+            self.read_single()
+
+    @classmethod
+    def bind(cls, context):
+        """Return a FieldStorage class using the given upload context.
+
+        The class is used for all parts of the multipart request body.
+        """
+        class _BoundUploadFieldStorage(cls):
+            upload_context = context
+        return _BoundUploadFieldStorage
+
 class CrashDumpSubmit(Component):
     """Upload/Submit new crash dumps"""
 
@@ -89,9 +246,86 @@ class CrashDumpSubmit(Component):
     upload_disabled = BoolOption('crashdump', 'upload_disabled', 'false',
                       doc="""Disable upload. No further crashdumps can be submitted.""")
 
+    compression = ChoiceOption('crashdump', 'compression', ['none', 'auto', 'gzip', 'zstd'],
+                      doc="""Compression applied to uploaded crash dump files and reports when they are stored.
+                      `auto` uses zstd if the zstandard module is available and falls back to gzip otherwise.""")
+
+    storage_layout = ChoiceOption('crashdump', 'storage_layout', storage_layouts,
+                      doc="""Directory layout of the uploaded crashes in the dump data directory. `flat` stores every
+                      crash in `<uuid>/`, `sharded` in `ab/cd/<uuid>/` named after the first characters of the uuid, which
+                      keeps the directories small. Files are found in both layouts; use `trac-admin crashdump
+                      migrate-layout` to move the existing crashes after changing the layout.""")
+
+    max_chunk_size = IntOption('crashdump', 'max_chunk_size', default=8 * 1024 * 1024,
+                      doc="""Maximum size of a single chunk of a chunked upload. If set to zero any chunk size is accepted.""")
+
+    upload_session_hours = IntOption('crashdump', 'upload_session_hours', default=24,
+                      doc="""Number of hours after its last chunk an unfinished chunked upload session is removed by the `expire-uploads` maintenance job. If set to zero the sessions are kept until they are committed or discarded.""")
+
+    max_crashlist_page_size = IntOption('crashdump', 'max_crashlist_page_size', default=10000,
+                      doc="""Maximum number of crashes returned by a single crashlist request which asks for pages with `limit` or `cursor`. The list contains a cursor to request the next page. Requests without these parameters and all requests if set to zero get all crashes at once.""")
+
+    max_batch_size = IntOption('crashdump', 'max_batch_size', default=1000,
+                      doc="""Maximum number of crashes accepted in a single batch submit. If set to zero the batch submit is disabled.""")
+
+    max_batch_upload_size = IntOption('crashdump', 'max_batch_upload_size', default=256 * 1024 * 1024,
+                      doc="""Maximum total size in bytes of a batch submit. The size of each crash is still limited by max_upload_size. If set to zero no limit is applied.""")
+
+    batch_transaction_size = IntOption('crashdump', 'batch_transaction_size', default=100,
+                      doc="""Number of crashes of a batch submit which are stored in a single database transaction.""")
+
+    max_concurrent_uploads = IntOption('crashdump', 'max_concurrent_uploads', default=16,
+                      doc="""Maximum number of uploads processed at the same time by a server process. Further uploads are rejected with 503 and a Retry-After header. If set to zero no limit is applied.""")
+
+    max_inflight_upload_size = IntOption('crashdump', 'max_inflight_upload_size', default=512 * 1024 * 1024,
+                      doc="""Maximum number of bytes being uploaded at the same time to a server process. If set to zero no limit is applied.""")
+
+    client_upload_rate = FloatOption('crashdump', 'client_upload_rate', default=0,
+                      doc="""Number of uploads per second accepted for a single upload host and a single crashing host. If set to zero no limit is applied.""")
+
+    product_upload_rate = FloatOption('crashdump', 'product_upload_rate', default=0,
+                      doc="""Number of uploads per second accepted for a single product. If set to zero no limit is applied.""")
+
+    upload_rate_burst = IntOption('crashdump', 'upload_rate_burst', default=20,
+                      doc="""Number of uploads a host or product can send at once before the upload rates apply.""")
+
+    busy_retry_after = IntOption('crashdump', 'busy_retry_after', default=10,
+                      doc="""Number of seconds clients are asked to wait before retrying when the server is busy.""")
+
+    defer_ticket_updates = BoolOption('crashdump', 'defer_ticket_updates', 'false',
+                      doc="""Update the tickets linked to an uploaded crash in a background thread after the upload has been answered.
+                      The tickets are linked with direct database writes, all tickets of a crash in one transaction, instead
+                      of saving every ticket on its own. The ticket change listeners and notifications are only called for
+                      the changed tickets after the commit; the time they take, e.g. for sending mails, is not saved by the
+                      direct writes and is only moved out of the upload request by this option.""")
+
     disable_manual_upload = BoolOption('crashdump', 'manual_upload_disabled', 'false',
                       doc="""Disable manual upload function. Crashes can only be uploaded automatically via the crash handler.""")
 
+    upload_file_fields = ['minidump', 'minidumpreport', 'minidumpreportxml', 'minidumpreporthtml',
+                          'coredump', 'coredumpreport', 'coredumpreportxml', 'coredumpreporthtml']
+
+    # crashdump columns holding the files of the upload fields
+    upload_file_columns = {
+        'minidump': 'minidumpfile',
+        'minidumpreport': 'minidumpreporttextfile',
+        'minidumpreportxml': 'minidumpreportxmlfile',
+        'minidumpreporthtml': 'minidumpreporthtmlfile',
+        'coredump': 'coredumpfile',
+        'coredumpreport': 'coredumpreporttextfile',
+        'coredumpreportxml': 'coredumpreportxmlfile',
+        'coredumpreporthtml': 'coredumpreporthtmlfile',
+        }
+
+    # fields of the manual upload form, which are no crash fields and must
+    # not appear in a batch manifest
+    _batch_rejected_fields = ('manual_upload', 'files', '__FORM_TOKEN')
+
+    _upload_session_re = re.compile(r'^(?:/crashdump)?/submit/upload/([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})(?:/([a-z]+))?$')
+
+    def __init__(self):
+        self._admission = AdmissionController()
+
     # INavigationContributor methods
     def get_active_navigation_item(self, req):
         self.log.debug('get_active_navigation_item %s' % req.path_info)
@@ -124,6 +358,13 @@ class CrashDumpSubmit(Component):
             return True
         elif (req.method == 'GET' or req.method == 'POST') and (req.path_info == '/crashdump/crash_upload' or req.path_info == '/crash_upload'):
             return True
+        elif req.method == 'POST' and (req.path_info == '/crashdump/submit/batch' or req.path_info == '/submit/batch'):
+            return True
+        elif req.method == 'POST' and (req.path_info == '/crashdump/submit/check' or req.path_info == '/submit/check'):
+            return True
+        elif req.method in ('GET', 'PUT', 'POST', 'DELETE') and self._upload_session_re.match(req.path_info):
+            self.log.debug('match_request: %s %s', req.method, req.path_info)
+            return True
         else:
             self.log.debug('match_request: %s %s', req.method, req.path_info)
             return False
@@ -320,42 +561,206 @@ class CrashDumpSubmit(Component):
         self.log.debug('CrashDumpSubmit _apply_username_replacements out=\'%s\'' % ret)
         return ret
 
+    def _get_staging_dir(self):
+        return os.path.join(self.env.path, self.dumpdata_dir, '.incoming')
+
+    def _parse_upload_arg_list(self, req):
+        """Replacement for `Request._parse_arg_list` used for crash uploads.
+
+        In contrast to the default implementation all uploaded files are
+        streamed directly into the staging directory and the upload limit
+        is enforced while the request body is read.
+        """
+        if self._is_batch_path(req.path_info):
+            max_size = self.max_batch_upload_size
+        else:
+            max_size = self.max_upload_size
+        context = _UploadContext(self._get_staging_dir(), max_size)
+        req.environ['crashdump.upload_context'] = context
+        storage_class = _UploadFieldStorage.bind(context)
+
+        environ = req.environ
+        fp = environ['wsgi.input']
+        ctype = req.get_header('Content-Type')
+        if ctype:
+            ctype, options = cgi.parse_header(ctype)
+        if ctype not in ('application/x-www-form-urlencoded', 'multipart/form-data'):
+            fp = io.BytesIO()
+        elif req.get_header('Content-Encoding'):
+            # decompress the request body while parsing it; the length of
+            # the decompressed body is unknown
+            coding = req.get_header('Content-Encoding')
+            method = content_encoding_method(coding)
+            if method is None:
+                raise UnsupportedContentEncoding(coding)
+            try:
+                length = int(req.get_header('Content-Length'))
+            except (TypeError, ValueError):
+                length = None
+            fp = DecompressingReader(fp, method, length=length,
+                                     max_size=max_size + 1024 * 1024 if max_size > 0 else 0)
+            environ = dict(environ)
+            environ.pop('CONTENT_LENGTH', None)
+
+        qs_on_post = environ.pop('QUERY_STRING', '')
+        try:
+            fs = storage_class(fp, environ=environ, keep_blank_values=True)
+        except IOError as e:
+            if e.errno == errno.EFBIG:
+                raise UploadSizeExceeded(context.size, max_size)
+            raise
+        finally:
+            environ['QUERY_STRING'] = qs_on_post
+
+        args = []
+        for value in fs.list or ():
+            name = value.name
+            if name is not None:
+                name = unicode(name, 'utf-8')
+            if not value.filename:
+                value = unicode(value.value, 'utf-8')
+            args.append((name, value))
+        return args
+
+    def _discard_upload(self, req):
+        context = req.environ.pop('crashdump.upload_context', None)
+        if context is not None:
+            context.cleanup()
+        admission = req.environ.pop('crashdump.admission', None)
+        if admission is not None:
+            admission.release()
+
+    def _admit_upload(self, req):
+        """Account the upload against the concurrency, size and rate limits.
+
+        The form fields are not available before the request body has been
+        read, so the crash uploader sends the host and product names as
+        request headers as well. The remote address is used if the upload
+        host name is missing.
+        """
+        self._admission.max_concurrent = self.max_concurrent_uploads
+        self._admission.max_inflight_bytes = self.max_inflight_upload_size
+        self._admission.busy_retry_after = self.busy_retry_after
+        try:
+            size = int(req.get_header('Content-Length') or 0)
+        except ValueError:
+            size = 0
+        burst = self.upload_rate_burst
+        limits = []
+        limits.append( ('uploadhost:%s' % (req.get_header('Upload-Hostname') or req.remote_addr), self.client_upload_rate, burst) )
+        if req.get_header('Crash-Hostname'):
+            limits.append( ('crashhost:%s' % req.get_header('Crash-Hostname'), self.client_upload_rate, burst) )
+        if req.get_header('Product-Name'):
+            limits.append( ('product:%s' % req.get_header('Product-Name'), self.product_upload_rate, burst) )
+        req.environ['crashdump.admission'] = self._admission.admit(limits, size)
+
+    def _accepted_content_encodings(self):
+        return ', '.join([content_encodings[method] for method in available_compression_methods()])
+
+    def _is_batch_path(self, path_info):
+        return path_info == '/crashdump/submit/batch' or path_info == '/submit/batch'
+
     def pre_process_request(self, req, handler):
+        if handler is not self or (req.method != "POST" and req.method != "PUT"):
+            return handler
         if req.path_info != '/crashdump/submit' and req.path_info != '/submit' and \
-            req.path_info != '/crashdump/crash_upload' and req.path_info != '/crash_upload':
+            req.path_info != '/crashdump/crash_upload' and req.path_info != '/crash_upload' and \
+            not self._is_batch_path(req.path_info) and \
+            not self._upload_session_re.match(req.path_info):
             return handler
 
         self.log.debug('CrashDumpSubmit pre_process_request: %s %s %s', req.method, req.path_info, handler)
-        if req.method == "POST":
-            user_agent = req.get_header('User-Agent')
-            if user_agent is not None and '/' in user_agent:
-                user_agent, agent_ver = user_agent.split('/', 1)
-            if user_agent == 'terra3d-crashuploader':
-                # copy the requested form token from into the args to pass the CSRF test
-                req.args['__FORM_TOKEN' ] = req.form_token
-
-            manual_upload = req.args.as_int('manual_upload', 0)
-            # for testing
-            if manual_upload:
-                # copy the requested form token from into the args to pass the CSRF test
-                req.args['__FORM_TOKEN' ] = req.form_token
-
+        try:
+            self._admit_upload(req)
+        except AdmissionRejected as e:
+            headers = {}
+            headers['Retry-After'] = str(int(math.ceil(e.retry_after)))
+            self.log.info('upload from %s rejected: %s', req.remote_addr, e)
+            return self._error_response(req, status=HTTPServiceUnavailable.code, body=str(e), headers=headers)
+        # the upload is released by process_request, or by
+        # post_process_request if the dispatcher rejects the request
+        try:
+            if req.method == "POST":
+                self._parse_upload(req)
+        except:
+            self._discard_upload(req)
+            raise
         return handler
 
+    def _parse_upload(self, req):
+        if 'arg_list' not in req.__dict__:
+            # request body has not been parsed yet, so we can stream the
+            # uploaded files into the staging directory
+            req.callbacks['arg_list'] = self._parse_upload_arg_list
+        try:
+            req.args
+        except UploadSizeExceeded as e:
+            self._discard_upload(req)
+            headers = {}
+            headers['Max-Upload-Size'] = self.max_upload_size
+            if self._is_batch_path(req.path_info):
+                headers['Max-Batch-Upload-Size'] = self.max_batch_upload_size
+            headers['Upload-Disabled'] = '1' if self.upload_disabled else '0'
+            self.log.debug('upload aborted: %s' % e)
+            return self._error_response(req, status=HTTPInternalServerError.code, body=str(e), headers=headers)
+        except UnsupportedContentEncoding as e:
+            self._discard_upload(req)
+            headers = {}
+            headers['Accept-Encoding'] = self._accepted_content_encodings()
+            return self._error_response(req, status=HTTPUnsupportedMediaType.code, body=str(e), headers=headers)
+        except IOError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            self._discard_upload(req)
+            return self._error_response(req, status=HTTPBadRequest.code, body=e.strerror)
+        user_agent = req.get_header('User-Agent')
+        if user_agent is not None and '/' in user_agent:
+            user_agent, agent_ver = user_agent.split('/', 1)
+        if user_agent == 'terra3d-crashuploader':
+            # copy the requested form token from into the args to pass the CSRF test
+            req.args['__FORM_TOKEN' ] = req.form_token
+
+        manual_upload = req.args.as_int('manual_upload', 0)
+        # for testing
+        if manual_upload:
+            # copy the requested form token from into the args to pass the CSRF test
+            req.args['__FORM_TOKEN' ] = req.form_token
+
     def post_process_request(self, req, template, data, content_type, method=None):
+        # also called for requests rejected after pre_process_request,
+        # e.g. by the CSRF check of the dispatcher
+        self._discard_upload(req)
         return template, data, content_type, method
 
     def process_request(self, req):
         self.log.debug('CrashDumpSubmit process_request: %s %s', req.method, req.path_info)
         if req.path_info == '/crashdump/submit' or req.path_info == '/submit':
             self.log.debug('CrashDumpSubmit process_request_submit: %s %s', req.method, req.path_info)
-            return self.process_request_submit(req)
+            try:
+                return self.process_request_submit(req)
+            finally:
+                self._discard_upload(req)
         elif req.path_info == '/crashdump/crash_upload' or req.path_info == '/crash_upload':
-            return self.process_request_crash_upload(req)
+            try:
+                return self.process_request_crash_upload(req)
+            finally:
+                self._discard_upload(req)
         elif req.path_info == '/crashdump/list' or req.path_info == '/crashlist' or req.path_info == '/crashdump/submit/crashlist' or req.path_info == '/submit/crashlist':
             return self.process_request_crashlist(req)
         elif req.path_info == '/crashdump/capabilities' or req.path_info == '/capabilities' or req.path_info == '/crashdump/submit/capabilities' or req.path_info == '/submit/capabilities':
             return self.process_request_capabilities(req)
+        elif req.path_info == '/crashdump/submit/check' or req.path_info == '/submit/check':
+            return self.process_request_check(req)
+        elif self._is_batch_path(req.path_info):
+            try:
+                return self.process_request_batch(req)
+            finally:
+                self._discard_upload(req)
+        elif self._upload_session_re.match(req.path_info):
+            try:
+                return self.process_request_upload_session(req)
+            finally:
+                self._discard_upload(req)
         else:
             return self._error_response(req, status=HTTPMethodNotAllowed.code, body='Invalid request path %s.' % req.path_info)
 
@@ -369,6 +774,14 @@ class CrashDumpSubmit(Component):
         headers = {}
         headers['Max-Upload-Size'] = self.max_upload_size
         headers['Upload-Disabled'] = '1' if self.upload_disabled else '0'
+        headers['Chunked-Upload'] = '1'
+        headers['Max-Chunk-Size'] = self.max_chunk_size
+        headers['Batch-Submit'] = '1' if self.max_batch_size > 0 else '0'
+        headers['Max-Batch-Size'] = self.max_batch_size
+        headers['Max-Batch-Upload-Size'] = self.max_batch_upload_size
+        headers['Duplicate-Check'] = '1'
+        # content codings accepted for request bodies and file parts
+        headers['Accept-Encoding'] = self._accepted_content_encodings()
 
         # This is a plain Python source file, not an egg
         dist = get_distribution('TracCrashDump')
@@ -381,6 +794,373 @@ class CrashDumpSubmit(Component):
             body = 'OK'
         return self._success_response(req, body=body.encode('utf-8'), headers=headers)
 
+    def _check_uploader_user_agent(self, req):
+        user_agent_full = req.get_header('User-Agent')
+        if user_agent_full is None:
+            return self._error_response(req, status=HTTPForbidden.code, body='No user-agent specified.')
+        if '/' in user_agent_full:
+            user_agent, agent_ver = user_agent_full.split('/', 1)
+        else:
+            user_agent = user_agent_full
+        if user_agent != 'terra3d-crashuploader':
+            return self._error_response(req, status=HTTPForbidden.code, body='User-agent %s not allowed' % user_agent_full)
+
+    def _get_upload_session_dir(self, uuid):
+        return os.path.join(self._get_staging_dir(), str(uuid))
+
+    def get_upload_sessions(self):
+        """Return the names of the directories of all chunked upload sessions."""
+        staging_dir = self._get_staging_dir()
+        try:
+            names = os.listdir(staging_dir)
+        except OSError:
+            return []
+        # the other entries are the files of uploads in progress
+        return sorted(name for name in names
+                      if CrashDump.uuid_is_valid(name) and os.path.isdir(os.path.join(staging_dir, name)))
+
+    def expire_upload_sessions(self, now=None):
+        """Remove the chunked upload sessions which did not receive a chunk
+        for upload_session_hours.
+
+        Returns the number of removed sessions and the bytes freed.
+        """
+        if self.upload_session_hours <= 0:
+            return (0, 0)
+        if now is None:
+            now = time.time()
+        cutoff = now - self.upload_session_hours * 3600
+        num_sessions = 0
+        num_bytes = 0
+        for name in self.get_upload_sessions():
+            session_dir = os.path.join(self._get_staging_dir(), name)
+            with lock_directory(session_dir):
+                try:
+                    paths = [os.path.join(session_dir, entry) for entry in os.listdir(session_dir)]
+                    last_change = max([os.path.getmtime(path) for path in [session_dir] + paths])
+                    size = sum([os.path.getsize(path) for path in paths])
+                except OSError:
+                    continue
+                if last_change >= cutoff:
+                    continue
+                self.log.info('Removing the expired upload session %s', name)
+                shutil.rmtree(session_dir, ignore_errors=True)
+            num_sessions += 1
+            num_bytes += size
+        return (num_sessions, num_bytes)
+
+    def _get_upload_session_state(self, session_dir):
+        """Return a list of (field, offset, filename) of all files in the upload session."""
+        ret = []
+        for field in self.upload_file_fields:
+            data_file = os.path.join(session_dir, field)
+            if os.path.isfile(data_file):
+                filename = None
+                try:
+                    with open(data_file + '.name', 'r') as f:
+                        filename = f.read().strip()
+                except IOError:
+                    pass
+                ret.append( (field, os.path.getsize(data_file), filename) )
+        return ret
+
+    def process_request_upload_session(self, req):
+        """Handle the chunked upload protocol.
+
+        GET    .../submit/upload/<uuid>            current state of the upload session
+        PUT    .../submit/upload/<uuid>/<field>    append a chunk at the offset given in the Upload-Offset
+                                                   header, the file name is taken from Upload-Filename
+        POST   .../submit/upload/<uuid>/commit     process the uploaded files like a regular submit
+        DELETE .../submit/upload/<uuid>            discard the upload session
+        """
+        self._check_uploader_user_agent(req)
+
+        headers = {}
+        headers['Max-Upload-Size'] = self.max_upload_size
+        headers['Max-Chunk-Size'] = self.max_chunk_size
+        headers['Upload-Disabled'] = '1' if self.upload_disabled else '0'
+        if self.upload_disabled:
+            return self._error_response(req, status=HTTPInternalServerError.code, body='Crashdump upload has been disabled by the administrator.', headers=headers)
+
+        match = self._upload_session_re.match(req.path_info)
+        uuid = UUID(match.group(1))
+        field = match.group(2)
+        session_dir = self._get_upload_session_dir(uuid)
+
+        if req.method == 'GET' and field is None:
+            body = ''
+            for (name, offset, filename) in self._get_upload_session_state(session_dir):
+                headers['Upload-Offset-%s' % name] = str(offset)
+                body += '%s %i %s\n' % (name, offset, filename or '')
+            return self._success_response(req, body=body, headers=headers)
+        elif req.method == 'DELETE' and field is None:
+            if os.path.isdir(session_dir):
+                with lock_directory(session_dir):
+                    shutil.rmtree(session_dir, ignore_errors=True)
+            return self._success_response(req, body='Upload session %s discarded.' % uuid, headers=headers)
+        elif req.method == 'PUT' and field in self.upload_file_fields:
+            return self._process_upload_chunk(req, uuid, session_dir, field, headers)
+        elif req.method == 'POST' and field == 'commit':
+            return self._process_upload_commit(req, uuid, session_dir)
+        else:
+            return self._error_response(req, status=HTTPMethodNotAllowed.code, body='Method %s not allowed for %s' % (req.method, req.path_info))
+
+    def _process_upload_chunk(self, req, uuid, session_dir, field, headers):
+        length = req.get_header('Content-Length')
+        try:
+            length = int(length)
+        except (TypeError, ValueError):
+            return self._error_response(req, status=HTTPBadRequest.code, body='Content-Length required.', headers=headers)
+        try:
+            offset = int(req.get_header('Upload-Offset') or 0)
+        except ValueError:
+            return self._error_response(req, status=HTTPBadRequest.code, body='Invalid Upload-Offset.', headers=headers)
+        if self.max_chunk_size > 0 and length > self.max_chunk_size:
+            return self._error_response(req, status=HTTPRequestEntityTooLarge.code, body='Chunk size %i bytes exceed the chunk limit of %i bytes' % (length, self.max_chunk_size), headers=headers)
+
+        # concurrent chunks of the same session are written one at a time,
+        # the offset is only checked while holding the lock
+        with lock_directory(session_dir):
+            return self._append_upload_chunk(req, uuid, session_dir, field, headers, offset, length)
+
+    def _append_upload_chunk(self, req, uuid, session_dir, field, headers, offset, length):
+        data_file = os.path.join(session_dir, field)
+        current = os.path.getsize(data_file) if os.path.isfile(data_file) else 0
+        if offset != current:
+            # client has to continue at the current offset
+            headers['Upload-Offset'] = str(current)
+            return self._error_response(req, status=HTTPConflict.code, body='Invalid offset %i for %s, expected %i.' % (offset, field, current), headers=headers)
+
+        total = sum([size for (name, size, filename) in self._get_upload_session_state(session_dir)])
+        if self.max_upload_size > 0 and total + length > self.max_upload_size:
+            return self._error_response(req, status=HTTPRequestEntityTooLarge.code, body='Upload size %i bytes exceed the upload limit of %i bytes' % (total + length, self.max_upload_size), headers=headers)
+
+        # the session may have been expired while waiting for the lock
+        if not os.path.isdir(session_dir):
+            os.makedirs(session_dir)
+        if offset == 0:
+            filename = os.path.basename(req.get_header('Upload-Filename') or '') or '%s.%s' % (uuid, field)
+            with open(data_file + '.name', 'w') as f:
+                f.write(filename)
+
+        fileobj = req.environ['wsgi.input']
+        with open(data_file, 'ab') as f:
+            todo = length
+            while todo > 0:
+                data = fileobj.read(min(todo, 65536))
+                if not data:
+                    break
+                f.write(data)
+                todo -= len(data)
+        headers['Upload-Offset'] = str(os.path.getsize(data_file))
+        if todo > 0:
+            return self._error_response(req, status=HTTPBadRequest.code, body='Incomplete chunk for %s, missing %i bytes.' % (field, todo), headers=headers)
+        return self._success_response(req, body='OK', headers=headers)
+
+    def _process_upload_commit(self, req, uuid, session_dir):
+        if not self._get_upload_session_state(session_dir):
+            return self._error_response(req, status=HTTPNotFound.code, body='No upload session for crash %s.' % uuid)
+
+        with lock_directory(session_dir):
+            state = self._get_upload_session_state(session_dir)
+            if not state:
+                return self._error_response(req, status=HTTPNotFound.code, body='No upload session for crash %s.' % uuid)
+
+            fields = []
+            for (name, offset, filename) in state:
+                field = _SessionUploadField(filename, os.path.join(session_dir, name))
+                req.args[name] = field
+                fields.append(field)
+            req.args['id'] = str(uuid)
+            try:
+                return self.process_request_submit(req)
+            finally:
+                for field in fields:
+                    field.file.close()
+                # all files which have been moved into the crash directory are
+                # done, so the session can be removed once nothing is left
+                if not self._get_upload_session_state(session_dir):
+                    shutil.rmtree(session_dir, ignore_errors=True)
+
+    def process_request_batch(self, req):
+        """Submit many crashes in a single request.
+
+        The request is a multipart form with a `manifest` field holding a JSON
+        list with one object per crash. Each object contains the same fields
+        as a regular submit, but the values of the file fields (e.g. minidump)
+        name the form part with the file data. The crashes are processed in
+        groups of batch_transaction_size crashes per database transaction
+        and the result of every crash is returned as JSON.
+        """
+        self._check_uploader_user_agent(req)
+
+        headers = {}
+        headers['Max-Upload-Size'] = self.max_upload_size
+        headers['Max-Batch-Size'] = self.max_batch_size
+        headers['Max-Batch-Upload-Size'] = self.max_batch_upload_size
+        headers['Upload-Disabled'] = '1' if self.upload_disabled else '0'
+        if self.upload_disabled:
+            return self._error_response(req, status=HTTPInternalServerError.code, body='Crashdump upload has been disabled by the administrator.', headers=headers)
+        if self.max_batch_size <= 0:
+            return self._error_response(req, status=HTTPForbidden.code, body='Batch submit has been disabled by the administrator.', headers=headers)
+
+        manifest = req.args.get('manifest')
+        if isinstance(manifest, cgi.FieldStorage):
+            manifest = manifest.value
+        try:
+            manifest = json.loads(manifest or '')
+        except ValueError as e:
+            return self._error_response(req, status=HTTPBadRequest.code, body='Invalid batch manifest: %s' % e, headers=headers)
+        if not isinstance(manifest, list) or not all(isinstance(entry, dict) for entry in manifest):
+            return self._error_response(req, status=HTTPBadRequest.code, body='Batch manifest must be a list of crashes.', headers=headers)
+        if len(manifest) > self.max_batch_size:
+            return self._error_response(req, status=HTTPRequestEntityTooLarge.code, body='Batch of %i crashes exceeds the limit of %i crashes.' % (len(manifest), self.max_batch_size), headers=headers)
+
+        results = []
+        group_size = max(self.batch_transaction_size, 1)
+        for start in range(0, len(manifest), group_size):
+            group = manifest[start:start + group_size]
+            deferred_updates = []
+            ticket_changes = []
+            try:
+                group_results = []
+                with self.env.db_transaction:
+                    for entry in group:
+                        group_results.append(self._process_batch_item(req, entry, deferred_updates,
+                                                                      ticket_changes))
+            except Exception as e:
+                self.log.exception('Failed to store batch of %i crashes', len(group))
+                self._remove_unstored_crashes(group)
+                group_results = [ { 'id': entry.get('id'), 'status': HTTPInternalServerError.code,
+                                    'message': 'Failed to store crash: %s' % exception_to_unicode(e) } for entry in group ]
+            else:
+                CrashDumpTicketLinks.notify_changes(self.env, ticket_changes)
+                if deferred_updates:
+                    self._start_ticket_updates(deferred_updates)
+            results.extend(group_results)
+
+        body = json.dumps({'results': results})
+        return self._success_response(req, body=body, content_type='application/json', headers=headers)
+
+    def _remove_unstored_crashes(self, entries):
+        """Remove the files of the crashes of a failed batch group.
+
+        The files have already been moved into the crash directories when
+        the transaction of the group is rolled back, so the directories of
+        the crashes which are not in the database are removed.
+        """
+        for entry in entries:
+            id_str = entry.get('id')
+            if not isinstance(id_str, basestring) or not CrashDump.uuid_is_valid(id_str):
+                continue
+            uuid = UUID(id_str)
+            crash_dir = os.path.join(self.env.path, self.dumpdata_dir, self._get_crash_dir_name(uuid))
+            if not os.path.isdir(crash_dir):
+                continue
+            with lock_crash(os.path.join(self.env.path, self.dumpdata_dir), uuid):
+                if CrashDump.find_by_uuid(self.env, uuid) is None:
+                    self.log.info('Removing the files of crash %s of the failed batch', uuid)
+                    shutil.rmtree(crash_dir, ignore_errors=True)
+
+    def _process_batch_item(self, req, entry, deferred_updates, ticket_changes):
+        arg_list = []
+        for (name, value) in entry.items():
+            if name in self._batch_rejected_fields:
+                return { 'id': entry.get('id'), 'status': HTTPBadRequest.code,
+                         'message': 'Field %s is not allowed in a batch submit.' % name }
+            if name in self.upload_file_fields:
+                if not value:
+                    continue
+                value = req.args.get(value)
+                if not isinstance(value, cgi.FieldStorage):
+                    return { 'id': entry.get('id'), 'status': HTTPBadRequest.code,
+                             'message': 'Missing file %s for field %s.' % (entry[name], name) }
+            elif value is None:
+                continue
+            elif isinstance(value, bool):
+                value = u'true' if value else u'false'
+            elif not isinstance(value, basestring):
+                value = unicode(value)
+            arg_list.append((name, value))
+
+        item_req = _BatchItemRequest(req, arg_list_to_args(arg_list), deferred_updates, ticket_changes)
+        try:
+            self.process_request_submit(item_req)
+        except RequestDone:
+            pass
+
+        result = { 'id': entry.get('id'), 'status': item_req.status, 'message': item_req.body }
+        if 'CrashId' in item_req.headers:
+            result['crashid'] = int(item_req.headers['CrashId'])
+        if 'Crash-URL' in item_req.headers:
+            result['url'] = item_req.headers['Crash-URL']
+        if 'Linked-Tickets' in item_req.headers:
+            result['linked_tickets'] = [ int(elem.split(':', 1)[0][1:]) for elem in item_req.headers['Linked-Tickets'].split(';') ]
+        return result
+
+    def process_request_check(self, req):
+        """Tell the client which of the given crashes are already stored.
+
+        The request body is a JSON list of objects with the crash `id` and
+        optionally `files`, mapping upload field names (e.g. minidump) to the
+        SHA-256 hash of the file content or null. The response lists for
+        every crash if it exists and for every requested file if it is
+        `stored`, `missing` or `different` (hash mismatch).
+        """
+        self._check_uploader_user_agent(req)
+        try:
+            crashes = json.loads(req.read() or '')
+        except ValueError as e:
+            return self._error_response(req, status=HTTPBadRequest.code, body='Invalid crash list: %s' % e)
+        if not isinstance(crashes, list) or not all(isinstance(entry, dict) for entry in crashes):
+            return self._error_response(req, status=HTTPBadRequest.code, body='Crash list must be a list of crashes.')
+        if self.max_batch_size > 0 and len(crashes) > self.max_batch_size:
+            return self._error_response(req, status=HTTPRequestEntityTooLarge.code, body='List of %i crashes exceeds the limit of %i crashes.' % (len(crashes), self.max_batch_size))
+
+        uuids = []
+        for entry in crashes:
+            id_str = entry.get('id')
+            if not id_str or not CrashDump.uuid_is_valid(id_str):
+                return self._error_response(req, status=HTTPBadRequest.code, body='Invalid crash identifier %s specified.' % id_str)
+            uuids.append(str(UUID(id_str)))
+
+        columns = [ self.upload_file_columns[field] for field in self.upload_file_fields ]
+        stored = {}
+        for start in range(0, len(uuids), 500):
+            chunk = uuids[start:start + 500]
+            for row in self.env.db_query("SELECT id,uuid,%s FROM crashdump WHERE uuid IN (%s)" %
+                                         (','.join(columns), ','.join(['%s'] * len(chunk))), chunk):
+                stored[row[1]] = (row[0], dict(zip(self.upload_file_fields, row[2:])))
+
+        # compare with the recorded hashes instead of reading the files
+        recorded = CrashDump.get_file_info(self.env, dict(
+            (crashid, dict((self.upload_file_columns[field], item_name) for field, item_name in item_names.items()))
+            for crashid, item_names in stored.values()))
+        retention = CrashDumpRetention(self.env)
+        results = []
+        for uuid, entry in zip(uuids, crashes):
+            result = { 'id': entry.get('id'), 'exists': uuid in stored }
+            if uuid in stored:
+                crashid, item_names = stored[uuid]
+                result['crashid'] = crashid
+                files = {}
+                for field, sha256 in (entry.get('files') or {}).items():
+                    if field not in self.upload_file_fields:
+                        continue
+                    filename = retention.dump_file_path(item_names[field]) if item_names[field] else None
+                    stored_sha256 = recorded.get(crashid, {}).get(self.upload_file_columns[field], {}).get('sha256')
+                    if filename is None or not dump_file_exists(filename):
+                        files[field] = 'missing'
+                    elif sha256 and (stored_sha256 or hash_dump_file(filename)) != sha256.lower():
+                        files[field] = 'different'
+                    else:
+                        files[field] = 'stored'
+                result['files'] = files
+            results.append(result)
+
+        body = json.dumps({'results': results})
+        return self._success_response(req, body=body, content_type='application/json')
+
     def process_request_crash_upload(self, req):
         return self._manual_upload_result(req, error=None)
 
@@ -399,15 +1179,7 @@ class CrashDumpSubmit(Component):
 
         manual_upload = req.args.as_int('manual_upload', 0)
         if manual_upload == 0:
-            user_agent_full = req.get_header('User-Agent')
-            if user_agent_full is None:
-                return self._error_response(req, status=HTTPForbidden.code, body='No user-agent specified.')
-            if '/' in user_agent_full:
-                user_agent, agent_ver = user_agent_full.split('/', 1)
-            else:
-                user_agent = user_agent_full
-            if user_agent != 'terra3d-crashuploader':
-                return self._error_response(req, status=HTTPForbidden.code, body='User-agent %s not allowed' % user_agent_full)
+            self._check_uploader_user_agent(req)
 
         headers = {}
         headers['Max-Upload-Size'] = self.max_upload_size
@@ -475,6 +1247,40 @@ class CrashDumpSubmit(Component):
                 req.args['minidumpreportxml'] = minidumpreportxml
 
         uuid = UUID(id_str)
+        for attempt in range(3):
+            try:
+                # uploads of the same crash are serialized, different crashes
+                # are processed in parallel
+                with lock_crash(os.path.join(self.env.path, self.dumpdata_dir), uuid):
+                    return self._process_request_submit_crash(req, uuid, id_str, manual_upload)
+            except self.env.db_exc.IntegrityError as e:
+                if isinstance(req, _BatchItemRequest):
+                    # the transaction of the batch group cannot go on after
+                    # the error on every database, the whole group fails
+                    raise
+                # the crash has been added by another server in the meantime
+                self.log.info('crash %s has been added concurrently: %s', uuid, exception_to_unicode(e))
+                force_str = req.args.get('force') or 'false'
+                if force_str.lower() != 'true' and not manual_upload:
+                    crashobj = CrashDump.find_by_uuid(self.env, uuid)
+                    if crashobj:
+                        return self._already_uploaded_response(req, uuid, id_str, crashobj.id)
+                # forced and manual uploads update the existing crash, so
+                # process the upload again
+        return self._error_response(req, status=HTTPInternalServerError.code, body='Failed to add crash dump %s to database' % uuid)
+
+    def _already_uploaded_response(self, req, uuid, id_str, crashid):
+        headers = {}
+        headers['Crash-URL'] = req.abs_href('crash', str(uuid))
+        headers['CrashId'] = str(crashid)
+        self.log.debug('crash %s already uploaded %s' % (uuid, headers['Crash-URL']) )
+        return self._error_response(req, status=HTTPInternalServerError.code, body='Crash identifier %s already uploaded.' % id_str, headers=headers)
+
+    def _process_request_submit_crash(self, req, uuid, id_str, manual_upload):
+        """Store the uploaded files and add or update the crash `uuid`.
+
+        Called with the lock of the crash directory held.
+        """
         crashid = None
         crashobj = CrashDump.find_by_uuid(self.env, uuid)
         if not crashobj:
@@ -485,17 +1291,13 @@ class CrashDumpSubmit(Component):
         force_str = req.args.get('force') or 'false'
         force = True if force_str.lower() == 'true' else False
         if crashid is not None and not force and not manual_upload:
-            headers = {}
-            headers['Crash-URL'] = req.abs_href('crash', str(uuid))
-            headers['CrashId'] = str(crashid)
-            self.log.debug('crash %s already uploaded %s' % (uuid, headers['Crash-URL']) )
-            return self._error_response(req, status=HTTPInternalServerError.code, body='Crash identifier %s already uploaded.' % id_str, headers=headers)
+            return self._already_uploaded_response(req, uuid, id_str, crashid)
 
         ticket_str = req.args.get('ticket') or 'no'
 
-        linked_tickets = set()
-        ticketobjs = []
-        new_ticket = None
+        # ids of the existing tickets to link the crash to
+        link_ticket_ids = []
+        create_ticket = False
         if ticket_str == 'no':
             pass
         elif '#' in ticket_str:
@@ -503,35 +1305,31 @@ class CrashDumpSubmit(Component):
             for t in ticket_str.split(','):
                 if t[0] == '#':
                     ticket_ids.append(int(t[1:]))
-            ticketobjs = []
+            with self.env.db_query as db:
+                existing = CrashDumpTicketLinks.existing_tickets(db, ticket_ids)
             for tkt_id in ticket_ids:
-                try:
-                    ticketobjs.append(Ticket(env=self.env, tkt_id=tkt_id))
-                except ResourceNotFound:
+                if tkt_id not in existing:
                     return self._error_response(req, status=HTTPNotFound.code, body='Ticket %i not found. Cannot link crash %s to the requested ticket.' % (tkt_id, str(uuid)))
+                link_ticket_ids.append(tkt_id)
 
         elif ticket_str == 'auto':
-            if crashid is None:
-                new_ticket = Ticket(env=self.env)
-                ticketobjs = [ new_ticket ]
-            else:
-                for tkt_id in crashobj.linked_tickets:
-                    try:
-                        ticketobjs.append( Ticket(env=self.env, tkt_id=tkt_id) )
+            if crashid is not None:
+                linked = crashobj.linked_tickets
+                with self.env.db_query as db:
+                    existing = CrashDumpTicketLinks.existing_tickets(db, linked)
+                for tkt_id in linked:
+                    if tkt_id in existing:
+                        link_ticket_ids.append(tkt_id)
                         break
-                    except ResourceNotFound:
-                        pass
-                if len(ticketobjs) == 0:
-                    new_ticket = Ticket(env=self.env)
-                    ticketobjs = [ new_ticket ]
+            if not link_ticket_ids:
+                create_ticket = True
         elif ticket_str == 'new':
-            new_ticket = Ticket(env=self.env)
-            ticketobjs = [ new_ticket ]
+            create_ticket = True
         else:
             return self._error_response(req, status=HTTPInternalServerError.code, body='Unrecognized ticket string %s for crash %s.' % (ticket_str, str(uuid)))
-        
+
         #print('ticket_str=%s' % ticket_str)
-        #print('ticketobjs=%s' % str(ticketobjs))
+        #print('link_ticket_ids=%s' % str(link_ticket_ids))
 
         # we require at least one crash dump file (either minidump or coredump)
         # and any number of report files
@@ -558,6 +1356,16 @@ class CrashDumpSubmit(Component):
         ok, new_coredumpreporttextfile, errmsg = self._store_dump_file(uuid, req, 'coredumpreport', force)
         ok, new_coredumpreportxmlfile, errmsg = self._store_dump_file(uuid, req, 'coredumpreportxml', force)
         ok, new_coredumpreporthtmlfile, errmsg = self._store_dump_file(uuid, req, 'coredumpreporthtml', force)
+        new_files = {
+            'minidumpfile': new_minidumpfile,
+            'minidumpreporttextfile': new_minidumpreporttextfile,
+            'minidumpreportxmlfile': new_minidumpreportxmlfile,
+            'minidumpreporthtmlfile': new_minidumpreporthtmlfile,
+            'coredumpfile': new_coredumpfile,
+            'coredumpreporttextfile': new_coredumpreporttextfile,
+            'coredumpreportxmlfile': new_coredumpreportxmlfile,
+            'coredumpreporthtmlfile': new_coredumpreporthtmlfile,
+            }
 
         self.log.debug('new_minidumpfile \'%s\'' % new_minidumpfile)
         self.log.debug('new_minidumpreportxmlfile \'%s\'' % new_minidumpreportxmlfile)
@@ -614,7 +1422,7 @@ class CrashDumpSubmit(Component):
 
         crashobj['crashtime'] = crashtimestamp if crashtimestamp else None
         crashobj['reporttime'] = reporttimestamp if reporttimestamp else None
-        crashobj['uploadtime'] = datetime.datetime.now(utc)
+        crashobj['uploadtime'] = datetime.now(utc)
 
         self.log.debug('crashtimestamp %s' % (crashobj['crashtime']))
         self.log.debug('reporttimestamp %s' % (crashobj['reporttime']))
@@ -691,6 +1499,17 @@ class CrashDumpSubmit(Component):
                     appbase = appbase[:-len(crashobj['buildpostfix'])]
                 crashobj['applicationname'] = appbase
 
+            if xmlreport is not None:
+                for name, value in report_summary(xmlreport).items():
+                    crashobj[name] = value
+            for name, value in file_size_summary(os.path.join(self.env.path, self.dumpdata_dir), crashobj.values).items():
+                crashobj[name] = value
+            # the size and hash of the files stored by this upload, so the
+            # views never need to look at the files for them
+            stored_files = CrashDump.file_info(os.path.join(self.env.path, self.dumpdata_dir), crashobj.values,
+                                               [field for field, item_name in new_files.items()
+                                                if item_name and crashobj[field] == item_name])
+
             new_crash = True if crashid is None else False
             if new_crash:
                 crashobj['status'] = 'new'
@@ -741,31 +1560,44 @@ class CrashDumpSubmit(Component):
                 crashobj['owner'] = self._apply_username_replacements(crashobj['owner'])
                 crashobj['reporter'] = self._apply_username_replacements(crashobj['reporter'])
 
-                crashid = crashobj.insert()
-                result = True if crashid else False
-                if result:
-                    if xmlreport is not None and xmlreport.exception is not None:
-                        ex_thread = xmlreport.exception.thread
-                    else:
-                        ex_thread = None
-                    if ex_thread is not None:
-                        threadid = ex_thread.id
-                        stackdump = ex_thread.simplified_stackdump if ex_thread.simplified_stackdump is not None else ex_thread.stackdump
-                        if stackdump:
-                            for frameno, frm in enumerate(stackdump.callstack):
-                                frameobj = CrashDumpStackFrame(crashid, threadid,frameno, env=self.env)
-                                frameobj['module'] = frm.module
-                                frameobj['function'] = frm.function
-                                frameobj['funcoff'] = frm.funcoff
-                                frameobj['source'] = frm.source
-                                frameobj['line'] = frm.line
-                                frameobj['lineoff'] = frm.lineoff
-                                frameobj.insert()
-
+            # the crash and everything recorded along with it are stored in
+            # one transaction, so a failure leaves no partially stored crash
+            with self.env.db_transaction as db:
+                if new_crash:
+                    crashid = crashobj.insert()
+                    result = True if crashid else False
+                    if result:
+                        if xmlreport is not None and xmlreport.exception is not None:
+                            ex_thread = xmlreport.exception.thread
+                        else:
+                            ex_thread = None
+                        if ex_thread is not None:
+                            threadid = ex_thread.id
+                            stackdump = ex_thread.simplified_stackdump if ex_thread.simplified_stackdump is not None else ex_thread.stackdump
+                            if stackdump:
+                                for frameno, frm in enumerate(stackdump.callstack):
+                                    frameobj = CrashDumpStackFrame(crashid, threadid,frameno, env=self.env)
+                                    frameobj['module'] = frm.module
+                                    frameobj['function'] = frm.function
+                                    frameobj['funcoff'] = frm.funcoff
+                                    frameobj['source'] = frm.source
+                                    frameobj['line'] = frm.line
+                                    frameobj['lineoff'] = frm.lineoff
+                                    frameobj.insert()
+                else:
+                    #print('update crash %s' % crashobj)
+                    result = crashobj.save_changes(author=crashobj['crashusername'])
 
-            else:
-                #print('update crash %s' % crashobj)
-                result = crashobj.save_changes(author=crashobj['crashusername'])
+                if result:
+                    CrashDump.record_files(db, crashobj.id, stored_files)
+                    if new_crash:
+                        # again with the stack frames inserted above
+                        CrashDumpFullTextIndex(self.env).update(db, [crashobj.id])
+                    # all threads, the exception thread is also stored as
+                    # rows in crashdump_stack above
+                    if xmlreport is not None:
+                        CrashDump.record_stacks(db, crashobj.id, report_stacks(xmlreport))
+                        CrashDump.record_modules(self.env, {crashobj.id: report_modules(xmlreport)})
 
             if result:
                 values = crashobj.values
@@ -774,21 +1606,16 @@ class CrashDumpSubmit(Component):
                 values['crashid'] = crashid
                 values['uuid'] = crashobj.uuid
                 values['app'] = crashobj['applicationname'] if crashobj['applicationname'] else crashobj['applicationfile']
-                # Update all already linked tickets
-                for tkt_id in crashobj.linked_tickets:
-                    try:
-                        new_linked_ticketobj = Ticket(env=self.env, tkt_id=tkt_id)
-                        comment = """The crash [[/crash/%(uuid)s|CrashId#%(crashid)s - %(uuid)s]] has been updated by **%(uploadusername)s**
+                already_linked = crashobj.linked_tickets if not new_crash else []
+                updates = []
+                if already_linked:
+                    comment = """The crash [[/crash/%(uuid)s|CrashId#%(crashid)s - %(uuid)s]] has been updated by **%(uploadusername)s**
 from **%(uploadhostname)s** is already linked to this ticket.
 """ % values
+                    updates.extend((tkt_id, comment) for tkt_id in already_linked)
 
-                        new_linked_ticketobj.save_changes(author=crashobj['reporter'], comment=comment)
-                        # Only add valid tickets to the linked_tickets set
-                        linked_tickets.add(tkt_id)
-                    except ResourceNotFound:
-                        pass
-                    
-                if new_ticket is not None:
+                if create_ticket:
+                    new_ticket = Ticket(env=self.env)
                     new_ticket['type'] = self.default_ticket_type
                     new_ticket['summary'] = "Crash %(uuid)s in %(app)s" % values
                     comment = """The crash [[/crash/%(uuid)s|CrashId#%(crashid)s - %(uuid)s]] has been uploaded by **%(uploadusername)s**
@@ -805,34 +1632,28 @@ from **%(uploadhostname)s** and this ticket has been automatically created to tr
                     new_ticket['reporter'] = self._apply_username_replacements(crashobj['reporter'])
 
                     new_ticket['linked_crash'] = str(crashid)
-                    new_ticket.insert()
+                    # the description already tells about the crash, so
+                    # only the link itself is left to add
+                    updates.append((new_ticket.insert(), None))
 
                 # Now add the newly linked tickets as well
-                for tkt_obj in ticketobjs:
-                    if tkt_obj.id not in crashobj.linked_tickets:
-                        ticket_values = self.escape_ticket_values(values)
-                        #self.log.debug('ticket_values=%s' % str(ticket_values))
-                        comment = """The crash [[/crash/%(uuid)s|CrashId#%(crashid)s - %(uuid)s]] has been uploaded by **%(uploadusername)s**
+                new_links = [tkt_id for tkt_id in link_ticket_ids if tkt_id not in already_linked]
+                if new_links:
+                    ticket_values = self.escape_ticket_values(values)
+                    #self.log.debug('ticket_values=%s' % str(ticket_values))
+                    comment = """The crash [[/crash/%(uuid)s|CrashId#%(crashid)s - %(uuid)s]] has been uploaded by **%(uploadusername)s**
 from **%(uploadhostname)s** and linked to this ticket.
 
 The crash occured at //%(crashtimestamp)s UTC// on **%(crashhostname)s** with user **%(crashusername)s** while running `%(applicationfile)s`. The
 application was running as part of %(productname)s (%(productcodename)s) version %(productversion)s (%(producttargetversion)s, %(buildtype)s) on a
 %(systemname)s/%(machinetype)s with %(osversion)s (%(osrelease)s/%(osmachine)s).
 """ % ticket_values
-                        linked_crashes = tkt_obj['linked_crash'] if tkt_obj['linked_crash'] else ''
-                        linked_crashes = set([int(x.strip()) for x in linked_crashes.split(',') if x.strip()])
-                        #print('crashid=%s' % crashid)
-                        #print('linked_crashes=%s' % linked_crashes)
-                        linked_crashes.add(crashid)
-                        #print('linked_crashes=%s' % linked_crashes)
-                        tkt_obj['linked_crash'] = ', '.join(str(x) for x in sorted(linked_crashes))
-                        tkt_obj.save_changes(author=crashobj['reporter'], comment=comment)
-                    
-                        linked_tickets.add(tkt_obj.id)
-                        with self.env.db_transaction as db:
-                            links = CrashDumpTicketLinks(self.env, tkt=tkt_obj, db=db)
-                            links.crashes.add(crashid)
-                            links.save(author=crashobj['reporter'], db=db)
+                    updates.extend((tkt_id, comment) for tkt_id in new_links)
+
+                if updates:
+                    linked_tickets = self._update_linked_tickets(req, crashid, updates, author=crashobj['reporter'])
+                else:
+                    linked_tickets = []
 
             if result:
                 if manual_upload:
@@ -862,7 +1683,63 @@ application was running as part of %(productname)s (%(productcodename)s) version
                 body = 'The following occured while processing the crash dump %s: %s' % (uuid, failure_message)
             return self._error_response(req, status=HTTPInternalServerError.code, body=body)
 
+    def _update_linked_tickets(self, req, crashid, updates, author):
+        """Link the crash to the tickets in `updates` and add the comments.
+
+        All tickets are updated in a single transaction. If
+        defer_ticket_updates is enabled, the update is done by a background
+        thread. The thread of a batch item is started and the ticket change
+        listeners and notifications of a batch item are called once its
+        batch group has been committed. Returns the ids of the existing
+        tickets.
+        """
+        if not self.defer_ticket_updates:
+            if isinstance(req, _BatchItemRequest):
+                with self.env.db_transaction as db:
+                    return CrashDumpTicketLinks.link_crash(db, crashid, updates, author,
+                                                           ticket_changes=req.ticket_changes)
+            ticket_changes = []
+            with self.env.db_transaction as db:
+                ret = CrashDumpTicketLinks.link_crash(db, crashid, updates, author, ticket_changes=ticket_changes)
+            CrashDumpTicketLinks.notify_changes(self.env, ticket_changes)
+            return ret
+
+        with self.env.db_query as db:
+            existing = CrashDumpTicketLinks.existing_tickets(db, [tkt_id for tkt_id, comment in updates])
+        if isinstance(req, _BatchItemRequest):
+            req.deferred_updates.append((crashid, updates, author))
+        else:
+            self._start_ticket_updates([(crashid, updates, author)])
+        return [tkt_id for tkt_id, comment in updates if tkt_id in existing]
+
+    def _start_ticket_updates(self, deferred_updates):
+        """Start the background thread doing the deferred ticket updates,
+        a list of (crashid, updates, author) tuples applied one at a time."""
+        def run():
+            for crashid, updates, author in deferred_updates:
+                try:
+                    ticket_changes = []
+                    with self.env.db_transaction as db:
+                        CrashDumpTicketLinks.link_crash(db, crashid, updates, author, ticket_changes=ticket_changes)
+                    CrashDumpTicketLinks.notify_changes(self.env, ticket_changes)
+                except Exception as e:
+                    self.log.error('Failed to update the tickets linked to crash %s: %s',
+                                   crashid, exception_to_unicode(e, traceback=True))
+
+        thread = threading.Thread(target=run, name='crashdump-ticket-update-%s' % deferred_updates[0][0])
+        thread.daemon = True
+        thread.start()
+        return thread
+
     def process_request_crashlist(self, req):
+        """Return the list of crashes as XML or JSON (format=json).
+
+        The result can be restricted with status=<status> and to the crashes
+        changed since since=<changetime>. At most limit=<n> crashes are
+        returned; the last element of the list contains the cursor to pass as
+        cursor=<id> to get the next page. The list is written incrementally
+        and an ETag is sent, so polling an unchanged list results in 304.
+        """
         if req.method != "GET":
             return self._error_response(req, status=HTTPMethodNotAllowed.code, body='Method %s not allowed' % req.method)
 
@@ -875,41 +1752,162 @@ application was running as part of %(productname)s (%(productcodename)s) version
             #return self._error_response(req, status=HTTPForbidden.code, body='User-agent %s not allowed' % user_agent)
 
         req_status = req.args.get('status') or 'active'
-        
-        headers = {}
-        body = ''
-        body = body + '<?xml version="1.0" encoding="utf-8"?>\r\n<crashlist>\r\n'
-        for crashobj in CrashDump.query(env=self.env, status=req_status):
-            
-            body = body + '<crash id=\"%i\" uuid=\"%s\" url=\"%s\" xmlreport=\"%s\" rawfile=\"%s\">\r\n' % \
-                (crashobj.id, crashobj['uuid'], 
-                    req.href('crash', crashobj['uuid']),
-                    req.href('crash', crashobj['uuid'], 'xml'),
-                    req.href('crash', crashobj['uuid'], 'raw'),
-                    )
-
-            for field in crashobj.fields:
-                field_name = field['name']
-                if field_name == 'uuid':
+        req_format = req.args.get('format') or 'xml'
+        if req_format not in ('xml', 'json'):
+            return self._error_response(req, status=HTTPBadRequest.code, body='Invalid format %s' % req_format)
+        limit = req.args.as_int('limit', 0, min=0)
+        cursor = req.args.as_int('cursor', None, min=0)
+        # only clients asking for pages know about the cursor, older clients
+        # expect the complete list
+        if self.max_crashlist_page_size > 0 and (limit or cursor is not None) and \
+                (limit == 0 or limit > self.max_crashlist_page_size):
+            limit = self.max_crashlist_page_size
+        since_str = req.args.get('since')
+        since = None
+        if since_str:
+            try:
+                since = from_utimestamp(int(since_str))
+            except ValueError:
+                try:
+                    since = parse_date(since_str, hint='iso8601')
+                except TracError:
+                    return self._error_response(req, status=HTTPBadRequest.code, body='Invalid since %s' % since_str)
+
+        count, last_modified, num_links = CrashDump.crashlist_state(self.env, status=req_status, since=since)
+        if last_modified is None:
+            last_modified = from_utimestamp(0)
+        req.check_modified(last_modified, [req_format, req_status, since_str, cursor, limit, count, num_links])
+
+        fields = CrashDumpSystem(self.env).get_crash_fields()
+        std_fields = [f['name'] for f in fields if not f.get('custom')]
+        crashes = self._iter_with_files(CrashDump.iter_crashlist(self.env, std_fields, status=req_status,
+                                                                 since=since, after_id=cursor, limit=limit))
+        if req_format == 'json':
+            content_type = 'application/json'
+            body = self._iter_crashlist_json(req, fields, crashes, limit)
+        else:
+            content_type = 'text/xml'
+            body = self._iter_crashlist_xml(req, fields, crashes, limit)
+
+        req.send_response(200)
+        req.send_header('Cache-Control', 'must-revalidate')
+        req.send_header('Content-Type', content_type + ';charset=utf-8')
+        req.send_header('Last-Modified', http_date(last_modified))
+        req.end_headers()
+        if req.method != 'HEAD':
+            req.write(body)
+        raise RequestDone
+
+    def _iter_with_files(self, crashes, chunk_size=500):
+        """Add the recorded sizes and hashes of the files to the (id,
+        values, linked tickets) tuples of `crashes`, fetched for a chunk of
+        crashes at a time."""
+        chunk = []
+        for crash in crashes:
+            chunk.append(crash)
+            if len(chunk) == chunk_size:
+                for item in self._add_files(chunk):
+                    yield item
+                chunk = []
+        for item in self._add_files(chunk):
+            yield item
+
+    def _add_files(self, chunk):
+        if not chunk:
+            return []
+        files = CrashDump.get_file_info(self.env, dict((crash_id, values) for crash_id, values, tickets in chunk))
+        return [(crash_id, values, tickets, files.get(crash_id, {})) for crash_id, values, tickets in chunk]
+
+    def _crashlist_value(self, field, values):
+        value = values.get(field['name'])
+        if value is None:
+            return None
+        elif field['type'] == 'time':
+            return str(value)
+        elif not isinstance(value, basestring):
+            return unicode(value)
+        return value
+
+    def _iter_crashlist_xml(self, req, fields, crashes, limit):
+        out = io.BytesIO()
+        writer = XMLGenerator(out, 'utf-8')
+
+        def flush():
+            data = out.getvalue()
+            out.seek(0)
+            out.truncate()
+            return data
+
+        writer.startDocument()
+        writer.startElement('crashlist', {})
+        writer.ignorableWhitespace('\r\n')
+        num = 0
+        last_id = None
+        for crash_id, values, tickets, files in crashes:
+            uuid = values['uuid']
+            writer.startElement('crash', OrderedDict([ ('id', str(crash_id)), ('uuid', uuid),
+                                                       ('url', req.href('crash', uuid)),
+                                                       ('xmlreport', req.href('crash', uuid, 'xml')),
+                                                       ('rawfile', req.href('crash', uuid, 'raw')) ]))
+            writer.ignorableWhitespace('\r\n')
+            for field in fields:
+                if field['name'] == 'uuid':
                     continue
-                field_type = field['type']
-                field_value = crashobj[field_name]
-                if field_type == 'time':
-                    field_value = str(to_utimestamp(field_value))
-
-                body = body + '<%s type=\"%s\">' % (field_name, field_type)
-                if field_value is not None:
-                    #print('%s=%s' % (field_name, field_value))
-                    body = body + escape(field_value)
-                body = body + '</%s>\r\n' % (field_name)
-            body = body + '<linked_tickets>\r\n'
-            for tkt in crashobj.linked_tickets:
-                body = body + '<ticket id=\"%i\" url=\"%s\">\r\n' % (tkt, req.href.ticket(tkt))
-                body = body + '</ticket>\r\n'
-            body = body + '</linked_tickets>\r\n'
-            body = body + '</crash>\r\n'
-        body = body + '</crashlist>\r\n'
-        return self._success_response(req, body=body.encode('utf-8'), headers=headers)
+                writer.startElement(field['name'], { 'type': field['type'] })
+                value = self._crashlist_value(field, values)
+                if value is not None:
+                    writer.characters(value)
+                writer.endElement(field['name'])
+                writer.ignorableWhitespace('\r\n')
+            writer.startElement('linked_tickets', {})
+            writer.ignorableWhitespace('\r\n')
+            for tkt in tickets:
+                writer.startElement('ticket', OrderedDict([ ('id', str(tkt)), ('url', req.href.ticket(tkt)) ]))
+                writer.endElement('ticket')
+                writer.ignorableWhitespace('\r\n')
+            writer.endElement('linked_tickets')
+            writer.ignorableWhitespace('\r\n')
+            writer.startElement('files', {})
+            writer.ignorableWhitespace('\r\n')
+            for name, info in sorted(files.items()):
+                writer.startElement('file', OrderedDict([ ('field', name), ('size', str(info['size'])),
+                                                          ('sha256', info['sha256']) ]))
+                writer.endElement('file')
+                writer.ignorableWhitespace('\r\n')
+            writer.endElement('files')
+            writer.ignorableWhitespace('\r\n')
+            writer.endElement('crash')
+            writer.ignorableWhitespace('\r\n')
+            num += 1
+            last_id = crash_id
+            yield flush()
+        if limit and num == limit:
+            writer.startElement('next', { 'cursor': str(last_id) })
+            writer.endElement('next')
+            writer.ignorableWhitespace('\r\n')
+        writer.endElement('crashlist')
+        writer.ignorableWhitespace('\r\n')
+        writer.endDocument()
+        yield flush()
+
+    def _iter_crashlist_json(self, req, fields, crashes, limit):
+        yield '{"crashes": ['
+        num = 0
+        last_id = None
+        for crash_id, values, tickets, files in crashes:
+            uuid = values['uuid']
+            crash = { 'id': crash_id, 'uuid': uuid,
+                      'url': req.href('crash', uuid),
+                      'xmlreport': req.href('crash', uuid, 'xml'),
+                      'rawfile': req.href('crash', uuid, 'raw'),
+                      'fields': dict((field['name'], self._crashlist_value(field, values))
+                                     for field in fields if field['name'] != 'uuid'),
+                      'linked_tickets': [ { 'id': tkt, 'url': req.href.ticket(tkt) } for tkt in tickets ],
+                      'files': files }
+            yield (',\r\n' if num else '\r\n') + json.dumps(crash)
+            num += 1
+            last_id = crash_id
+        yield '\r\n], "next": %s}\r\n' % (json.dumps(last_id) if limit and num == limit else 'null')
 
     # ITemplateProvider methods
     def get_htdocs_dirs(self):
@@ -943,10 +1941,7 @@ application was running as part of %(productname)s (%(productcodename)s) version
 
     def _get_total_upload_size(self, req):
         ret = 0
-        files_fields = ['minidump', 'minidumpreport', 'minidumpreportxml', 'minidumpreporthtml',
-                        'coredump', 'coredumpreport', 'coredumpreportxml', 'coredumpreporthtml']
-
-        for name in files_fields:
+        for name in self.upload_file_fields:
             file = req.args.get(name) if name in req.args else None
             if file is None:
                 continue
@@ -960,6 +1955,18 @@ application was running as part of %(productname)s (%(productcodename)s) version
             ret = ret + size
         return ret
 
+    def _get_crash_dir_name(self, uuid):
+        """Return the directory for the files of a crash relative to the dump
+        data directory: the directory of the crash if it has already been
+        stored in another layout, otherwise its directory in the configured
+        layout."""
+        for layout in storage_layouts:
+            if layout != self.storage_layout:
+                name = crash_dir_name(uuid, layout)
+                if os.path.isdir(os.path.join(self.env.path, self.dumpdata_dir, name)):
+                    return name
+        return crash_dir_name(uuid, self.storage_layout)
+
     def _store_dump_file(self, uuid, req, name, force):
         item_name = None
         ret = False
@@ -970,8 +1977,8 @@ application was running as part of %(productname)s (%(productcodename)s) version
         else:
             filename = file.filename
             fileobj = file.file
-            item_name = os.path.join(str(uuid), filename)
-            crash_dir = os.path.join(self.env.path, self.dumpdata_dir, str(uuid))
+            item_name = os.path.join(self._get_crash_dir_name(uuid), filename)
+            crash_dir = os.path.join(self.env.path, self.dumpdata_dir, os.path.dirname(item_name))
             crash_file = os.path.join(crash_dir, filename)
             self.log.debug('_store_dump_file env.path %s' % (self.env.path))
             self.log.debug('_store_dump_file self.dumpdata_dir %s' % (self.dumpdata_dir))
@@ -982,40 +1989,63 @@ application was running as part of %(productname)s (%(productcodename)s) version
             if not os.path.isdir(crash_dir):
                 os.makedirs(crash_dir)
 
-            flags = os.O_CREAT + os.O_WRONLY
-            flags += os.O_TRUNC
-            #if force:
-                #flags += os.O_TRUNC
-            #else:
-                #if os.path.isfile(crash_file):
-                    #errmsg = 'File %s already exists.' % crash_file
-                    #return (False, item_name, errmsg)
-                #flags += os.O_EXCL
-            if hasattr(os, 'O_BINARY'):
-                flags += os.O_BINARY
-            targetfileobj = None
-            try:
-                targetfileobj = os.fdopen(os.open(crash_file, flags, 0660), 'w')
-            except OSError as e:
-                errmsg = str(e)
-            except IOError as e:
-                errmsg = str(e)
-
-            if targetfileobj is None:
-                ret = False
-                if errmsg is None:
-                    errmsg = 'Cannot open file %s.' % crash_file
-            else:
+            # file parts sent with a Content-Encoding are stored as they are,
+            # since compressed dump files are supported transparently
+            part_method = None
+            part_headers = getattr(file, 'headers', None)
+            coding = part_headers.get('content-encoding') if part_headers is not None else None
+            if coding:
+                part_method = content_encoding_method(coding)
+                if part_method is None:
+                    return (False, item_name, 'Content-Encoding %s of field %s not supported' % (coding, name))
+            target_file = crash_file + compression_suffix(part_method)
+
+            # the new file is always renamed into place, so readers see
+            # either the old or the new file but never a partial one
+            upload_path = getattr(fileobj, 'upload_path', None)
+            if upload_path is not None:
+                # the upload has been streamed into the staging directory, so
+                # just move it into place instead of copying all the data.
                 try:
-                    shutil.copyfileobj(fileobj, targetfileobj)
+                    fileobj.flush()
+                    os.chmod(upload_path, 0660)
+                    os.rename(upload_path, target_file)
                     ret = True
                 except OSError as e:
+                    self.log.debug('_store_dump_file cannot move %s to %s: %s' % (upload_path, target_file, e))
+                    fileobj.seek(0)
+
+            if not ret:
+                tmpname = None
+                try:
+                    fd, tmpname = tempfile.mkstemp(prefix='.upload-', dir=crash_dir)
+                    with os.fdopen(fd, 'wb') as targetfileobj:
+                        shutil.copyfileobj(fileobj, targetfileobj)
+                    os.chmod(tmpname, 0660)
+                    os.rename(tmpname, target_file)
+                    ret = True
+                except (OSError, IOError) as e:
                     errmsg = str(e)
-                except IOError as e:
-                    errmsg = str(e)
+                    if tmpname is not None and os.path.isfile(tmpname):
+                        os.remove(tmpname)
+
+            if ret:
+                # get rid of any older (compressed) version of this file
+                remove_dump_file(crash_file, keep=target_file)
+                if part_method is None:
+                    errmsg = self._compress_dump_file(crash_file)
         return (ret, item_name, errmsg)
 
+    def _compress_dump_file(self, crash_file):
+        if self.compression == 'none':
+            return None
+        try:
+            compress_dump_file(crash_file, self.compression)
+        except (IOError, OSError) as e:
+            # keep the uncompressed file
+            self.log.warning('Failed to compress %s: %s' % (crash_file, e))
+        return None
+
     def _get_dump_filename(self, crashobj, name):
         item_name = crashobj[name]
-        crash_file = os.path.join(self.env.path, self.dumpdata_dir, item_name)
-        return crash_file
+        return CrashDumpRetention(self.env).dump_file_path(item_name)
@@ -4,7 +4,8 @@
 
 import unittest
 
-from crashdump.tests import api, web_ui, model
+from crashdump.tests import api, web_ui, model, submit, storage, admission, admin, retention, jobs, scrub, \
+    stackcodec, fulltext
 
 
 def test_suite():
@@ -12,6 +13,15 @@ def test_suite():
     suite.addTest(api.test_suite())
     suite.addTest(web_ui.test_suite())
     suite.addTest(model.test_suite())
+    suite.addTest(submit.test_suite())
+    suite.addTest(storage.test_suite())
+    suite.addTest(admission.test_suite())
+    suite.addTest(admin.test_suite())
+    suite.addTest(retention.test_suite())
+    suite.addTest(jobs.test_suite())
+    suite.addTest(scrub.test_suite())
+    suite.addTest(stackcodec.test_suite())
+    suite.addTest(fulltext.test_suite())
 
     return suite
 
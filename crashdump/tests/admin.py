@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from uuid import uuid4
+
+from trac.test import EnvironmentStub
+from trac.util.datefmt import to_utimestamp, utc
+
+from crashdump.admin import CrashDumpAdmin
+from crashdump.model import CrashDump
+from crashdump.storage import find_dump_file, lock_crash
+from crashdump.tests.model import test_xml_report
+
+
+class CrashDumpAdminTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'crashdump.*'])
+        self.env.path = tempfile.mkdtemp()
+        self.dumpdata_dir = os.path.join(self.env.path, 'dumpdata')
+        self.env.config.set('crashdump', 'dumpdata_dir', self.dumpdata_dir)
+        self.env.upgrade()
+        self.admin = CrashDumpAdmin(self.env)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    def _insert_crash(self, xml=None):
+        crash = CrashDump(env=self.env, uuid=str(uuid4()), must_exist=False)
+        crash.insert()
+        if xml is not None:
+            item_name = 'crash%i.xml' % crash.id
+            if not os.path.isdir(self.dumpdata_dir):
+                os.mkdir(self.dumpdata_dir)
+            with open(os.path.join(self.dumpdata_dir, item_name), 'w') as f:
+                f.write(xml)
+            self.env.db_transaction("UPDATE crashdump SET minidumpreportxmlfile=%s WHERE id=%s",
+                                    (item_name, crash.id))
+        return crash.id
+
+    def test_backfill(self):
+        self.admin.backfill_batch_size = 2
+        ids = [self._insert_crash(test_xml_report), self._insert_crash(),
+               self._insert_crash('<broken'), self._insert_crash(test_xml_report)]
+        self.admin._do_backfill('resume', '2')
+        rows = self.env.db_query("SELECT id, exceptionmodule, threadcount FROM crashdump ORDER BY id")
+        self.assertEqual([(ids[0], 'app.exe', 3), (ids[1], None, None),
+                          (ids[2], None, None), (ids[3], 'app.exe', 3)], rows)
+        self.assertEqual(ids[-1], self.admin._get_backfill_checkpoint())
+
+        # resuming only looks at crashes added since the last run
+        self.env.db_transaction("UPDATE crashdump SET threadcount=NULL")
+        new_id = self._insert_crash(test_xml_report)
+        self.admin._do_backfill()
+        rows = self.env.db_query("SELECT id FROM crashdump WHERE threadcount IS NOT NULL")
+        self.assertEqual([(new_id,)], rows)
+
+        self.admin._do_backfill('restart')
+        rows = self.env.db_query("SELECT id FROM crashdump WHERE threadcount IS NOT NULL ORDER BY id")
+        self.assertEqual([(ids[0],), (ids[3],), (new_id,)], rows)
+
+    def test_backfill_archived_file(self):
+        archive_dir = os.path.join(self.env.path, 'archive')
+        self.env.config.set('crashdump', 'archive_dir', archive_dir)
+        crashid = self._insert_crash(test_xml_report)
+        item_name = os.path.join('archived', 'crash.dmp')
+        os.makedirs(os.path.join(archive_dir, 'archived'))
+        with open(os.path.join(archive_dir, item_name), 'w') as f:
+            f.write('MDMP' * 4)
+        self.env.db_transaction("UPDATE crashdump SET minidumpfile=%s WHERE id=%s", (item_name, crashid))
+        self.admin.backfill()
+        self.assertEqual([(16,)], self.env.db_query("SELECT dumpsize FROM crashdump WHERE id=%s", (crashid,)))
+        self.assertEqual([(item_name, 16)],
+                         self.env.db_query("SELECT name, size FROM crashdump_file "
+                                           "WHERE crash=%s AND field='minidumpfile'", (crashid,)))
+
+    def test_purge(self):
+        old = datetime(2020, 1, 1, tzinfo=utc)
+        new = datetime(2021, 1, 1, tzinfo=utc)
+        ids = [self._insert_crash(test_xml_report) for i in range(5)]
+        self.env.db_transaction("UPDATE crashdump SET crashtime=%s", (to_utimestamp(old),))
+        self.env.db_transaction("UPDATE crashdump SET crashtime=%s WHERE id=%s", (to_utimestamp(new), ids[-1]))
+        for crashid in ids:
+            self.env.db_transaction("INSERT INTO crashdump_ticket (crash, ticket) VALUES (%s, 1)", (crashid,))
+            self.env.db_transaction("INSERT INTO crashdump_stack (crash, threadid, frameno) VALUES (%s, 1, 0)", (crashid,))
+
+        # an interrupted purge resumes after the last completed batch
+        calls = []
+        def interrupt(result):
+            calls.append(dict(result))
+            raise KeyboardInterrupt
+        self.assertRaises(KeyboardInterrupt, CrashDump.purge_old_data, self.env, self.dumpdata_dir,
+                          datetime(2020, 6, 1, tzinfo=utc), batch_size=2, progress=interrupt)
+        self.assertEqual([{'crashes': 2, 'files': 2, 'bytes': 2 * len(test_xml_report), 'failed': 0}], calls)
+        self.assertEqual(ids[2:], [crashid for crashid, in self.env.db_query("SELECT id FROM crashdump ORDER BY id")])
+
+        result = CrashDump.purge_old_data(self.env, self.dumpdata_dir, datetime(2020, 6, 1, tzinfo=utc),
+                                          batch_size=2, jobs=2)
+        self.assertEqual({'crashes': 2, 'files': 2, 'bytes': 2 * len(test_xml_report), 'failed': 0}, result)
+        self.assertEqual([(ids[-1],)], self.env.db_query("SELECT id FROM crashdump"))
+        self.assertEqual([(ids[-1],)], self.env.db_query("SELECT crash FROM crashdump_ticket"))
+        self.assertEqual([(ids[-1],)], self.env.db_query("SELECT crash FROM crashdump_stack"))
+        self.assertEqual(['crash%i.xml' % ids[-1]], os.listdir(self.dumpdata_dir))
+        self.assertEqual([], self.env.db_query("SELECT value FROM system WHERE name='crashdump_purge'"))
+
+        self.admin._do_purge('2022-01-01T00:00:00Z', 'crashtime', 'restart', '1')
+        self.assertEqual([], self.env.db_query("SELECT id FROM crashdump"))
+
+
+    def test_compress(self):
+        crashid = self._insert_crash(test_xml_report)
+        uuid = CrashDump.find_by_id(self.env, crashid).uuid
+        path = os.path.join(self.dumpdata_dir, 'crash%i.xml' % crashid)
+        results = []
+        worker = threading.Thread(target=lambda: results.append(self.admin.compress('gzip')))
+        with lock_crash(self.dumpdata_dir, uuid):
+            worker.start()
+            # the files of a locked crash are left alone
+            worker.join(0.5)
+            self.assertTrue(worker.is_alive())
+            self.assertTrue(os.path.exists(path))
+        worker.join(5)
+        self.assertEqual(1, results[0][0])
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual((path + '.gz', 'gzip'), find_dump_file(path))
+
+    def test_migrate_layout(self):
+        archive_dir = os.path.join(self.env.path, 'archive')
+        self.env.config.set('crashdump', 'archive_dir', archive_dir)
+        crash = CrashDump(env=self.env, uuid=str(uuid4()), must_exist=False)
+        crash.insert()
+        uuid = str(crash.uuid)
+        for root, name in ((self.dumpdata_dir, 'report.xml'), (archive_dir, 'minidump.dmp')):
+            os.makedirs(os.path.join(root, uuid))
+            with open(os.path.join(root, uuid, name), 'w') as f:
+                f.write(name)
+        self.env.db_transaction("UPDATE crashdump SET minidumpreportxmlfile=%s, minidumpfile=%s WHERE id=%s",
+                                (os.path.join(uuid, 'report.xml'), os.path.join(uuid, 'minidump.dmp'), crash.id))
+
+        self.admin.migrate_batch_size = 1
+        self.assertEqual((1, 1), self.admin.migrate_layout('sharded', 2))
+        sharded = os.path.join(uuid[0:2], uuid[2:4], uuid)
+        self.assertEqual([(os.path.join(sharded, 'report.xml'), os.path.join(sharded, 'minidump.dmp'))],
+                         self.env.db_query("SELECT minidumpreportxmlfile, minidumpfile FROM crashdump"))
+        self.assertTrue(os.path.isfile(os.path.join(self.dumpdata_dir, sharded, 'report.xml')))
+        self.assertTrue(os.path.isfile(os.path.join(archive_dir, sharded, 'minidump.dmp')))
+        self.assertFalse(os.path.exists(os.path.join(self.dumpdata_dir, uuid)))
+        self.assertFalse(os.path.exists(os.path.join(archive_dir, uuid)))
+
+        # and back, removing the empty shard directories
+        self.assertEqual((1, 1), self.admin.migrate_layout('flat'))
+        self.assertEqual([(os.path.join(uuid, 'report.xml'),)],
+                         self.env.db_query("SELECT minidumpreportxmlfile FROM crashdump"))
+        self.assertFalse(os.path.exists(os.path.join(self.dumpdata_dir, uuid[0:2])))
+        self.assertEqual((1, 0), self.admin.migrate_layout('flat'))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CrashDumpAdminTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import unittest
+
+from crashdump.admission import AdmissionController, AdmissionRejected
+
+
+class AdmissionControllerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.controller = AdmissionController(clock=lambda: self.now)
+
+    def test_concurrency_limit(self):
+        self.controller.max_concurrent = 2
+        first = self.controller.admit([])
+        self.controller.admit([])
+        self.assertRaises(AdmissionRejected, self.controller.admit, [])
+        first.release()
+        first.release()
+        self.assertEqual(1, self.controller.concurrent)
+        self.controller.admit([])
+
+    def test_inflight_bytes(self):
+        self.controller.max_inflight_bytes = 1000
+        # a single large upload is accepted if nothing else is in flight
+        large = self.controller.admit([], 5000)
+        self.assertRaises(AdmissionRejected, self.controller.admit, [], 10)
+        large.release()
+        self.controller.admit([], 600)
+        self.assertRaises(AdmissionRejected, self.controller.admit, [], 600)
+        self.assertEqual(600, self.controller.inflight_bytes)
+
+    def test_rate_limit(self):
+        limits = [('host:a', 0.5, 2)]
+        self.controller.admit(limits).release()
+        self.controller.admit(limits).release()
+        try:
+            self.controller.admit(limits)
+            self.fail('AdmissionRejected not raised')
+        except AdmissionRejected as e:
+            self.assertAlmostEqual(2.0, e.retry_after)
+        # other clients are not affected
+        self.controller.admit([('host:b', 0.5, 2)]).release()
+        self.now += 2.0
+        self.controller.admit(limits).release()
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(AdmissionControllerTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
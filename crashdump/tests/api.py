@@ -5,13 +5,17 @@
 import shutil
 import tempfile
 import unittest
+from datetime import datetime
 
 from trac.core import Component, implements
 from trac.db.api import DatabaseManager
 #from trac.db.schema import Table, Column, Index
-from trac.test import EnvironmentStub
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+from trac.util.datefmt import utc
 
 from crashdump.api import CrashDumpSystem
+from crashdump.model import CrashDump, CrashDumpStackFrame
 
 
 class CrashDumpSystemEnvOkTestCase(unittest.TestCase):
@@ -51,6 +55,63 @@ class CrashDumpSystemEnvOkTestCase(unittest.TestCase):
         assert_field_exists(self, fields, 'minidumpreporthtmlfile')
         assert_field_exists(self, fields, 'minidumpreporttextfile')
 
+    def test_close_crash_with_last_ticket(self):
+        self.env.upgrade()
+        crash = CrashDump(env=self.env, uuid='67cbc89f-1001-4691-a2c2-c1bb40aac800', must_exist=False)
+        crash['status'] = 'new'
+        crash.insert()
+        tickets = []
+        for i in range(2):
+            tkt = Ticket(self.env)
+            tkt['summary'] = 'crash'
+            tkt['reporter'] = 'joe'
+            tkt['status'] = 'new'
+            tkt['linked_crash'] = str(crash.id)
+            tkt.insert()
+            tickets.append(tkt)
+
+        for i, tkt in enumerate(tickets):
+            tkt = Ticket(self.env, tkt.id)
+            tkt['status'] = 'closed'
+            tkt['resolution'] = 'fixed'
+            tkt.save_changes('joe', 'done')
+            crash = CrashDump(env=self.env, id=crash.id)
+            self.assertEqual('new' if i == 0 else 'closed', crash['status'])
+        self.assertEqual([('fixed',)],
+                         self.env.db_query("SELECT resolution FROM crashdump WHERE id=%s", (crash.id,)))
+        self.assertEqual(['closetime', 'comment', 'resolution', 'status'],
+                         sorted(field for field, in self.env.db_query(
+                                "SELECT field FROM crashdump_change WHERE crash=%s", (crash.id,))))
+
+    def test_search_frames(self):
+        self.env.upgrade()
+        ids = []
+        for i, functions in enumerate([['Foo::bar', 'main'], ['helper', 'Foo::bar', 'main']]):
+            crash = CrashDump(env=self.env, uuid='67cbc89f-1001-4691-a2c2-c1bb40aac80%i' % i, must_exist=False)
+            crash['status'] = 'new'
+            crash['crashtime'] = datetime(2020, 1, 2, tzinfo=utc)
+            ids.append(crash.insert())
+            for frameno, function in enumerate(functions):
+                frame = CrashDumpStackFrame(crash.id, 16, frameno, env=self.env)
+                frame['module'] = 'app.exe'
+                frame['function'] = function
+                frame['source'] = 'main.cpp'
+                frame['line'] = 10 + frameno
+                frame.insert()
+
+        req = MockRequest(self.env)
+        results = list(self.crashdump_sys.get_search_results(req, ['Foo::bar'], ['crashdump']))
+        self.assertEqual(['/trac.cgi/crash/67cbc89f-1001-4691-a2c2-c1bb40aac800',
+                          '/trac.cgi/crash/67cbc89f-1001-4691-a2c2-c1bb40aac801'], sorted(r[0] for r in results))
+        self.assertEqual([], list(self.crashdump_sys.get_search_results(req, ['Foo::bar', 'other.dll'],
+                                                                        ['crashdump'])))
+
+        self.assertEqual([ids[0]], [c.id for c in CrashDump.query(self.env, stack={'function': 'Foo::bar',
+                                                                                   'depth': 1})])
+        self.assertEqual(ids, [c.id for c in CrashDump.query(self.env, stack={'function': 'Foo::bar'})])
+        self.assertEqual(1, CrashDump.query_count(self.env, stack={'source': 'main.cpp', 'line': 12}))
+        self.assertRaises(ValueError, CrashDump.query, self.env, stack={'funcoff': 1})
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from trac.test import EnvironmentStub, MockRequest
+from trac.util.datefmt import utc
+
+from crashdump.api import CrashDumpSystem
+from crashdump.fulltext import CrashDumpFullTextIndex
+from crashdump.model import CrashDump, CrashDumpStackFrame
+
+
+class CrashDumpFullTextIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'crashdump.*'])
+        self.env.path = tempfile.mkdtemp()
+        self.env.upgrade()
+        self.index = CrashDumpFullTextIndex(self.env)
+        if not self.index.available:
+            self.skipTest('SQLite without FTS5')
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    def _insert_crash(self, num, summary, description='', functions=()):
+        crash = CrashDump(env=self.env, uuid='67cbc89f-1001-4691-a2c2-c1bb40aac8%02i' % num, must_exist=False)
+        crash['status'] = 'new'
+        crash['summary'] = summary
+        crash['description'] = description
+        crash['crashtime'] = datetime(2020, 1, 2, tzinfo=utc)
+        crash.insert()
+        for frameno, function in enumerate(functions):
+            frame = CrashDumpStackFrame(crash.id, 16, frameno, env=self.env)
+            frame['module'] = 'app.exe'
+            frame['function'] = function
+            frame.insert()
+        return crash
+
+    def test_ranking(self):
+        body = self._insert_crash(1, 'Other', 'crash in the renderer')
+        title = self._insert_crash(2, 'Renderer crash')
+        self._insert_crash(3, 'Unrelated')
+        self.assertEqual([title.id, body.id], self.index.search(['renderer']))
+        self.assertEqual([title.id, body.id], self.index.search(['rend']))
+        self.assertEqual([title.id], self.index.search(['renderer', 'crash'], limit=1))
+        self.assertEqual([], self.index.search(['renderer', 'missing']))
+        self.assertEqual([], self.index.search(['"*']))
+
+    def test_update(self):
+        crash = self._insert_crash(1, 'Startup crash')
+        crash['summary'] = 'Shutdown crash'
+        crash.save_changes(author='me')
+        self.assertEqual([], self.index.search(['startup']))
+        self.assertEqual([crash.id], self.index.search(['shutdown']))
+
+        with self.env.db_transaction as db:
+            CrashDump.delete_rows(self.env, db, [crash.id])
+        self.assertEqual([], self.index.search(['shutdown']))
+
+    def test_frames_and_rebuild(self):
+        crash = self._insert_crash(1, 'Crash', functions=['Foo::bar', 'main'])
+        # the frames are inserted after the crash, like the upload does
+        self.assertEqual([], self.index.search(['Foo::bar']))
+        self.assertEqual(1, self.index.rebuild())
+        self.assertEqual([crash.id], self.index.search(['Foo::bar']))
+        self.assertEqual([crash.id], self.index.search(['app.exe']))
+
+        req = MockRequest(self.env)
+        results = list(CrashDumpSystem(self.env).get_search_results(req, ['Foo::bar'], ['crashdump']))
+        self.assertEqual(['/trac.cgi/crash/67cbc89f-1001-4691-a2c2-c1bb40aac801'], [r[0] for r in results])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CrashDumpFullTextIndexTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from trac.core import Component, implements
+from trac.test import EnvironmentStub
+from trac.util.datefmt import to_utimestamp, utc
+
+from crashdump.jobs import CrashDumpJobRunner, IMaintenanceJobProvider
+from crashdump.model import CrashDump
+
+
+class TestJobProvider(Component):
+    implements(IMaintenanceJobProvider)
+
+    def get_maintenance_jobs(self):
+        yield ('test', 'Test job')
+
+    def get_scheduled_job_args(self, name):
+        return ['scheduled']
+
+    def run_maintenance_job(self, name, args, job):
+        if args and args[0] == 'cancel':
+            CrashDumpJobRunner(self.env).cancel(job.id)
+        job.progress('Halfway', 50)
+        return 'Done %s' % ' '.join(args)
+
+
+class CrashDumpJobRunnerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'crashdump.*', TestJobProvider])
+        self.env.path = tempfile.mkdtemp()
+        self.env.config.set('crashdump', 'dumpdata_dir', os.path.join(self.env.path, 'dumpdata'))
+        self.env.config.set('crashdump', 'job_poll_interval', '0')
+        self.env.upgrade()
+        self.runner = CrashDumpJobRunner(self.env)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    def _get_job(self, job_id):
+        for job in self.runner.get_jobs():
+            if job['id'] == job_id:
+                return job
+
+    def test_run(self):
+        job_id = self.runner.submit('test', ['a', 'b'], author='admin')
+        self.assertEqual('queued', self._get_job(job_id)['status'])
+        self.assertEqual(1, self.runner.run_pending())
+        job = self._get_job(job_id)
+        self.assertEqual('done', job['status'])
+        self.assertEqual('Done a b', job['message'])
+        self.assertEqual(50, job['progress'])
+        self.assertEqual(['a', 'b'], job['args'])
+        self.assertEqual('admin', job['author'])
+        self.assertEqual(0, self.runner.run_pending())
+
+    def test_cancel(self):
+        queued_id = self.runner.submit('test')
+        self.assertTrue(self.runner.cancel(queued_id))
+        self.assertEqual('cancelled', self._get_job(queued_id)['status'])
+        self.assertFalse(self.runner.cancel(queued_id))
+
+        running_id = self.runner.submit('test', ['cancel'])
+        self.assertEqual(1, self.runner.run_pending())
+        job = self._get_job(running_id)
+        self.assertEqual('cancelled', job['status'])
+        self.assertEqual('Halfway', job['message'])
+
+    def test_schedule(self):
+        self.env.config.set('crashdump-schedule', 'test', '24')
+        now = datetime.now(utc)
+        job_ids = self.runner.schedule(now)
+        self.assertEqual(['test'], [self._get_job(job_id)['name'] for job_id in job_ids])
+        self.assertEqual(['scheduled'], self._get_job(job_ids[0])['args'])
+        # not due again before the interval has passed
+        self.assertEqual([], self.runner.schedule(now + timedelta(hours=1)))
+        self.assertEqual(1, len(self.runner.schedule(now + timedelta(hours=25))))
+        # a process which checked the schedule before does not queue the
+        # job a second time
+        due = to_utimestamp(now - timedelta(hours=24))
+        self.assertIsNone(self.runner._submit_scheduled('test', ['scheduled'], due))
+
+    def test_finish_stale_job(self):
+        job_id = self.runner.submit('test')
+        job = self.runner._claim_next_job()
+        self.assertEqual(job_id, job.id)
+        self.env.db_transaction("UPDATE crashdump_job SET status='failed', message='Interrupted' WHERE id=%s",
+                                (job_id,))
+        self.runner._finish(job, 'done', 'Done')
+        job = self._get_job(job_id)
+        self.assertEqual('failed', job['status'])
+        self.assertEqual('Interrupted', job['message'])
+
+    def test_reloaded_environment_worker(self):
+        self.env.config.set('crashdump', 'job_poll_interval', '1')
+        other_env = EnvironmentStub(enable=['trac.*', 'crashdump.*', TestJobProvider])
+        other_env.path = self.env.path
+        other_env.config.set('crashdump', 'job_poll_interval', '1')
+        other_runner = CrashDumpJobRunner(other_env)
+        # keep the workers off the database shared by both environments
+        for runner in (self.runner, other_runner):
+            runner.schedule = lambda: None
+            runner.run_pending = lambda: None
+        self.runner._start_worker()
+        try:
+            other_runner._start_worker()
+            # the runner of the old environment stops looping
+            self.runner._worker.join(5)
+            self.assertFalse(self.runner._worker.is_alive())
+            self.assertTrue(other_runner._worker.is_alive())
+        finally:
+            self.runner.stop()
+            other_runner.stop()
+        other_runner._worker.join(5)
+        self.assertFalse(other_runner._worker.is_alive())
+        other_env.shutdown()
+
+    def test_purge_job(self):
+        now = datetime.now(utc)
+        for days in (10, 400):
+            crash = CrashDump(env=self.env, uuid=str(uuid4()), must_exist=False)
+            crash.insert(when=now - timedelta(days=days))
+        threshold = now - timedelta(days=365)
+        job_id = self.runner.submit('purge', [str(to_utimestamp(threshold)), 'uploadtime'])
+        self.runner.run_pending()
+        job = self._get_job(job_id)
+        self.assertEqual('done', job['status'])
+        self.assertEqual(1, CrashDump.query_count(self.env))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CrashDumpJobRunnerTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
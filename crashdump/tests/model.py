@@ -2,18 +2,53 @@
 # -*- coding: utf-8 -*-
 # kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
 
+import hashlib
+import os
 import shutil
 import tempfile
 import unittest
+from datetime import datetime
 
 from trac.core import Component, implements
 from trac.db.api import DatabaseManager
 #from trac.db.schema import Table, Column, Index
 from trac.test import EnvironmentStub
 from trac.resource import ResourceNotFound
+from trac.util.datefmt import utc
+from trac.util.text import empty
 
+from crashdump.api import CrashDumpSystem
 from crashdump.web_ui import CrashDumpModule
-from crashdump.model import CrashDump
+from crashdump.model import CrashDump, CrashDumpRow, report_summary, report_modules, report_stacks, \
+    file_size_summary
+from crashdump.xmlreport import XMLReport
+
+# minimal XML report with an exception in thread 0x10
+test_xml_report = '''<?xml version="1.0" encoding="UTF-8"?>
+<crash_dump>
+  <system_info><platform_type type="QString">Win32</platform_type></system_info>
+  <exception>
+    <threadid type="uint">10</threadid>
+    <code type="uint">c0000005</code>
+    <address type="qulonglong">7ff612340000</address>
+  </exception>
+  <modules>
+    <module><name type="QString">C:\\app\\app.exe</name></module>
+    <module><name type="QString">C:\\Windows\\ntdll.dll</name></module>
+  </modules>
+  <threads>
+    <thread><id type="uint">10</id></thread>
+    <thread><id type="uint">11</id></thread>
+    <thread><id type="uint">12</id></thread>
+  </threads>
+  <stackdumps>
+    <stackdump threadid="0x10">
+      <frame><module type="QString">app.exe</module><function type="QString">crash_here</function></frame>
+      <frame><module type="QString">app.exe</module><function type="QString">main</function></frame>
+    </stackdump>
+  </stackdumps>
+</crash_dump>
+'''
 
 
 class CrashDumpModelTestCase(unittest.TestCase):
@@ -77,6 +112,247 @@ class CrashDumpModelTestCase(unittest.TestCase):
                           CrashDump, id='42', env=self.env)
 
 
+    def test_report_summary(self):
+        dumpdata_dir = os.path.join(self.env.path, 'dumpdata')
+        os.mkdir(dumpdata_dir)
+        with open(os.path.join(dumpdata_dir, 'report.xml'), 'w') as f:
+            f.write(test_xml_report)
+        with open(os.path.join(dumpdata_dir, 'crash.dmp'), 'w') as f:
+            f.write('MDMP' * 100)
+
+        summary = report_summary(XMLReport(os.path.join(dumpdata_dir, 'report.xml')))
+        self.assertEqual(0xc0000005, summary['exceptioncode'])
+        self.assertEqual('0x7ff612340000', summary['exceptionaddress'])
+        self.assertEqual('app.exe', summary['exceptionmodule'])
+        self.assertEqual('crash_here', summary['exceptionfunction'])
+        self.assertEqual(3, summary['threadcount'])
+        self.assertEqual(2, summary['modulecount'])
+
+        # the simplified stack of the exception thread is preferred
+        simplified = '''<stackdump threadid="0x10" simplified="true">
+      <frame><module type="QString">app.exe</module><function type="QString">handle_request</function></frame>
+    </stackdump>
+  </stackdumps>'''
+        with open(os.path.join(dumpdata_dir, 'simplified.xml'), 'w') as f:
+            f.write(test_xml_report.replace('</stackdumps>', simplified))
+        summary = report_summary(XMLReport(os.path.join(dumpdata_dir, 'simplified.xml')))
+        self.assertEqual('handle_request', summary['exceptionfunction'])
+
+        sizes = file_size_summary(dumpdata_dir, {'minidumpfile': 'crash.dmp',
+                                                 'minidumpreportxmlfile': 'report.xml',
+                                                 'coredumpfile': 'missing.core'})
+        self.assertEqual(400, sizes['dumpsize'])
+        self.assertEqual(len(test_xml_report), sizes['reportsize'])
+
+        crash = self._insert_crashdump(exceptionmodule='app.exe', threadcount=3)
+        self.assertEqual([(crash.id,)],
+                         self.env.db_query("SELECT id FROM crashdump WHERE exceptionmodule=%s", ('app.exe',)))
+        self.assertEqual(3, CrashDump(id=crash.id, env=self.env)['threadcount'])
+
+    def test_save_changes(self):
+        crash = self._insert_crashdump(uuid='67cbc89f-1001-4691-a2c2-c1bb40aac800', status='new')
+        crash = CrashDump(id=crash.id, env=self.env)
+        crash['status'] = 'closed'
+        crash['resolution'] = 'fixed'
+        when = datetime(2020, 1, 2, tzinfo=utc)
+        self.assertEqual(1, crash.save_changes('joe', 'closing', when=when))
+        self.assertEqual([('comment', '1', 'closing'), ('resolution', None, 'fixed'), ('status', 'new', 'closed')],
+                         sorted(self.env.db_query("SELECT field, oldvalue, newvalue FROM crashdump_change WHERE crash=%s",
+                                                  (crash.id,))))
+        self.assertEqual([('closed', 'fixed')],
+                         self.env.db_query("SELECT status, resolution FROM crashdump WHERE id=%s", (crash.id,)))
+        crash = CrashDump(id=crash.id, env=self.env)
+        self.assertEqual(when, crash['changetime'])
+
+        self.assertFalse(crash.save_changes('joe'))
+        crash['summary'] = 'new summary'
+        self.assertEqual(2, crash.save_changes('joe'))
+
+    def test_delete(self):
+        crash = self._insert_crashdump(uuid='67cbc89f-1001-4691-a2c2-c1bb40aac800', status='new')
+        crash = CrashDump(id=crash.id, env=self.env)
+        crash['status'] = 'closed'
+        crash.save_changes('joe')
+        self.env.db_transaction("INSERT INTO crashdump_ticket (crash, ticket) VALUES (%s, 1)", (crash.id,))
+        self.env.db_transaction("CREATE TABLE crashdump_custom (crash integer, name text, value text)")
+        self.env.db_transaction("INSERT INTO crashdump_custom (crash, name, value) VALUES (%s, 'foo', 'bar')", (crash.id,))
+        dumpdata_dir = os.path.join(self.env.path, 'dumpdata')
+        archive_dir = os.path.join(self.env.path, 'archive')
+        archived_dir = os.path.join(archive_dir, str(crash.uuid), 'symbols')
+        os.makedirs(archived_dir)
+        with open(os.path.join(archived_dir, 'extra.txt'), 'wb') as f:
+            f.write('extra')
+        self.assertTrue(crash.delete(dumpdata_dir, archive_dir))
+        for table in ('crashdump_change', 'crashdump_custom', 'crashdump_ticket'):
+            self.assertEqual([], self.env.db_query("SELECT * FROM %s" % table))
+        self.assertIsNone(CrashDump.find_by_id(self.env, crash.id))
+        self.assertEqual([], os.listdir(archive_dir))
+
+    def test_file_info(self):
+        dumpdata_dir = os.path.join(self.env.path, 'dumpdata')
+        crash = CrashDump(env=self.env, uuid='67cbc89f-1001-4691-a2c2-c1bb40aac800', must_exist=False)
+        crash['status'] = 'new'
+        crash['productname'] = 'app'
+        crash['minidumpfile'] = '67cbc89f-1001-4691-a2c2-c1bb40aac800/a.dmp'
+        crash.insert(when=datetime(2020, 1, 15, tzinfo=utc))
+        os.makedirs(os.path.join(dumpdata_dir, '67cbc89f-1001-4691-a2c2-c1bb40aac800'))
+        with open(os.path.join(dumpdata_dir, crash['minidumpfile']), 'wb') as f:
+            f.write('MDMP' * 4)
+        files = CrashDump.file_info(dumpdata_dir, crash.values)
+        self.assertEqual(['minidumpfile'], list(files))
+        self.assertEqual((crash['minidumpfile'], 16, hashlib.sha256('MDMP' * 4).hexdigest()), files['minidumpfile'])
+        with self.env.db_transaction as db:
+            CrashDump.record_files(db, crash.id, files)
+            CrashDump.record_files(db, crash.id, files)
+        self.assertEqual({'minidumpfile': {'size': 16, 'sha256': hashlib.sha256('MDMP' * 4).hexdigest()}},
+                         crash.get_files())
+        self.assertEqual([('app', datetime(2020, 1, 1, tzinfo=utc), 1, 16)], CrashDump.storage_usage(self.env))
+
+        # the record of a replaced file is ignored
+        crash['minidumpfile'] = '67cbc89f-1001-4691-a2c2-c1bb40aac800/b.dmp'
+        crash.save_changes('joe')
+        self.assertEqual({}, CrashDump(id=crash.id, env=self.env).get_files())
+        self.assertEqual([], CrashDump.storage_usage(self.env))
+
+        self.assertTrue(crash.delete(dumpdata_dir))
+        self.assertEqual([], self.env.db_query("SELECT * FROM crashdump_file"))
+
+    def test_modules(self):
+        xmlfile = os.path.join(self.env.path, 'report.xml')
+        with open(xmlfile, 'w') as f:
+            f.write(test_xml_report)
+        self.assertEqual([('app.exe', ''), ('ntdll.dll', '')], report_modules(XMLReport(xmlfile)))
+
+        ids = []
+        for i in range(3):
+            crash = CrashDump(env=self.env, uuid='67cbc89f-1001-4691-a2c2-c1bb40aac80%i' % i, must_exist=False)
+            crash['status'] = 'new'
+            ids.append(crash.insert())
+        CrashDump.record_modules(self.env, {
+            ids[0]: [('foo.dll', '3.2.1'), ('app.exe', '1.0')],
+            ids[1]: [('foo.dll', '3.2.2'), ('app.exe', '1.0')],
+            ids[2]: [('app.exe', '1.0')],
+            })
+        # shared rows for the same module and version
+        self.assertEqual([(3,)], self.env.db_query("SELECT COUNT(*) FROM crashdump_module_version"))
+        self.assertEqual([('app.exe', '1.0'), ('foo.dll', '3.2.1')], CrashDump(id=ids[0], env=self.env).get_modules())
+
+        self.assertEqual([ids[0]], [c.id for c in CrashDump.query(self.env, module=('foo.dll', '3.2.1'))])
+        self.assertEqual([ids[0], ids[1]], [c.id for c in CrashDump.query(self.env, module='foo.dll')])
+        self.assertEqual(3, CrashDump.query_count(self.env, module='app.exe'))
+        self.assertEqual(0, CrashDump.query_count(self.env, module=('app.exe', '2.0')))
+        self.assertEqual([('3.2.1', 1), ('3.2.2', 1)], CrashDump.module_versions(self.env, 'foo.dll'))
+
+        # replaced on the next upload
+        CrashDump.record_modules(self.env, {ids[0]: [('bar.dll', '1.0')]})
+        self.assertEqual([ids[1]], [c.id for c in CrashDump.query(self.env, module='foo.dll')])
+        self.assertTrue(CrashDump(id=ids[1], env=self.env).delete(os.path.join(self.env.path, 'dumpdata')))
+        self.assertEqual(0, CrashDump.query_count(self.env, module='foo.dll'))
+
+    def test_thread_stacks(self):
+        xmlfile = os.path.join(self.env.path, 'report.xml')
+        with open(xmlfile, 'w') as f:
+            f.write(test_xml_report)
+        stacks = report_stacks(XMLReport(xmlfile))
+        self.assertEqual((1, 2), stacks[:2])
+
+        crash = self._insert_crashdump(uuid='67cbc89f-1001-4691-a2c2-c1bb40aac800', status='new')
+        self.assertIsNone(crash.get_thread_stacks())
+        with self.env.db_transaction as db:
+            CrashDump.record_stacks(db, crash.id, stacks)
+        stored = CrashDump(id=crash.id, env=self.env).get_thread_stacks()
+        self.assertEqual([0x10], [dump.threadid for dump in stored])
+        self.assertEqual(['crash_here', 'main'], [frame.function for frame in stored[0x10].callstack])
+        self.assertTrue(crash.delete(os.path.join(self.env.path, 'dumpdata')))
+        self.assertEqual([], self.env.db_query("SELECT * FROM crashdump_thread_stacks"))
+
+    def test_query(self):
+        ids = []
+        for i in range(6):
+            crash = CrashDump(env=self.env, uuid='67cbc89f-1001-4691-a2c2-c1bb40aac80%i' % i, must_exist=False)
+            crash['status'] = 'closed' if i == 5 else 'new'
+            crash['applicationname'] = 'app%i' % (i % 2)
+            crash['exceptionmodule'] = 'mod%i' % (5 - i)
+            ids.append(crash.insert())
+
+        self.assertEqual(ids[:5], [c.id for c in CrashDump.query(self.env, status='active')])
+        self.assertEqual(5, CrashDump.query_count(self.env, status='active'))
+        self.assertEqual([ids[0], ids[2], ids[4]],
+                         [c.id for c in CrashDump.query(self.env, filters={'applicationname': 'app0'})])
+        self.assertEqual([ids[1], ids[3]],
+                         [c.id for c in CrashDump.query(self.env, filters={'applicationname': ['app1'], 'status': 'new'})])
+        self.assertRaises(ValueError, CrashDump.query, self.env, filters={'no_such_field': 1})
+        self.assertRaises(ValueError, CrashDump.query, self.env, order='id;DROP TABLE crashdump')
+
+        page = CrashDump.query(self.env, order='exceptionmodule', limit=2, offset=2,
+                               fields=['uuid', 'exceptionmodule'])
+        self.assertEqual([ids[3], ids[2]], [c.id for c in page])
+        self.assertEqual(['mod2', 'mod3'], [c['exceptionmodule'] for c in page])
+        self.assertEqual('67cbc89f-1001-4691-a2c2-c1bb40aac803', page[0].uuid)
+        self.assertIsNone(page[0]['applicationname'])
+
+        # keyset pagination gives the same pages as offset pagination
+        after = (page[-1]['exceptionmodule'], page[-1].id)
+        self.assertEqual([ids[1], ids[0]],
+                         [c.id for c in CrashDump.query(self.env, order='exceptionmodule', limit=2, after=after)])
+        self.assertEqual([ids[3], ids[2]],
+                         [c.id for c in CrashDump.query(self.env, desc=True, limit=2, after=ids[4])])
+
+        # crashes with NULL in the sort field are paged as well
+        crash = CrashDump(env=self.env, uuid='67cbc89f-1001-4691-a2c2-c1bb40aac806', must_exist=False)
+        crash['status'] = 'new'
+        ids.append(crash.insert())
+        for desc in (False, True):
+            expected = [c.id for c in CrashDump.query(self.env, order='exceptionmodule', desc=desc)]
+            paged = []
+            after = None
+            while True:
+                page = CrashDump.query(self.env, order='exceptionmodule', desc=desc, limit=2, after=after,
+                                       fields=['exceptionmodule'])
+                if not page:
+                    break
+                paged += [c.id for c in page]
+                after = (page[-1].get_raw('exceptionmodule'), page[-1].id)
+            self.assertEqual(expected, paged)
+        self.assertEqual(3, CrashDump.query_count(self.env, limit=3))
+
+        self.env.db_transaction("INSERT INTO crashdump_ticket (crash, ticket) VALUES (%s, 7)", (ids[1],))
+        crashes = CrashDump.query(self.env, limit=2)
+        CrashDump.prefetch_linked_tickets(self.env, crashes)
+        self.assertEqual([[], [7]], [c.linked_tickets for c in crashes])
+
+    def test_query_rows(self):
+        crash = CrashDump(env=self.env, uuid='67cbc89f-1001-4691-a2c2-c1bb40aac800', must_exist=False)
+        crash['status'] = 'new'
+        crash['crashtime'] = datetime(2020, 1, 2, tzinfo=utc)
+        crash.insert()
+        self.env.db_transaction("INSERT INTO crashdump_ticket (crash, ticket) VALUES (%s, 3)", (crash.id,))
+
+        rows = CrashDump.query(self.env)
+        row = rows[0]
+        self.assertIsInstance(row, CrashDumpRow)
+        self.assertEqual(crash.id, row.id)
+        self.assertEqual('67cbc89f-1001-4691-a2c2-c1bb40aac800', row.uuid)
+        self.assertEqual('new', row['status'])
+        self.assertEqual(datetime(2020, 1, 2, tzinfo=utc), row['crashtime'])
+        self.assertIs(empty, row['summary'])
+        self.assertEqual([3], row.linked_tickets)
+        self.assertRaises(AttributeError, setattr, row, 'status', 'closed')
+
+        # all rows share the schema of the current locale
+        schema = CrashDumpSystem(self.env).get_crash_field_schema()
+        self.assertIs(schema, row.schema)
+        self.assertIs(schema, CrashDump.query(self.env)[0].schema)
+        self.assertRaises(AttributeError, setattr, schema, 'std_fields', ())
+        CrashDumpSystem(self.env).reset_crash_fields()
+        self.assertIsNot(schema, CrashDumpSystem(self.env).get_crash_field_schema())
+
+        full = row.crashdump()
+        self.assertIsInstance(full, CrashDump)
+        full['status'] = 'closed'
+        full.save_changes('joe')
+        self.assertEqual('closed', CrashDump.query(self.env)[0]['status'])
+
 
 def test_suite():
     suite = unittest.TestSuite()
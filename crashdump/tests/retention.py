@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from trac.test import EnvironmentStub
+from trac.util.datefmt import utc
+
+from crashdump import retention as retention_module
+from crashdump.model import CrashDump
+from crashdump.retention import CrashDumpRetention
+from crashdump.storage import find_dump_file
+
+
+class CrashDumpRetentionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'crashdump.*'])
+        self.env.path = tempfile.mkdtemp()
+        self.dumpdata_dir = os.path.join(self.env.path, 'dumpdata')
+        self.archive_dir = os.path.join(self.env.path, 'archive')
+        self.env.config.set('crashdump', 'dumpdata_dir', self.dumpdata_dir)
+        self.env.config.set('crashdump', 'archive_dir', self.archive_dir)
+        self.env.upgrade()
+        self.retention = CrashDumpRetention(self.env)
+        self.now = datetime(2021, 1, 1, tzinfo=utc)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    def _insert_crash(self, days, product='app', status='new'):
+        crash = CrashDump(env=self.env, uuid=str(uuid4()), must_exist=False)
+        crash['productname'] = product
+        crash['status'] = status
+        crash.insert(when=self.now - timedelta(days=days))
+        files = {}
+        for field in ('minidumpfile', 'minidumpreportxmlfile'):
+            item_name = os.path.join(str(crash.uuid), field)
+            path = os.path.join(self.dumpdata_dir, item_name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(field * 10)
+            files[field] = item_name
+        self.env.db_transaction("UPDATE crashdump SET minidumpfile=%s, minidumpreportxmlfile=%s WHERE id=%s",
+                                (files['minidumpfile'], files['minidumpreportxmlfile'], crash.id))
+        return crash.id, files['minidumpfile']
+
+    def test_policy(self):
+        self.env.config.set('crashdump-retention', 'default.archive_days', '30')
+        self.env.config.set('crashdump-retention', 'default.drop_days', '365')
+        self.env.config.set('crashdump-retention', 'closed.status', 'closed')
+        self.env.config.set('crashdump-retention', 'closed.drop_days', '90')
+        self.env.config.set('crashdump-retention', 'myapp.product', 'MyApp')
+        self.env.config.set('crashdump-retention', 'myapp.archive_days', '7')
+        rules = self.retention.get_rules()
+        policy = CrashDumpRetention.get_policy
+        self.assertEqual((30, 365), policy(rules, 'other', 'new'))
+        self.assertEqual((30, 90), policy(rules, 'other', 'closed'))
+        self.assertEqual((7, 365), policy(rules, 'MyApp', 'new'))
+        self.assertEqual((7, 90), policy(rules, 'MyApp', 'closed'))
+        self.assertEqual((None, None), policy([], 'MyApp', 'closed'))
+
+    def test_sweep(self):
+        self.env.config.set('crashdump-retention', 'default.archive_days', '30')
+        self.env.config.set('crashdump-retention', 'default.drop_days', '100')
+        self.env.config.set('crashdump', 'archive_compression', 'gzip')
+        recent, recent_file = self._insert_crash(10)
+        old, old_file = self._insert_crash(50)
+        ancient, ancient_file = self._insert_crash(200)
+
+        result = self.retention.sweep(now=self.now, jobs=2)
+        self.assertEqual(1, result['archived'])
+        self.assertEqual(1, result['dropped'])
+        self.assertEqual(len('minidumpfile' * 10), result['moved'])
+        self.assertEqual(0, result['failed'])
+
+        # the recent dump stays, the old one is looked up in the archive
+        self.assertEqual(os.path.join(self.dumpdata_dir, recent_file),
+                         self.retention.dump_file_path(recent_file))
+        archived = self.retention.dump_file_path(old_file)
+        self.assertEqual(os.path.join(self.archive_dir, old_file), archived)
+        self.assertEqual('gzip', find_dump_file(archived)[1])
+        self.assertFalse(os.path.exists(os.path.join(self.dumpdata_dir, old_file)))
+        # the dropped dump is gone, the report is kept
+        rows = self.env.db_query("SELECT id, minidumpfile, minidumpreportxmlfile, archivetime IS NOT NULL "
+                                 "FROM crashdump ORDER BY id")
+        self.assertEqual([(recent, recent_file, False), (old, old_file, True), (ancient, None, False)],
+                         [(r[0], r[1], bool(r[3])) for r in rows])
+        self.assertTrue(rows[2][2])
+        self.assertFalse(os.path.exists(os.path.join(self.dumpdata_dir, ancient_file)))
+
+        # archived files are not moved again and dropped from the archive
+        result = self.retention.sweep(now=self.now + timedelta(days=60))
+        self.assertEqual((1, 1), (result['archived'], result['dropped']))
+        self.assertEqual([(None,)], self.env.db_query("SELECT minidumpfile FROM crashdump WHERE id=%s", (old,)))
+        self.assertEqual([], os.listdir(os.path.join(self.archive_dir, os.path.dirname(old_file))))
+
+    def test_sweep_skips_changed_crash(self):
+        self.env.config.set('crashdump-retention', 'default.drop_days', '100')
+        crashid, item_name = self._insert_crash(200)
+        new_item_name = item_name + '.new'
+        with open(os.path.join(self.dumpdata_dir, new_item_name), 'w') as f:
+            f.write('MDMP')
+
+        lock_crash = retention_module.lock_crash
+        def uploading_lock_crash(dumpdata_dir, uuid):
+            # an upload replaces the dump while the sweep waits for the lock
+            self.env.db_transaction("UPDATE crashdump SET minidumpfile=%s WHERE id=%s", (new_item_name, crashid))
+            return lock_crash(dumpdata_dir, uuid)
+        retention_module.lock_crash = uploading_lock_crash
+        try:
+            result = self.retention.sweep(now=self.now)
+        finally:
+            retention_module.lock_crash = lock_crash
+        self.assertEqual((0, 0), (result['dropped'], result['failed']))
+        self.assertEqual([(new_item_name,)],
+                         self.env.db_query("SELECT minidumpfile FROM crashdump WHERE id=%s", (crashid,)))
+        self.assertTrue(os.path.exists(os.path.join(self.dumpdata_dir, new_item_name)))
+        self.assertTrue(os.path.exists(os.path.join(self.dumpdata_dir, item_name)))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CrashDumpRetentionTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
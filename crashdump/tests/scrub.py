@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from uuid import uuid4
+
+from trac.test import EnvironmentStub
+
+from crashdump import scrub as scrub_module
+from crashdump.model import CrashDump
+from crashdump.scrub import CrashDumpScrubber
+
+
+class CrashDumpScrubberTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'crashdump.*'])
+        self.env.path = tempfile.mkdtemp()
+        self.dumpdata_dir = os.path.join(self.env.path, 'dumpdata')
+        self.env.config.set('crashdump', 'dumpdata_dir', self.dumpdata_dir)
+        self.env.upgrade()
+        self.scrubber = CrashDumpScrubber(self.env)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    def _write(self, item_name, data='data'):
+        path = os.path.join(self.dumpdata_dir, item_name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def _insert_crash(self, product, status, **files):
+        crash = CrashDump(env=self.env, uuid=str(uuid4()), must_exist=False)
+        crash['productname'] = product
+        crash['status'] = status
+        crash.insert()
+        for field, data in files.items():
+            item_name = os.path.join(str(crash.uuid), field)
+            if data is not None:
+                self._write(item_name, data)
+            self.env.db_transaction("UPDATE crashdump SET %s=%%s WHERE id=%%s" % field, (item_name, crash.id))
+        return crash
+
+    def test_scrub(self):
+        good = self._insert_crash('app', 'new', minidumpfile='x' * 10, minidumpreportxmlfile='y' * 5)
+        broken = self._insert_crash('app', 'closed', minidumpfile=None, minidumpreportxmlfile='z' * 3)
+        # a stray file of an existing crash and the directory of a purged one
+        stray = self._write(os.path.join(str(good.uuid), 'leftover'), 'abc')
+        orphan_dir = os.path.dirname(self._write(os.path.join(str(uuid4()), 'minidumpfile'), 'o' * 7))
+        staged = self._write(os.path.join('.incoming', 'upload-1'))
+        # an upload in progress is left alone
+        recent = self._write(os.path.join(str(uuid4()), 'minidumpfile'))
+        old = time.time() - 2 * self.scrubber.grace_period
+        for path in (stray, orphan_dir, os.path.join(orphan_dir, 'minidumpfile')):
+            os.utime(path, (old, old))
+
+        problems = []
+        result = self.scrubber.scrub(jobs=2, found=lambda *args: problems.append(args))
+        self.assertEqual(2, result['crashes'])
+        self.assertEqual(1, result['missing'])
+        self.assertEqual(2, result['orphans'])
+        self.assertEqual(10, result['orphan_bytes'])
+        self.assertEqual({('new', 'app'): 15, ('closed', 'app'): 3}, result['usage'])
+        self.assertEqual(sorted([('missing', os.path.join(str(broken.uuid), 'minidumpfile'), broken.id, 0),
+                                 ('orphan', stray, good.id, 3),
+                                 ('orphan', orphan_dir, None, 7)]),
+                         sorted(problems))
+        self.assertTrue(os.path.exists(stray))
+
+        result = self.scrubber.scrub(repair=True)
+        self.assertEqual((1, 2, 0), (result['repaired'], result['removed'], result['failed']))
+        self.assertFalse(os.path.exists(stray))
+        self.assertFalse(os.path.exists(orphan_dir))
+        self.assertTrue(os.path.exists(staged))
+        self.assertTrue(os.path.exists(recent))
+        self.assertEqual([(None,)], self.env.db_query("SELECT minidumpfile FROM crashdump WHERE id=%s",
+                                                      (broken.id,)))
+
+        result = self.scrubber.scrub()
+        self.assertEqual((0, 0), (result['missing'], result['orphans']))
+
+    def test_repair_skips_uploaded_crash(self):
+        uuid = str(uuid4())
+        crash_file = self._write(os.path.join(uuid, 'minidumpfile'))
+        old = time.time() - 2 * self.scrubber.grace_period
+        for path in (crash_file, os.path.dirname(crash_file)):
+            os.utime(path, (old, old))
+
+        lock_crash = scrub_module.lock_crash
+        def uploading_lock_crash(dumpdata_dir, uuid):
+            # the upload of the crash completes while the repair waits for
+            # the lock
+            crash = CrashDump(env=self.env, uuid=uuid, must_exist=False)
+            crash['minidumpfile'] = os.path.join(uuid, 'minidumpfile')
+            crash.insert()
+            return lock_crash(dumpdata_dir, uuid)
+        scrub_module.lock_crash = uploading_lock_crash
+        try:
+            result = self.scrubber.scrub(repair=True)
+        finally:
+            scrub_module.lock_crash = lock_crash
+        self.assertEqual((0, 0), (result['removed'], result['failed']))
+        self.assertTrue(os.path.exists(crash_file))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CrashDumpScrubberTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import unittest
+
+from crashdump.stackcodec import encode_stacks, ThreadStacks, StackCodecError
+
+
+class _Object(object):
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+def _frame(module, function, addr, line=None):
+    return _Object(addr=addr, retaddr=addr + 8, trust_level=2, module=module, function=function,
+                   funcoff=0x10, source='main.cpp' if line else None, line=line, lineoff=-1 if line else None)
+
+
+class StackCodecTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        thread = _Object(name=u'worker \xe4', main_thread=False, rpc_thread=True)
+        dumps = [
+            _Object(threadid=0x10, exception=True, thread=None,
+                    callstack=[_frame('app.exe', 'crash_here', 0x7ff612340000, 12),
+                               _frame('app.exe', 'main', 0x7ff612340100, 40)]),
+            _Object(threadid=0x11, exception=False, thread=thread,
+                    callstack=[_frame('ntdll.dll', 'NtWaitForSingleObject', 0x7ffe00000000)] * 50),
+            _Object(threadid=0x12, exception=False, thread=None, callstack=None),
+            ]
+        blob = encode_stacks(dumps)
+        stacks = ThreadStacks(blob)
+        self.assertEqual(3, len(stacks))
+        self.assertEqual([0x10, 0x11, 0x12], [dump.threadid for dump in stacks])
+        self.assertEqual(0x10, stacks['exception'].threadid)
+        self.assertIn(0x11, stacks)
+        self.assertNotIn(0x13, stacks)
+        self.assertRaises(KeyError, stacks.__getitem__, 0x13)
+
+        # the frames are decoded on first access
+        self.assertIsNone(stacks[0x10]._callstack)
+        top = stacks[0x10].top
+        self.assertEqual((0, 'app.exe', 'crash_here', 0x7ff612340000, 0x7ff612340008, 2, 0x10, 'main.cpp', 12, -1),
+                         (top.num, top.module, top.function, top.addr, top.retaddr, top.trust_level, top.funcoff,
+                          top.source, top.line, top.lineoff))
+        self.assertEqual(['app.exe'], stacks[0x10].involved_modules)
+        self.assertEqual(50, len(stacks[0x11].callstack))
+        self.assertIsNone(stacks[0x11].callstack[49].source)
+        self.assertEqual(u'worker \xe4', stacks[0x11].thread.name)
+        self.assertTrue(stacks[0x11].thread.rpc_thread)
+        self.assertIsNone(stacks[0x10].thread.name)
+        self.assertEqual([], stacks[0x12].callstack)
+
+        # the strings are stored only once
+        self.assertEqual(1, str(stacks._data).count('NtWaitForSingleObject'))
+
+    def test_invalid(self):
+        self.assertRaises(StackCodecError, ThreadStacks, 'not a blob')
+        blob = encode_stacks([_Object(threadid=1, exception=False, thread=None,
+                                      callstack=[_frame('a', 'b', 1)])])
+        self.assertRaises(StackCodecError, ThreadStacks, blob[:-8])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(StackCodecTestCase))
+    return suite
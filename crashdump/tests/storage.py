@@ -0,0 +1,165 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import errno
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from crashdump.storage import compress_dump_file, find_dump_file, open_dump_file, \
+    remove_dump_file, accepts_encoding, DecompressingReader, lock_directory, crash_dir_name, \
+    lock_crash, remove_crash_locks, crash_lock_names, \
+    split_item_name, alternative_item_names
+
+
+class CrashDumpStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'report.dmp.xml')
+        self.data = '<?xml version="1.0"?>\n<crash_dump>' + 'x' * 10000 + '</crash_dump>\n'
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_compress_gzip(self):
+        target = compress_dump_file(self.filename, 'gzip')
+        self.assertEqual(self.filename + '.gz', target)
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual((target, 'gzip'), find_dump_file(self.filename))
+        self.assertTrue(os.path.getsize(target) < len(self.data))
+
+        f = open_dump_file(self.filename)
+        self.assertEqual(self.data, f.read())
+        f.close()
+
+        f = open_dump_file(self.filename, seekable=True)
+        f.seek(len(self.data) - 14)
+        self.assertEqual('</crash_dump>', f.read(13))
+        f.close()
+
+    def test_remove(self):
+        compress_dump_file(self.filename, 'gzip')
+        self.assertTrue(remove_dump_file(self.filename))
+        self.assertEqual((None, None), find_dump_file(self.filename))
+
+    def test_accepts_encoding(self):
+        self.assertTrue(accepts_encoding('gzip, deflate', 'gzip'))
+        self.assertFalse(accepts_encoding('gzip;q=0, deflate', 'gzip'))
+        self.assertFalse(accepts_encoding('deflate', 'gzip'))
+        self.assertFalse(accepts_encoding(None, 'gzip'))
+
+    def _gzip(self, data):
+        out = io.BytesIO()
+        gz = gzip.GzipFile(fileobj=out, mode='wb')
+        gz.write(data)
+        gz.close()
+        return out.getvalue()
+
+    def test_decompressing_reader(self):
+        compressed = self._gzip('first line\nsecond line\n' + 'x' * 100)
+        # data after the given length must not be read
+        reader = DecompressingReader(io.BytesIO(compressed + 'garbage'), 'gzip', length=len(compressed))
+        self.assertEqual('first line\n', reader.readline())
+        self.assertEqual('sec', reader.readline(3))
+        self.assertEqual('ond line\n', reader.readline())
+        self.assertEqual('x' * 100, reader.read())
+        self.assertEqual('', reader.read())
+
+    def test_decompressing_reader_limit(self):
+        reader = DecompressingReader(io.BytesIO(self._gzip('x' * 100000)), 'gzip', max_size=1000)
+        try:
+            reader.read()
+            self.fail('IOError not raised')
+        except IOError as e:
+            self.assertEqual(errno.EFBIG, e.errno)
+
+    def test_decompressing_reader_bomb(self):
+        # 10 MB of zeros compress to about 10 KB
+        bomb = self._gzip('\0' * 10 * 1024 * 1024)
+        reader = DecompressingReader(io.BytesIO(bomb), 'gzip', max_size=1000)
+        try:
+            reader.read(100)
+            reader.read()
+            self.fail('IOError not raised')
+        except IOError as e:
+            self.assertEqual(errno.EFBIG, e.errno)
+        # no more than the limit has been decompressed
+        self.assertEqual(1001, reader._size)
+        self.assertTrue(len(reader._buffer) <= 1000)
+
+    def test_layout(self):
+        uuid = '0123abcd-0000-4000-8000-000000000000'
+        flat = os.path.join(uuid, 'minidump.dmp')
+        sharded = os.path.join('01', '23', uuid, 'minidump.dmp')
+        self.assertEqual(uuid, crash_dir_name(uuid))
+        self.assertEqual(os.path.dirname(sharded), crash_dir_name(uuid, 'sharded'))
+        self.assertEqual((uuid, 'minidump.dmp'), split_item_name(flat))
+        self.assertEqual((uuid, 'minidump.dmp'), split_item_name(sharded))
+        self.assertEqual((None, None), split_item_name('minidump.dmp'))
+        self.assertEqual([sharded], alternative_item_names(flat))
+        self.assertEqual([flat], alternative_item_names(sharded))
+
+    def test_lock_crash(self):
+        uuid = '0123abcd-0000-4000-8000-000000000000'
+        events = []
+
+        def worker(name):
+            with lock_crash(self.dir, uuid):
+                events.append(name + ' start')
+                time.sleep(0.05)
+                events.append(name + ' end')
+
+        threads = [threading.Thread(target=worker, args=(str(n),)) for n in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for n in range(3):
+            start = events.index('%i start' % n)
+            self.assertEqual('%i end' % n, events[start + 1])
+        # no crash directory is created for the lock
+        self.assertFalse(os.path.exists(os.path.join(self.dir, uuid)))
+
+        # only locks not in use are removed
+        with lock_crash(self.dir, uuid):
+            self.assertEqual(0, remove_crash_locks(self.dir))
+        self.assertEqual(1, remove_crash_locks(self.dir))
+        self.assertEqual([], crash_lock_names(self.dir))
+
+    def test_lock_directory(self):
+        crash_dir = os.path.join(self.dir, 'crash')
+        events = []
+
+        def worker(name):
+            with lock_directory(crash_dir):
+                events.append(name + ' start')
+                time.sleep(0.05)
+                events.append(name + ' end')
+
+        threads = [threading.Thread(target=worker, args=(str(n),)) for n in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(os.path.isdir(crash_dir))
+        for n in range(3):
+            self.assertEqual(events[2 * n][0], events[2 * n + 1][0])
+            self.assertTrue(events[2 * n + 1].endswith('end'))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CrashDumpStorageTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,546 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from uuid import UUID
+
+from trac.core import Component, implements
+from trac.db.api import DatabaseManager
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.api import ITicketChangeListener
+from trac.ticket.model import Ticket
+from trac.web.api import arg_list_to_args, HTTPBadRequest, HTTPNotFound, RequestDone
+from trac.web.main import RequestDispatcher
+
+from crashdump.links import CrashDumpTicketLinks
+from crashdump.submit import CrashDumpSubmit, UploadSizeExceeded, UnsupportedContentEncoding, \
+    _BatchItemRequest, _UploadContext, _UploadFieldStorage
+
+
+class TestTicketChangeListener(Component):
+    implements(ITicketChangeListener)
+
+    # the recorded changes, while a list
+    changes = None
+
+    def ticket_created(self, ticket):
+        pass
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        if self.changes is not None:
+            self.changes.append((ticket.id, ticket['linked_crash'], comment, author, old_values))
+
+    def ticket_deleted(self, ticket):
+        pass
+
+
+def _multipart_body(boundary, fields, files):
+    body = ''
+    for (name, value) in fields:
+        body += '--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value)
+    for (name, filename, data) in files:
+        body += '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n' % (boundary, name, filename)
+        body += 'Content-Type: application/octet-stream\r\n\r\n%s\r\n' % data
+    body += '--%s--\r\n' % boundary
+    return body
+
+
+class CrashDumpSubmitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'crashdump.*'])
+        self.env.path = tempfile.mkdtemp()
+        self.env.config.set('crashdump', 'dumpdata_dir', os.path.join(self.env.path, 'dumpdata'))
+        self.db_mgr = DatabaseManager(self.env)
+        self.env.upgrade()
+        self.submit = CrashDumpSubmit(self.env)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    def _parse_upload(self, files, max_size=0):
+        boundary = 'crashdumptestboundary'
+        body = _multipart_body(boundary, [('id', '67cbc89f-1001-4691-a2c2-c1bb40aac806')], files)
+        environ = {'REQUEST_METHOD': 'POST',
+                   'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % boundary,
+                   'CONTENT_LENGTH': str(len(body))}
+        context = _UploadContext(self.submit._get_staging_dir(), max_size)
+        storage_class = _UploadFieldStorage.bind(context)
+        fs = storage_class(io.BytesIO(body), environ=environ, keep_blank_values=True)
+        return context, fs
+
+    def test_upload_is_moved_into_place(self):
+        data = 'MDMP' + 'x' * 4096
+        context, fs = self._parse_upload([('minidump', 'test.dmp', data)])
+        self.assertEqual(1, len(context.files))
+        staged = context.files[0]
+        self.assertTrue(os.path.isfile(staged))
+
+        uuid = UUID('67cbc89f-1001-4691-a2c2-c1bb40aac806')
+        req = MockRequest(self.env, method='POST', args={'minidump': fs['minidump']})
+        ok, item_name, errmsg = self.submit._store_dump_file(uuid, req, 'minidump', False)
+        self.assertTrue(ok)
+        self.assertIsNone(errmsg)
+        self.assertFalse(os.path.exists(staged))
+        crash_file = os.path.join(self.env.path, self.submit.dumpdata_dir, item_name)
+        with open(crash_file, 'rb') as f:
+            self.assertEqual(data, f.read())
+        context.cleanup()
+
+    def test_sharded_layout(self):
+        self.env.config.set('crashdump', 'storage_layout', 'sharded')
+        context, fs = self._parse_upload([('minidump', 'test.dmp', 'MDMP')])
+        uuid = UUID('67cbc89f-1001-4691-a2c2-c1bb40aac806')
+        req = MockRequest(self.env, method='POST', args={'minidump': fs['minidump']})
+        ok, item_name, errmsg = self.submit._store_dump_file(uuid, req, 'minidump', False)
+        self.assertTrue(ok)
+        self.assertEqual(os.path.join('67', 'cb', str(uuid), 'test.dmp'), item_name)
+        context.cleanup()
+
+        # crashes already stored in the flat layout stay there
+        os.makedirs(os.path.join(self.env.path, self.submit.dumpdata_dir, str(UUID(int=1))))
+        self.assertEqual(str(UUID(int=1)), self.submit._get_crash_dir_name(UUID(int=1)))
+
+    def test_rejected_submit_creates_no_directory(self):
+        from crashdump.model import CrashDump
+        self.env.config.set('crashdump', 'storage_layout', 'sharded')
+        uuid = '67cbc89f-1001-4691-a2c2-c1bb40aac806'
+        CrashDump(uuid=uuid, env=self.env, must_exist=False).insert()
+        context, fs = self._parse_upload([('minidump', 'test.dmp', 'MDMP' + 'x' * 2048)])
+        req = MockRequest(self.env, method='POST', path_info='/submit',
+                          args={'id': uuid, 'minidump': fs['minidump']})
+        req.environ['HTTP_USER_AGENT'] = 'terra3d-crashuploader/1.0'
+        self.assertRaises(RequestDone, self.submit.process_request, req)
+        context.cleanup()
+        self.assertIn('already uploaded', req.response_sent.getvalue())
+        dumpdata = os.path.join(self.env.path, 'dumpdata')
+        self.assertEqual([], [name for name in os.listdir(dumpdata) if not name.startswith('.')])
+
+    def test_upload_limit_while_streaming(self):
+        self.assertRaises(UploadSizeExceeded, self._parse_upload,
+                          [('minidump', 'test.dmp', 'x' * 8192)], max_size=4096)
+
+    def _upload_request(self, method, path_info, body='', headers=None):
+        req = MockRequest(self.env, method=method, path_info=path_info)
+        req.environ['HTTP_USER_AGENT'] = 'terra3d-crashuploader/1.0'
+        req.environ['CONTENT_TYPE'] = 'application/octet-stream'
+        req.environ['CONTENT_LENGTH'] = str(len(body))
+        req.environ['wsgi.input'] = io.BytesIO(body)
+        for (name, value) in (headers or {}).items():
+            req.environ['HTTP_' + name.upper().replace('-', '_')] = value
+        self.assertTrue(self.submit.match_request(req))
+        def process():
+            self.submit.pre_process_request(req, self.submit)
+            self.submit.process_request(req)
+        self.assertRaises(RequestDone, process)
+        return req
+
+    def test_chunked_upload(self):
+        path = '/submit/upload/67cbc89f-1001-4691-a2c2-c1bb40aac806'
+        req = self._upload_request('PUT', path + '/minidump', 'MDMP1234',
+                                   {'Upload-Offset': '0', 'Upload-Filename': 'test.dmp'})
+        self.assertEqual('200 Ok', req.status_sent[0])
+        # resuming at a wrong offset is rejected and reports the current offset
+        req = self._upload_request('PUT', path + '/minidump', 'abcd', {'Upload-Offset': '4'})
+        self.assertEqual('409', req.status_sent[0][:3])
+        self.assertEqual('8', req.headers_sent['Upload-Offset'])
+        req = self._upload_request('PUT', path + '/minidump', 'abcd', {'Upload-Offset': '8'})
+        self.assertEqual('12', req.headers_sent['Upload-Offset'])
+
+        req = self._upload_request('GET', path)
+        self.assertEqual('minidump 12 test.dmp\n', req.response_sent.getvalue())
+
+        req = self._upload_request('DELETE', path)
+        req = self._upload_request('GET', path)
+        self.assertEqual('', req.response_sent.getvalue())
+
+    def test_expire_upload_sessions(self):
+        path = '/submit/upload/67cbc89f-1001-4691-a2c2-c1bb40aac80%i/minidump'
+        for i in range(2):
+            self._upload_request('PUT', path % i, 'MDMP1234', {'Upload-Offset': '0', 'Upload-Filename': 'test.dmp'})
+        staging_dir = self.submit._get_staging_dir()
+        with open(os.path.join(staging_dir, 'upload-in-progress'), 'wb') as f:
+            f.write('MDMP')
+        old_session = os.path.join(staging_dir, '67cbc89f-1001-4691-a2c2-c1bb40aac800')
+        old = time.time() - 25 * 3600
+        for name in ['.', 'minidump', 'minidump.name']:
+            os.utime(os.path.join(old_session, name), (old, old))
+        for name in os.listdir(staging_dir):
+            os.utime(os.path.join(staging_dir, name), (old, old))
+
+        self.assertEqual((1, len('MDMP1234') + len('test.dmp')), self.submit.expire_upload_sessions())
+        self.assertEqual(['67cbc89f-1001-4691-a2c2-c1bb40aac801', 'upload-in-progress'], sorted(os.listdir(staging_dir)))
+
+    def test_chunk_size_limit(self):
+        self.env.config.set('crashdump', 'max_chunk_size', '4')
+        req = self._upload_request('PUT', '/submit/upload/67cbc89f-1001-4691-a2c2-c1bb40aac806/minidump',
+                                   'MDMP1234', {'Upload-Offset': '0'})
+        self.assertEqual('413', req.status_sent[0][:3])
+
+    def test_batch_submit(self):
+        context, fs = self._parse_upload([('f0', 'a.dmp', 'MDMP' + 'a' * 2048),
+                                          ('f1', 'b.dmp', 'MDMP' + 'b' * 2048)])
+        manifest = [{'id': '67cbc89f-1001-4691-a2c2-c1bb40aac806', 'minidump': 'f0'},
+                    {'id': '67cbc89f-1001-4691-a2c2-c1bb40aac807', 'minidump': 'f1'},
+                    {'id': '67cbc89f-1001-4691-a2c2-c1bb40aac808', 'minidump': 'f2'}]
+        req = MockRequest(self.env, method='POST', path_info='/submit/batch',
+                          args={'manifest': json.dumps(manifest), 'f0': fs['f0'], 'f1': fs['f1']})
+        req.environ['HTTP_USER_AGENT'] = 'terra3d-crashuploader/1.0'
+        self.assertTrue(self.submit.match_request(req))
+        self.assertRaises(RequestDone, self.submit.process_request, req)
+        results = json.loads(req.response_sent.getvalue())['results']
+        self.assertEqual([200, 200, 400], [r['status'] for r in results])
+        self.assertEqual([1, 2], [r['crashid'] for r in results[:2]])
+        self.assertEqual(2, self.env.db_query("SELECT COUNT(*) FROM crashdump")[0][0])
+        context.cleanup()
+
+    def test_batch_rejects_manual_upload(self):
+        context, fs = self._parse_upload([('f0', 'a.dmp', 'MDMP' + 'a' * 2048)])
+        manifest = [{'id': '67cbc89f-1001-4691-a2c2-c1bb40aac806', 'minidump': 'f0', 'manual_upload': 1}]
+        req = MockRequest(self.env, method='POST', path_info='/submit/batch',
+                          args={'manifest': json.dumps(manifest), 'f0': fs['f0']})
+        req.environ['HTTP_USER_AGENT'] = 'terra3d-crashuploader/1.0'
+        self.assertRaises(RequestDone, self.submit.process_request, req)
+        context.cleanup()
+        self.assertEqual('200', req.status_sent[0][:3])
+        results = json.loads(req.response_sent.getvalue())['results']
+        self.assertEqual([400], [r['status'] for r in results])
+        self.assertEqual(0, self.env.db_query("SELECT COUNT(*) FROM crashdump")[0][0])
+
+        # a redirect of a batch item is recorded, not sent
+        req = MockRequest(self.env, method='POST', path_info='/submit/batch')
+        item_req = _BatchItemRequest(req, {}, [])
+        self.assertRaises(RequestDone, item_req.redirect, '/crash/1')
+        self.assertEqual(303, item_req.status)
+        self.assertEqual('/crash/1', item_req.headers['Location'])
+        self.assertEqual([], req.status_sent)
+
+    def test_batch_group_failure(self):
+        from crashdump.model import CrashDump
+        self.env.config.set('crashdump', 'batch_transaction_size', '2')
+        context, fs = self._parse_upload([('f0', 'a.dmp', 'MDMP' + 'a' * 2048),
+                                          ('f1', 'b.dmp', 'MDMP' + 'b' * 2048),
+                                          ('f2', 'c.dmp', 'MDMP' + 'c' * 2048)])
+        uuids = ['67cbc89f-1001-4691-a2c2-c1bb40aac80%i' % i for i in range(6, 9)]
+        manifest = [{'id': uuid, 'minidump': 'f%i' % i} for i, uuid in enumerate(uuids)]
+        req = MockRequest(self.env, method='POST', path_info='/submit/batch',
+                          args={'manifest': json.dumps(manifest), 'f0': fs['f0'], 'f1': fs['f1'], 'f2': fs['f2']})
+        req.environ['HTTP_USER_AGENT'] = 'terra3d-crashuploader/1.0'
+
+        # the second crash of the first group fails after the first one
+        # has been stored
+        record_files = CrashDump.record_files
+        def failing_record_files(db, crashid, files):
+            if any(uuids[1] in name for name, size, sha256 in files.values()):
+                raise self.env.db_exc.OperationalError('disk I/O error')
+            return record_files(db, crashid, files)
+        CrashDump.record_files = staticmethod(failing_record_files)
+        try:
+            self.assertRaises(RequestDone, self.submit.process_request, req)
+        finally:
+            CrashDump.record_files = staticmethod(record_files)
+        context.cleanup()
+
+        results = json.loads(req.response_sent.getvalue())['results']
+        self.assertEqual([500, 500, 200], [r['status'] for r in results])
+        self.assertEqual([(uuids[2],)], self.env.db_query("SELECT uuid FROM crashdump"))
+        dumpdata = os.path.join(self.env.path, 'dumpdata')
+        self.assertEqual([uuids[2]], sorted(name for name in os.listdir(dumpdata) if not name.startswith('.')))
+
+    def test_deferred_ticket_updates(self):
+        self.env.config.set('crashdump', 'defer_ticket_updates', 'true')
+        self.env.config.set('crashdump', 'batch_transaction_size', '2')
+        tkt = Ticket(self.env)
+        tkt['summary'] = 'crashes'
+        tkt['reporter'] = 'joe'
+        tkt_id = tkt.insert()
+        context, fs = self._parse_upload([('f0', 'a.dmp', 'MDMP' + 'a' * 2048),
+                                          ('f1', 'b.dmp', 'MDMP' + 'b' * 2048)])
+        manifest = [{'id': '67cbc89f-1001-4691-a2c2-c1bb40aac806', 'minidump': 'f0', 'ticket': '#%i' % tkt_id},
+                    {'id': '67cbc89f-1001-4691-a2c2-c1bb40aac807', 'minidump': 'f1', 'ticket': '#%i' % tkt_id}]
+        req = MockRequest(self.env, method='POST', path_info='/submit/batch',
+                          args={'manifest': json.dumps(manifest), 'f0': fs['f0'], 'f1': fs['f1']})
+        req.environ['HTTP_USER_AGENT'] = 'terra3d-crashuploader/1.0'
+
+        # the updates are only started once the whole group is stored
+        threads = []
+        start_ticket_updates = self.submit._start_ticket_updates
+        def recording_start_ticket_updates(deferred_updates):
+            stored = self.env.db_query("SELECT COUNT(*) FROM crashdump")[0][0]
+            crash_ids = [crashid for crashid, updates, author in deferred_updates]
+            threads.append((crash_ids, stored, start_ticket_updates(deferred_updates)))
+        self.submit._start_ticket_updates = recording_start_ticket_updates
+        self.assertRaises(RequestDone, self.submit.process_request, req)
+        context.cleanup()
+        for crash_ids, stored, thread in threads:
+            thread.join()
+
+        results = json.loads(req.response_sent.getvalue())['results']
+        self.assertEqual([200, 200], [r['status'] for r in results])
+        self.assertEqual([([1, 2], 2)], [(crash_ids, stored) for crash_ids, stored, thread in threads])
+        self.assertEqual([(1, tkt_id), (2, tkt_id)],
+                         self.env.db_query("SELECT crash, ticket FROM crashdump_ticket ORDER BY crash"))
+
+    def test_submit_is_atomic(self):
+        from crashdump.model import CrashDump
+        context, fs = self._parse_upload([('minidump', 'test.dmp', 'MDMP' + 'x' * 2048)])
+        req = MockRequest(self.env, method='POST', path_info='/submit',
+                          args={'id': '67cbc89f-1001-4691-a2c2-c1bb40aac806', 'minidump': fs['minidump']})
+        req.environ['HTTP_USER_AGENT'] = 'terra3d-crashuploader/1.0'
+
+        record_files = CrashDump.record_files
+        def failing_record_files(db, crashid, files):
+            raise self.env.db_exc.OperationalError('disk I/O error')
+        CrashDump.record_files = staticmethod(failing_record_files)
+        try:
+            self.assertRaises(self.env.db_exc.OperationalError, self.submit.process_request, req)
+        finally:
+            CrashDump.record_files = staticmethod(record_files)
+        context.cleanup()
+        # the crash row is rolled back along with the file information
+        self.assertEqual(0, self.env.db_query("SELECT COUNT(*) FROM crashdump")[0][0])
+
+    def test_concurrently_added_crash(self):
+        from crashdump.model import CrashDump
+        uuid = '67cbc89f-1001-4691-a2c2-c1bb40aac806'
+        CrashDump(uuid=uuid, env=self.env, must_exist=False).insert()
+        crashid = CrashDump.find_by_uuid(self.env, uuid).id
+
+        fetch_crash_by_uuid = CrashDump._fetch_crash_by_uuid
+        lookups = []
+        def racing_fetch_crash_by_uuid(crashobj, uuid, must_exist=True):
+            # the first attempt misses the crash added by the other server
+            lookups.append(uuid)
+            if len(lookups) > 2:
+                fetch_crash_by_uuid(crashobj, uuid, must_exist)
+        CrashDump._fetch_crash_by_uuid = racing_fetch_crash_by_uuid
+        try:
+            context, fs = self._parse_upload([('minidump', 'test.dmp', 'MDMP' + 'x' * 2048)])
+            req = MockRequest(self.env, method='POST', path_info='/submit',
+                              args={'id': uuid, 'minidump': fs['minidump']})
+            req.environ['HTTP_USER_AGENT'] = 'terra3d-crashuploader/1.0'
+            self.assertRaises(RequestDone, self.submit.process_request, req)
+            context.cleanup()
+        finally:
+            CrashDump._fetch_crash_by_uuid = fetch_crash_by_uuid
+        self.assertEqual(3, len(lookups))
+        self.assertIn('already uploaded', req.response_sent.getvalue())
+        self.assertEqual(str(crashid), req.headers_sent['CrashId'])
+        self.assertEqual(1, self.env.db_query("SELECT COUNT(*) FROM crashdump")[0][0])
+
+    def test_upload_rejected_when_busy(self):
+        self.env.config.set('crashdump', 'max_concurrent_uploads', '1')
+        path = '/submit/upload/67cbc89f-1001-4691-a2c2-c1bb40aac806/minidump'
+        req = MockRequest(self.env, method='PUT', path_info=path)
+        self.submit._admit_upload(req)
+        busy = self._upload_request('PUT', path, 'MDMP', {'Upload-Offset': '0'})
+        self.assertEqual('503', busy.status_sent[0][:3])
+        self.assertEqual('10', busy.headers_sent['Retry-After'])
+        self.submit._discard_upload(req)
+        req = self._upload_request('PUT', path, 'MDMP', {'Upload-Offset': '0'})
+        self.assertEqual('200', req.status_sent[0][:3])
+
+    def test_upload_released_when_rejected(self):
+        # no background job runner started by its request filter
+        self.env.config.set('crashdump', 'job_poll_interval', '0')
+        dispatcher = RequestDispatcher(self.env)
+        for i in range(3):
+            req = MockRequest(self.env, method='PUT', path_info='/submit')
+            req.environ['CONTENT_LENGTH'] = '4'
+            self.assertRaises(HTTPNotFound, dispatcher.dispatch, req)
+
+        # a browser upload without form token fails the CSRF check
+        boundary = 'crashdumptestboundary'
+        body = _multipart_body(boundary, [('id', '67cbc89f-1001-4691-a2c2-c1bb40aac806')],
+                               [('minidump', 'test.dmp', 'MDMP' + 'x' * 4096)])
+        req = MockRequest(self.env, method='POST', path_info='/submit')
+        req.environ['HTTP_USER_AGENT'] = 'Mozilla/5.0'
+        req.environ['CONTENT_TYPE'] = 'multipart/form-data; boundary=%s' % boundary
+        req.environ['CONTENT_LENGTH'] = str(len(body))
+        req.environ['wsgi.input'] = io.BytesIO(body)
+        # parse the request body instead of the arguments of MockRequest
+        req.callbacks['args'] = lambda req: arg_list_to_args(req.arg_list)
+        self.assertRaises(HTTPBadRequest, dispatcher.dispatch, req)
+
+        self.assertEqual(0, self.submit._admission.concurrent)
+        self.assertEqual(0, self.submit._admission.inflight_bytes)
+        self.assertEqual([], os.listdir(self.submit._get_staging_dir()))
+
+    def _crashlist(self, **args):
+        req = MockRequest(self.env, method='GET', path_info='/submit/crashlist', args=args)
+        req.environ['HTTP_USER_AGENT'] = 'terra3d-crashuploader/1.0'
+        self.assertTrue(self.submit.match_request(req))
+        self.assertRaises(RequestDone, self.submit.process_request, req)
+        return req
+
+    def test_crashlist_pages(self):
+        from crashdump.model import CrashDump
+        for n in range(3):
+            crashobj = CrashDump(uuid=UUID(int=n + 1), env=self.env, must_exist=False)
+            crashobj['status'] = 'new'
+            crashobj.insert()
+        self.env.db_transaction("INSERT INTO crashdump_ticket (crash, ticket) VALUES (2, 7)")
+        self.env.db_transaction("UPDATE crashdump SET minidumpfile='a.dmp' WHERE id=2")
+        with self.env.db_transaction as db:
+            CrashDump.record_files(db, 2, {'minidumpfile': ('a.dmp', 4, 'ab' * 32)})
+
+        req = self._crashlist(format='json', limit=2)
+        page = json.loads(req.response_sent.getvalue())
+        self.assertEqual([1, 2], [c['id'] for c in page['crashes']])
+        self.assertEqual([7], [t['id'] for t in page['crashes'][1]['linked_tickets']])
+        self.assertEqual({}, page['crashes'][0]['files'])
+        self.assertEqual({'minidumpfile': {'size': 4, 'sha256': 'ab' * 32}}, page['crashes'][1]['files'])
+        self.assertEqual(2, page['next'])
+        req = self._crashlist(format='json', limit=2, cursor=page['next'])
+        page = json.loads(req.response_sent.getvalue())
+        self.assertEqual([3], [c['id'] for c in page['crashes']])
+        self.assertIsNone(page['next'])
+
+        req = self._crashlist()
+        self.assertIn('<crash id="1" uuid="00000000-0000-0000-0000-000000000001"', req.response_sent.getvalue())
+        etag = req.headers_sent['ETag']
+        req = MockRequest(self.env, method='GET', path_info='/submit/crashlist')
+        req.environ['HTTP_USER_AGENT'] = 'terra3d-crashuploader/1.0'
+        req.environ['HTTP_IF_NONE_MATCH'] = etag
+        self.assertRaises(RequestDone, self.submit.process_request, req)
+        self.assertEqual('304', req.status_sent[0][:3])
+
+        # links of crashes outside the list do not change it
+        self.env.db_transaction("UPDATE crashdump SET status='closed' WHERE id=3")
+        req = self._crashlist()
+        etag = req.headers_sent['ETag']
+        self.env.db_transaction("INSERT INTO crashdump_ticket (crash, ticket) VALUES (3, 8)")
+        req = MockRequest(self.env, method='GET', path_info='/submit/crashlist')
+        req.environ['HTTP_USER_AGENT'] = 'terra3d-crashuploader/1.0'
+        req.environ['HTTP_IF_NONE_MATCH'] = etag
+        self.assertRaises(RequestDone, self.submit.process_request, req)
+        self.assertEqual('304', req.status_sent[0][:3])
+
+    def test_crashlist_page_size(self):
+        from crashdump.model import CrashDump
+        self.env.config.set('crashdump', 'max_crashlist_page_size', '2')
+        for n in range(3):
+            crashobj = CrashDump(uuid=UUID(int=n + 1), env=self.env, must_exist=False)
+            crashobj['status'] = 'new'
+            crashobj.insert()
+        page = json.loads(self._crashlist(format='json').response_sent.getvalue())
+        self.assertEqual([1, 2, 3], [c['id'] for c in page['crashes']])
+        page = json.loads(self._crashlist(format='json', limit=5).response_sent.getvalue())
+        self.assertEqual([1, 2], [c['id'] for c in page['crashes']])
+        page = json.loads(self._crashlist(format='json', cursor=1).response_sent.getvalue())
+        self.assertEqual([2, 3], [c['id'] for c in page['crashes']])
+
+    def test_duplicate_check(self):
+        from crashdump.model import CrashDump
+        crash_dir = os.path.join(self.env.path, 'dumpdata', str(UUID(int=1)))
+        os.makedirs(crash_dir)
+        with open(os.path.join(crash_dir, 'test.dmp'), 'wb') as f:
+            f.write('MDMP')
+        crashobj = CrashDump(uuid=UUID(int=1), env=self.env, must_exist=False)
+        crashobj['minidumpfile'] = os.path.join(str(UUID(int=1)), 'test.dmp')
+        crashobj.insert()
+
+        body = json.dumps([{'id': str(UUID(int=1)),
+                            'files': {'minidump': hashlib.sha256('MDMP').hexdigest(), 'minidumpreportxml': None}},
+                           {'id': str(UUID(int=2))}])
+        req = MockRequest(self.env, method='POST', path_info='/submit/check')
+        req.environ['HTTP_USER_AGENT'] = 'terra3d-crashuploader/1.0'
+        req.environ['CONTENT_TYPE'] = 'application/json'
+        req.environ['CONTENT_LENGTH'] = str(len(body))
+        req.environ['wsgi.input'] = io.BytesIO(body)
+        self.assertTrue(self.submit.match_request(req))
+        self.assertRaises(RequestDone, self.submit.process_request, req)
+        results = json.loads(req.response_sent.getvalue())['results']
+        self.assertEqual({'minidump': 'stored', 'minidumpreportxml': 'missing'}, results[0]['files'])
+        self.assertTrue(results[0]['exists'])
+        self.assertFalse(results[1]['exists'])
+
+    def test_compressed_upload(self):
+        boundary = 'crashdumptestboundary'
+        data = 'MDMP' + 'x' * 4096
+        body = _multipart_body(boundary, [('id', '67cbc89f-1001-4691-a2c2-c1bb40aac806')],
+                               [('minidump', 'test.dmp', data)])
+        out = io.BytesIO()
+        gz = gzip.GzipFile(fileobj=out, mode='wb')
+        gz.write(body)
+        gz.close()
+        req = MockRequest(self.env, method='POST')
+        req.environ['CONTENT_TYPE'] = 'multipart/form-data; boundary=%s' % boundary
+        req.environ['CONTENT_LENGTH'] = str(len(out.getvalue()))
+        req.environ['HTTP_CONTENT_ENCODING'] = 'gzip'
+        req.environ['wsgi.input'] = io.BytesIO(out.getvalue())
+        args = dict(self.submit._parse_upload_arg_list(req))
+        self.assertEqual('67cbc89f-1001-4691-a2c2-c1bb40aac806', args['id'])
+        args['minidump'].file.seek(0)
+        self.assertEqual(data, args['minidump'].file.read())
+
+        self.submit._discard_upload(req)
+
+        req = MockRequest(self.env, method='POST')
+        req.environ['CONTENT_TYPE'] = 'multipart/form-data; boundary=%s' % boundary
+        req.environ['HTTP_CONTENT_ENCODING'] = 'br'
+        req.environ['wsgi.input'] = io.BytesIO(body)
+        self.assertRaises(UnsupportedContentEncoding, self.submit._parse_upload_arg_list, req)
+        self.submit._discard_upload(req)
+
+
+    def test_link_crash_to_tickets(self):
+        ids = []
+        for i in range(3):
+            tkt = Ticket(self.env)
+            tkt['summary'] = 'ticket %i' % i
+            tkt['reporter'] = 'joe'
+            ids.append(tkt.insert())
+        self.env.db_transaction("INSERT INTO crashdump_ticket (crash, ticket) VALUES (5, %s)", (ids[0],))
+        self.env.db_transaction("INSERT INTO ticket_custom (ticket, name, value) VALUES (%s, 'linked_crash', '5')", (ids[0],))
+
+        with self.env.db_transaction as db:
+            linked = CrashDumpTicketLinks.link_crash(db, 5, [(ids[0], None), (ids[1], 'linked'), (ids[2], None), (999, 'x')], 'joe')
+        self.assertEqual(ids, linked)
+        self.assertEqual([(5, t) for t in ids],
+                         self.env.db_query("SELECT crash, ticket FROM crashdump_ticket ORDER BY ticket"))
+        # the already linked ticket without comment is not touched
+        self.assertEqual([], self.env.db_query("SELECT * FROM ticket_change WHERE ticket=%s", (ids[0],)))
+        self.assertEqual('5', Ticket(self.env, ids[1])['linked_crash'])
+        changes = self.env.db_query("SELECT field, oldvalue, newvalue FROM ticket_change WHERE ticket=%s ORDER BY field", (ids[1],))
+        self.assertEqual([('comment', '1', 'linked'), ('linked_crash', None, '5')], changes)
+
+        # linking again only adds the comment
+        with self.env.db_transaction as db:
+            CrashDumpTicketLinks.link_crash(db, 5, [(ids[1], 'again')], 'joe')
+        changes = self.env.db_query("SELECT field, oldvalue, newvalue FROM ticket_change WHERE ticket=%s AND newvalue='again'", (ids[1],))
+        self.assertEqual([('comment', '2', 'again')], changes)
+
+    def test_link_crash_notifies_listeners(self):
+        tkt = Ticket(self.env)
+        tkt['summary'] = 'ticket'
+        tkt['reporter'] = 'joe'
+        tkt_id = tkt.insert()
+        ticket_changes = []
+        with self.env.db_transaction as db:
+            CrashDumpTicketLinks.link_crash(db, 5, [(tkt_id, 'linked')], 'joe', ticket_changes=ticket_changes)
+        TestTicketChangeListener.changes = []
+        try:
+            CrashDumpTicketLinks.notify_changes(self.env, ticket_changes)
+            self.assertEqual([(tkt_id, '5', 'linked', 'joe', {'linked_crash': None})],
+                             TestTicketChangeListener.changes)
+        finally:
+            TestTicketChangeListener.changes = None
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CrashDumpSubmitTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -2,9 +2,12 @@
 # -*- coding: utf-8 -*-
 # kate: space-indent on; indent-width 4; mixedindent off; indent-mode python;
 
+import os
 import shutil
 import tempfile
 import unittest
+from datetime import datetime
+from urlparse import parse_qs
 
 from trac.core import Component, implements
 from trac.db.api import DatabaseManager
@@ -12,12 +15,14 @@ from trac.perm import PermissionSystem
 from trac.ticket.model import Ticket
 #from trac.db.schema import Table, Column, Index
 from trac.test import EnvironmentStub, MockRequest
+from trac.util.datefmt import utc
 from trac.resource import ResourceNotFound
 from trac.web.api import HTTPBadRequest, RequestDone
 
 from crashdump.web_ui import CrashDumpModule
 from crashdump.model import CrashDump
 from crashdump.links import CrashDumpTicketLinks
+from crashdump.storage import compress_dump_file
 
 class CrashDumpWebUiTestCase(unittest.TestCase):
     def setUp(self):
@@ -92,6 +97,92 @@ class CrashDumpWebUiTestCase(unittest.TestCase):
         self.assertEqual(tmpl, 'report.html')
 
 
+    def test_crash_list(self):
+        for i in range(5):
+            crash = CrashDump(env=self.env, uuid='67cbc89f-1001-4691-a2c2-c1bb40aac80%i' % i, must_exist=False)
+            crash['applicationname'] = 'app%i' % (i % 2)
+            crash.insert()
+        req = MockRequest(self.env, authname='user', method='GET',
+                          args={'action': 'crash_list', 'max': '2', 'page': '2',
+                                'applicationname': 'app0', 'sort': 'id', 'asc': '1'})
+        tmpl, data, extra = self.crashdump_module.process_request(req)
+        self.assertEqual('list.html', tmpl)
+        self.assertEqual(3, data['numrows'])
+        self.assertEqual(['67cbc89f-1001-4691-a2c2-c1bb40aac804'], [c.uuid for c in data['results']])
+        self.assertEqual(2, data['paginator'].num_pages)
+
+    def test_crash_list_cursor(self):
+        for i in range(5):
+            crash = CrashDump(env=self.env, uuid='67cbc89f-1001-4691-a2c2-c1bb40aac80%i' % i, must_exist=False)
+            crash['applicationname'] = 'app%i' % (i % 3) if i != 4 else None
+            crash.insert()
+        # too many matches to count them
+        self.crashdump_module.list_count_limit = 3
+
+        def crash_list(**args):
+            args.update({'action': 'crash_list', 'max': '2', 'sort': 'applicationname', 'asc': '1'})
+            req = MockRequest(self.env, authname='user', method='GET', args=args)
+            tmpl, data, extra = self.crashdump_module.process_request(req)
+            links = req.chrome['links']
+            cursors = {}
+            for rel in ('next', 'prev'):
+                if rel in links:
+                    query = parse_qs(links[rel][0]['href'].split('?', 1)[1])
+                    cursors[rel] = query['after' if rel == 'next' else 'before'][0]
+            return [c.uuid[-1] for c in data['results']], data['numrows'], cursors
+
+        uuids, numrows, cursors = crash_list()
+        self.assertIsNone(numrows)
+        self.assertEqual(['next'], list(cursors))
+        pages = [uuids]
+        while 'next' in cursors:
+            uuids, numrows, cursors = crash_list(after=cursors['next'])
+            pages.append(uuids)
+        # NULL sorts first on SQLite
+        self.assertEqual([['4', '0'], ['3', '1'], ['2']], pages)
+        uuids, numrows, cursors = crash_list(before=cursors['prev'])
+        self.assertEqual(['3', '1'], uuids)
+        self.assertEqual(['next', 'prev'], sorted(cursors))
+
+    def test_purge_preview(self):
+        for i in range(5):
+            crash = CrashDump(env=self.env, uuid='67cbc89f-1001-4691-a2c2-c1bb40aac80%i' % i, must_exist=False)
+            crash['crashtime'] = datetime(2010 + i, 1, 1, tzinfo=utc)
+            crash.insert()
+        PermissionSystem(self.env).grant_permission('admin', 'TRAC_ADMIN')
+        self.crashdump_module.purge_preview_limit = 2
+        req = MockRequest(self.env, authname='admin', method='POST',
+                          args={'purge_threshold': '2014-01-01T00:00:00Z'})
+        tmpl, data = self.crashdump_module.render_admin_panel(req, 'crashdump', 'maintenance', '')
+        self.assertEqual('crashdump_admin_maintenance.html', tmpl)
+        self.assertEqual(4, data['purge_crash_count'])
+        # the oldest crashes are listed
+        self.assertEqual(['67cbc89f-1001-4691-a2c2-c1bb40aac800', '67cbc89f-1001-4691-a2c2-c1bb40aac801'],
+                         [c.uuid for c in data['purge_crashes']])
+
+    def test_send_compressed_file(self):
+        crash = self._insert_crashdump(minidumpfile='crash/test.dmp')
+        dumpdata_dir = os.path.join(self.env.path, 'dumpdata')
+        self.env.config.set('crashdump', 'dumpdata_dir', dumpdata_dir)
+        os.makedirs(os.path.join(dumpdata_dir, 'crash'))
+        with open(os.path.join(dumpdata_dir, 'crash', 'test.dmp'), 'wb') as f:
+            f.write('MDMP' * 1024)
+        compress_dump_file(os.path.join(dumpdata_dir, 'crash', 'test.dmp'), 'gzip')
+        with self.env.db_transaction as db:
+            CrashDump.record_files(db, crash.id, CrashDump.file_info(dumpdata_dir, crash.values))
+
+        req = MockRequest(self.env, method='GET', args={'crashid': crash.id, 'action': 'minidump_raw'})
+        self.assertRaises(RequestDone, self.crashdump_module.process_request, req)
+        self.assertEqual('Accept-Encoding', req.headers_sent['Vary'])
+        self.assertEqual('4096', req.headers_sent['Content-Length'])
+        self.assertEqual('MDMP' * 1024, req.response_sent.getvalue())
+
+        req = MockRequest(self.env, method='GET', args={'crashid': crash.id, 'action': 'minidump_raw'})
+        req.environ['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        self.assertRaises(RequestDone, self.crashdump_module.process_request, req)
+        self.assertEqual('Accept-Encoding', req.headers_sent['Vary'])
+        self.assertEqual('gzip', req.headers_sent['Content-Encoding'])
+
     def test_action_view_crash_child(self):
         """Full name of reporter and owner are used in ticket properties."""
         self.env.insert_users([('user1', 'User One', ''),
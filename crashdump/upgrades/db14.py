@@ -0,0 +1,43 @@
+from trac.db import Table, Column, Index, DatabaseManager
+
+columns = [
+    Column('exceptioncode', type='int64'),
+    Column('exceptionname', size=64),
+    Column('exceptionaddress', size=32),
+    Column('exceptionmodule', size=256),
+    Column('exceptionfunction'),
+    Column('threadcount', type='int'),
+    Column('modulecount', type='int'),
+    Column('dumpsize', type='int64'),
+    Column('reportsize', type='int64'),
+]
+
+indexes = [
+    Index(['exceptioncode']),
+    Index(['exceptionmodule']),
+]
+
+_sql_types = {
+    'int': 'integer',
+    'int64': 'bigint',
+    'text': 'text',
+}
+
+def do_upgrade(env, ver, cursor):
+    """adds the crash summary columns to the table crashdump
+
+    The columns are added in place since copying the whole table is slow for
+    large installations. Existing crashes are filled in by
+    `trac-admin crashdump backfill`.
+    """
+
+    for column in columns:
+        cursor.execute('ALTER TABLE crashdump ADD COLUMN %s %s' % (column.name, _sql_types[column.type]))
+
+    # let the connector generate the index statements for the database type
+    connector = DatabaseManager(env).get_connector()[0]
+    table = Table('crashdump', key=('id'))[columns + indexes]
+    for stmt in connector.to_sql(table):
+        words = stmt.split()
+        if words[0] == 'CREATE' and 'INDEX' in words[1:3]:
+            cursor.execute(stmt)
@@ -0,0 +1,39 @@
+from trac.db import Table, Column, Index, DatabaseManager
+
+# only the indexed columns are listed, the tables already exist
+schema = [
+    Table('crashdump', key=('id'))[
+        Column('id', type='int', auto_increment=True),
+        Column('status'),
+        Column('component'),
+        Column('crashtime', type='int64'),
+        Column('uploadtime', type='int64'),
+        Column('changetime', type='int64'),
+        Column('applicationname', size=128),
+        Column('productname', size=64),
+        Column('productversion', size=32),
+        Index(['status']),
+        Index(['component']),
+        Index(['crashtime']),
+        Index(['uploadtime']),
+        Index(['changetime']),
+        Index(['applicationname']),
+        Index(['productname', 'productversion']),
+    ],
+    Table('crashdump_ticket', key=('crash', 'ticket'))[
+        Column('crash', type='int'),
+        Column('ticket', type='int'),
+        Index(['ticket']),
+    ],
+]
+
+def do_upgrade(env, ver, cursor):
+    """adds secondary indexes for the common crashdump queries
+    """
+
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            words = stmt.split()
+            if words[0] == 'CREATE' and 'INDEX' in words[1:3]:
+                cursor.execute(stmt)
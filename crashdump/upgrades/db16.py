@@ -0,0 +1,8 @@
+def do_upgrade(env, ver, cursor):
+    """adds the archivetime column to the table crashdump
+
+    The column holds the time at which the raw dump files of a crash were
+    moved to the archive directory and is NULL for crashes whose files are
+    still in the dump data directory.
+    """
+    cursor.execute('ALTER TABLE crashdump ADD COLUMN archivetime bigint')
@@ -0,0 +1,28 @@
+from trac.db import Table, Column, Index, DatabaseManager
+
+schema = [
+    Table('crashdump_job', key=('id'))[
+        Column('id', type='int', auto_increment=True),
+        Column('name', size=32),
+        Column('args'),
+        Column('status', size=16),
+        Column('author', size=256),
+        Column('created', type='int64'),
+        Column('started', type='int64'),
+        Column('updated', type='int64'),
+        Column('finished', type='int64'),
+        Column('progress', type='int'),
+        Column('message'),
+        Column('cancel', type='int'),
+        Index(['status']),
+        Index(['name', 'created']),
+    ],
+]
+
+def do_upgrade(env, ver, cursor):
+    """adds the table crashdump_job for the background maintenance jobs
+    """
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
@@ -0,0 +1,23 @@
+from trac.db import Table, Column, Index, DatabaseManager
+
+schema = [
+    Table('crashdump_file', key=('crash', 'field'))[
+        Column('crash', type='int'),
+        Column('field', size=32),
+        Column('name', size=256),
+        Column('size', type='int64'),
+        Column('sha256', size=64),
+        Index(['sha256']),
+    ],
+]
+
+def do_upgrade(env, ver, cursor):
+    """adds the table crashdump_file with the size and hash of the stored files
+
+    The files of existing crashes are recorded by `trac-admin crashdump
+    backfill restart`.
+    """
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
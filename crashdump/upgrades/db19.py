@@ -0,0 +1,27 @@
+from trac.db import Table, Column, Index, DatabaseManager
+
+schema = [
+    Table('crashdump_module_version', key=('id'))[
+        Column('id', type='int', auto_increment=True),
+        Column('name', size=256),
+        Column('version', size=64),
+        Index(['name', 'version'], unique=True),
+    ],
+    Table('crashdump_crash_module', key=('crash', 'module'))[
+        Column('crash', type='int'),
+        Column('module', type='int'),
+        Index(['module']),
+    ],
+]
+
+def do_upgrade(env, ver, cursor):
+    """adds the tables crashdump_module_version and crashdump_crash_module
+    with the modules loaded by every crash
+
+    The modules of existing crashes are recorded by `trac-admin crashdump
+    backfill restart`.
+    """
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
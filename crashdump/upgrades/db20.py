@@ -0,0 +1,22 @@
+from trac.db import Table, Column, DatabaseManager
+
+schema = [
+    Table('crashdump_thread_stacks', key=('crash'))[
+        Column('crash', type='int'),
+        Column('threadcount', type='int'),
+        Column('framecount', type='int'),
+        Column('data'),
+    ],
+]
+
+def do_upgrade(env, ver, cursor):
+    """adds the table crashdump_thread_stacks with the encoded stacks of all
+    threads of every crash
+
+    The stacks of existing crashes are recorded by `trac-admin crashdump
+    backfill restart`.
+    """
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
@@ -0,0 +1,29 @@
+from trac.db import Table, Column, Index, DatabaseManager
+
+# only the indexed columns are listed, the table already exists
+schema = [
+    Table('crashdump_stack', key=('crash', 'threadid', 'frameno'))[
+        Column('crash', type='int'),
+        Column('threadid', type='int'),
+        Column('frameno', type='int'),
+        Column('module'),
+        Column('function'),
+        Column('source'),
+        Column('line', type='int'),
+        Index(['function']),
+        Index(['module']),
+        Index(['source', 'line']),
+    ],
+]
+
+def do_upgrade(env, ver, cursor):
+    """adds indexes for searching crashes by the functions, modules and
+    source files of their stack frames
+    """
+
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            words = stmt.split()
+            if words[0] == 'CREATE' and 'INDEX' in words[1:3]:
+                cursor.execute(stmt)
@@ -0,0 +1,10 @@
+from crashdump.fulltext import create_index, populate_index
+
+def do_upgrade(env, ver, cursor):
+    """adds the full-text index crashdump_fts of the crashes
+
+    SQLite needs the FTS5 extension and PostgreSQL uses a tsvector column,
+    other databases get no index. All existing crashes are indexed.
+    """
+    if create_index(env, cursor):
+        populate_index(env, cursor)
@@ -4,11 +4,12 @@
 
 import subprocess
 import re
+import json
 
 from pkg_resources import resource_filename
 
 from trac.core import *
-from trac.web.api import IRequestHandler, IRequestFilter, ITemplateStreamFilter
+from trac.web.api import IRequestHandler, IRequestFilter, ITemplateStreamFilter, RequestDone
 from trac.web.chrome import (
     Chrome, ITemplateProvider, INavigationContributor,
     add_ctxtnav, add_link, add_notice, add_script, add_script_data,
@@ -39,11 +40,15 @@ import math
 import time
 from datetime import datetime, timedelta
 from .model import CrashDump
+from .jobs import CrashDumpJobRunner
+from .retention import CrashDumpRetention
 from .links import CrashDumpTicketLinks
 from .api import CrashDumpSystem
 from .xmlreport import XMLReport
 from .systeminforeport import SystemInfoReport
 from .minidump import MiniDump, MiniDumpWrapper
+from .stackcodec import StackCodecError
+from .storage import find_dump_file, get_dump_file_size, iter_dump_file, accepts_encoding, content_encodings
 from .utils import *
 
 if crashdump_use_jinja2:
@@ -102,6 +107,26 @@ class CrashDumpModule(Component):
     show_delete_crash = BoolOption('crashdump', 'show_delete_crash', 'false',
                       doc="""Show button to delete a crash from the system.""")
 
+    # columns fetched, sortable and filterable in the crash list
+    list_fields = ['uuid', 'crashtime', 'crashusername', 'crashhostname', 'status',
+                   'priority', 'component', 'version', 'milestone', 'applicationname',
+                   'systemname', 'osversion', 'buildtype',
+                   'exceptionname', 'exceptionmodule', 'exceptionfunction']
+    list_sort_fields = ['id', 'crashtime', 'crashusername', 'crashhostname', 'status',
+                        'priority', 'component', 'version', 'milestone', 'applicationname',
+                        'systemname', 'buildtype', 'exceptionname', 'exceptionmodule']
+    list_filter_fields = ['crashusername', 'crashhostname', 'priority', 'component',
+                          'version', 'milestone', 'applicationname', 'productname',
+                          'productversion', 'systemname', 'buildtype',
+                          'exceptioncode', 'exceptionname', 'exceptionmodule']
+
+    # results with more matches are paged with a cursor instead of page
+    # numbers, so they are never counted in full
+    list_count_limit = 1000
+
+    # number of crashes listed by the purge preview of the admin panel
+    purge_preview_limit = 100
+
     crashdump_fields = set(['_crash'])
     crashdump_uuid_fields = set(['_crash_uuid'])
     crashdump_sysinfo_fields = set(['_crash_sysinfo'])
@@ -347,33 +372,34 @@ class CrashDumpModule(Component):
         data['is_64_bit'] = False
         if xmlfile:
             start = time.time()
+            report_prefix = 'minidump' if crashobj['minidumpreportxmlfile'] else 'coredump'
+            recorded = crashobj.get_files()
+
+            def file_size(field, filename):
+                # sizes recorded on upload, crashes uploaded before are
+                # looked up on disk
+                if field in recorded:
+                    return recorded[field]['size']
+                try:
+                    return get_dump_file_size(filename)
+                except OSError:
+                    return 0
+
             if minidumpfile:
+                data['minidumpfile_size'] = file_size('minidumpfile', minidumpfile)
                 try:
-                    data['minidumpfile_size'] = os.path.getsize(minidumpfile)
                     data['minidumpfile'] = MiniDump(minidumpfile)
-                except OSError:
+                except (IOError, OSError):
                     pass
             if coredumpfile:
-                try:
-                    data['coredumpfile_size'] = os.path.getsize(coredumpfile)
-                except OSError:
-                    pass
+                data['coredumpfile_size'] = file_size('coredumpfile', coredumpfile)
             if reporttextfile:
-                try:
-                    data['reporttextfile_size'] = os.path.getsize(reporttextfile)
-                except OSError:
-                    pass
+                data['reporttextfile_size'] = file_size(report_prefix + 'reporttextfile', reporttextfile)
             if reporthtmlfile:
-                try:
-                    data['reporthtmlfile_size'] = os.path.getsize(reporthtmlfile)
-                except OSError:
-                    pass
+                data['reporthtmlfile_size'] = file_size(report_prefix + 'reporthtmlfile', reporthtmlfile)
             if xmlfile:
-                try:
-                    data['xmlfile_size'] = os.path.getsize(xmlfile)
-                except OSError:
-                    pass
-            if os.path.isfile(xmlfile):
+                data['xmlfile_size'] = file_size(report_prefix + 'reportxmlfile', xmlfile)
+            if find_dump_file(xmlfile)[0] is not None:
                 try:
                     xmlreport = XMLReport(xmlfile)
                     for f in xmlreport.fields:
@@ -388,12 +414,50 @@ class CrashDumpModule(Component):
                     data[f] = MiniDumpWrapper.ProxyObject(wrapper, f)
                 data['xmlreport'] = None
                 data['xmlfile_error'] = 'XML file %s does not exist' % xmlfile
+            if data.get('xmlreport') is None:
+                # the stacks of all threads stored on upload
+                try:
+                    stacks = crashobj.get_thread_stacks()
+                except StackCodecError as e:
+                    self.log.warning('Failed to decode the stacks of crash %s: %s', crashobj.uuid, e)
+                    stacks = None
+                if stacks is not None:
+                    data['stackdumps'] = stacks
             end = time.time()
             data['parsetime'] = end - start
         data['bits'] = 64 if data['is_64_bit'] else 32
         data['addr_format'] = addr_format_64 if data['is_64_bit'] else addr_format_32
         return data
 
+    def _list_cursor(self, crash, sort_col):
+        """Return the cursor of the crash list continuing at `crash`: the
+        crash id, followed by the database value of the sort column."""
+        if sort_col == 'id':
+            return str(crash.id)
+        value = crash.get_raw(sort_col)
+        if value is None:
+            return str(crash.id)
+        return u'%i:%s' % (crash.id, value)
+
+    def _parse_list_cursor(self, cursor, sort_col):
+        """Return the `after` argument of `CrashDump.query` for a cursor
+        returned by `_list_cursor`, None if it is invalid."""
+        if not cursor:
+            return None
+        crashid, sep, value = cursor.partition(':')
+        crashid = as_int(crashid, None)
+        if crashid is None:
+            return None
+        if sort_col == 'id':
+            return crashid
+        if not sep:
+            value = None
+        elif sort_col in self.datetime_fields:
+            value = as_int(value, None)
+            if value is None:
+                return None
+        return (value, crashid)
+
     def _get_prefs(self, req):
         return {'comments_order': req.session.get('ticket_comments_order',
                                                   'oldest'),
@@ -408,37 +472,125 @@ class CrashDumpModule(Component):
 
         action = req.args.get('action', 'view')
         if action == 'crash_list':
-            page = req.args.getint('page', 1)
+            page = req.args.getint('page', 1, min=1)
             default_max = self.items_per_page
             max = req.args.getint('max')
             limit = as_int(max, default_max, min=0)  # explict max takes precedence
             offset = (page - 1) * limit
 
             sort_col = req.args.get('sort', '')
+            if sort_col not in self.list_sort_fields:
+                sort_col = 'id'
             asc = req.args.getint('asc', 0, min=0, max=1)
 
             title = ''
             description = ''
 
+            req_status = req.args.get('status') or 'all'
+            filters = {}
+            for name in self.list_filter_fields:
+                value = req.args.getlist(name)
+                if value:
+                    filters[name] = value
+            query_args = dict((name, value) for name, value in filters.items())
+            if req_status != 'all':
+                query_args['status'] = req_status
+            # crashes which loaded a module, optionally in a given version
+            module_name = req.args.get('module', '').strip()
+            module_version = req.args.get('module_version', '').strip()
+            module = None
+            if module_name:
+                module = (module_name, module_version) if module_version else module_name
+                query_args['module'] = module_name
+                if module_version:
+                    query_args['module_version'] = module_version
+            # crashes with a matching frame in the top `depth` frames of the
+            # exception thread
+            stack = {}
+            stack_args = {}
+            for name in ('function', 'source', 'line', 'depth'):
+                value = req.args.get(name, '').strip()
+                stack_args[name] = value
+                if not value:
+                    continue
+                if name in ('line', 'depth'):
+                    value = as_int(value, None, min=0)
+                    if value is None:
+                        continue
+                stack[name] = value
+                query_args[name] = value
+            if not set(stack).difference(['depth']):
+                stack = None
+            query_args['max'] = limit
+
+            def report_href(**kwargs):
+                params = dict(query_args)
+                params['sort'] = sort_col
+                params['asc'] = asc
+                params.update(kwargs)
+                return req.href('crash', 'list', **params)
+
+            def sort_href(col):
+                return report_href(sort=col, asc=0 if col == sort_col and asc else 1, page=None)
+
             data = {'action': 'crash_list',
                 'max': limit,
                 'numrows': 0,
                 'title': title,
                 'description': description,
+                'sort': sort_col,
+                'asc': asc,
+                'sort_href': sort_href,
+                'show_args_form': True,
+                'args': dict(stack_args, module=module_name, module_version=module_version),
                 'message': None, 'paginator': None }
 
-            req_status = req.args.get('status') or 'active'
-            #results = CrashDump.query(env=self.env, status=req_status)
-            results = CrashDump.query(env=self.env, status=None)
+            status = None if req_status == 'all' else req_status
+            query_kwargs = dict(status=status, filters=filters, module=module, stack=stack)
+            after = self._parse_list_cursor(req.args.get('after'), sort_col)
+            before = self._parse_list_cursor(req.args.get('before'), sort_col)
+            num_items = None
+            if not limit:
+                results = CrashDump.query(self.env, order=sort_col, desc=not asc, fields=self.list_fields,
+                                          **query_kwargs)
+                num_items = len(results)
+            elif after is None and before is None:
+                num_items = CrashDump.query_count(self.env, limit=self.list_count_limit + 1, **query_kwargs)
+                if num_items > self.list_count_limit:
+                    num_items = None
+            if num_items is None:
+                # one more crash is fetched to know whether there is another page
+                if before is not None:
+                    results = CrashDump.query(self.env, order=sort_col, desc=bool(asc), limit=limit + 1,
+                                              after=before, fields=self.list_fields, **query_kwargs)
+                    has_previous_page = len(results) > limit
+                    results = results[:limit]
+                    results.reverse()
+                    has_next_page = True
+                else:
+                    results = CrashDump.query(self.env, order=sort_col, desc=not asc, limit=limit + 1,
+                                              after=after, fields=self.list_fields, **query_kwargs)
+                    has_next_page = len(results) > limit
+                    results = results[:limit]
+                    has_previous_page = after is not None
+            elif limit:
+                results = CrashDump.query(self.env, order=sort_col, desc=not asc, limit=limit, offset=offset,
+                                          fields=self.list_fields, **query_kwargs)
+            CrashDump.prefetch_linked_tickets(self.env, results)
             data['results'] = results
 
-            limit_offset = 0
-            need_paginator = limit > 0 and limit_offset
-            need_reorder = limit_offset is None
-            numrows = len(results)
+            numrows = num_items
 
             paginator = None
-            if need_paginator:
+            if num_items is None:
+                if results and has_next_page:
+                    add_link(req, 'next', report_href(page=None, after=self._list_cursor(results[-1], sort_col)),
+                             _('Next Page'))
+                if results and has_previous_page:
+                    add_link(req, 'prev', report_href(page=None, before=self._list_cursor(results[0], sort_col)),
+                             _('Previous Page'))
+                prevnext_nav(req, _('Previous Page'), _('Next Page'))
+            elif limit > 0:
                 paginator = Paginator(results, page - 1, limit, num_items)
                 data['paginator'] = paginator
                 if paginator.has_next_page:
@@ -460,6 +612,7 @@ class CrashDumpModule(Component):
                                         'title': None}
                 numrows = paginator.num_items
             data['paginator'] = paginator
+            data['numrows'] = numrows
 
             add_script_data(req, {'comments_prefs': self._get_prefs(req)})
             if not crashdump_use_jinja2:
@@ -608,7 +761,7 @@ class CrashDumpModule(Component):
             add_stylesheet(req, 'crashdump/crashdump.css')
 
             data = {'id': crashobj.id, 'uuid': crashobj.uuid }
-            crashobj.delete(self.dumpdata_dir)
+            crashobj.delete(self.dumpdata_dir, CrashDumpRetention(self.env).archive_dir)
             return 'deleted.html', data, metadata
 
         elif action == 'minidump_raw':
@@ -660,11 +813,33 @@ class CrashDumpModule(Component):
     def _send_file(self, req, crashobj, name):
         filename = self._get_dump_filename(crashobj, name)
         item_name = os.path.basename(filename)
+        stored_file, method = find_dump_file(filename)
+        if stored_file is None:
+            raise ResourceNotFound(_("File %(name)s for crash %(uuid)s does not exist.", name=item_name, uuid=str(crashobj.uuid)))
         # Force browser to download files instead of rendering
         # them, since they might contain malicious code enabling
         # XSS attacks
         req.send_header('Content-Disposition', 'attachment; filename=%s' % item_name)
-        req.send_file(filename, mimetype='application/force-download')
+        if method is None:
+            req.send_file(stored_file, mimetype='application/force-download')
+            return
+        # the response of a compressed file depends on the Accept-Encoding
+        req.send_header('Vary', 'Accept-Encoding')
+        if accepts_encoding(req.get_header('Accept-Encoding'), method):
+            # client can handle the compressed data directly
+            req.send_header('Content-Encoding', content_encodings[method])
+            req.send_file(stored_file, mimetype='application/force-download')
+        else:
+            # the recorded size is the size of the uncompressed data
+            size = crashobj.get_files().get(name, {}).get('size')
+            req.send_response(200)
+            req.send_header('Content-Type', 'application/force-download')
+            if size is not None:
+                req.send_header('Content-Length', size)
+            req.end_headers()
+            if req.method != 'HEAD':
+                req.write(iter_dump_file(filename))
+            raise RequestDone
 
     def _query_link(self, req, name, value, text=None):
         """Return a link to /query with the appropriate name and value"""
@@ -707,8 +882,7 @@ class CrashDumpModule(Component):
         item_name = crashobj[name]
         if not item_name:
             return None
-        crash_file = os.path.join(self.env.path, self.dumpdata_dir, item_name)
-        return crash_file
+        return CrashDumpRetention(self.env).dump_file_path(item_name)
 
     def _link_ticket_by_id(self, req, ticketid):
         ret = None
@@ -847,11 +1021,34 @@ class CrashDumpModule(Component):
         if req.perm.has_permission('TRAC_ADMIN'):
             yield ('crashdump', 'Crash dump', 'maintenance', 'Maintenance')
 
+    def _get_admin_jobs(self, req):
+        """Return the recent maintenance jobs prepared for the admin panel."""
+        ret = []
+        for job in CrashDumpJobRunner(self.env).get_jobs():
+            for name in ('created', 'started', 'finished'):
+                job[name] = format_datetime(job[name], tzinfo=req.tz) if job[name] else None
+            job.pop('updated')
+            ret.append(job)
+        return ret
+
     def render_admin_panel(self, req, cat, page, path_info):
         assert req.perm.has_permission('TRAC_ADMIN')
 
+        runner = CrashDumpJobRunner(self.env)
         action = req.args.get('action', 'view')
-        if req.method == 'POST':
+        if action == 'jobs' and req.is_xhr:
+            req.send(json.dumps(self._get_admin_jobs(req)), 'application/json', 200)
+
+        if req.method == 'POST' and 'run_job' in req.args:
+            job_id = runner.submit(req.args.get('job_name'), author=req.authname)
+            add_notice(req, _("Queued maintenance job %(id)i.", id=job_id))
+            req.redirect(req.href.admin(cat, page))
+        elif req.method == 'POST' and 'cancel_job' in req.args:
+            job_id = req.args.getint('cancel_job')
+            if job_id is None or not runner.cancel(job_id):
+                add_warning(req, _("The maintenance job is not queued or running."))
+            req.redirect(req.href.admin(cat, page))
+        elif req.method == 'POST':
             confirm = req.args.get('confirm', 0)
             if 'purge_threshold' in req.args:
                 purge_threshold_str = req.args.get('purge_threshold', '')
@@ -862,12 +1059,21 @@ class CrashDumpModule(Component):
 
             if not confirm:
                 self.log.debug('render_admin_panel purge not yet confirmed')
+                crashes = None
+                num_crashes = 0
                 if purge_threshold is not None:
-                    crashes = CrashDump.query_old_data(self.env, purge_threshold)
+                    # the preview lists the oldest crashes only
+                    threshold = ('crashtime', purge_threshold)
+                    num_crashes = CrashDump.query_count(self.env, threshold=threshold)
+                    crashes = CrashDump.query(self.env, threshold=threshold, order='crashtime',
+                                              limit=self.purge_preview_limit, fields=['uuid', 'crashtime'])
                 data = {
                     'datetime_hint': get_datetime_format_hint(req.lc_time),
                     'purge_threshold': purge_threshold_str,
-                    'purge_crashes': crashes
+                    'purge_crashes': crashes,
+                    'purge_crash_count': num_crashes,
+                    'jobs': self._get_admin_jobs(req),
+                    'job_names': runner.get_job_names(),
                 }
                 return 'crashdump_admin_%s.html' % page, data
             elif confirm == 'no':
@@ -875,6 +1081,12 @@ class CrashDumpModule(Component):
                 req.redirect(req.href.admin(cat, page))
             elif confirm == 'yes':
                 self.log.debug('render_admin_panel purge confirmed')
+                if purge_threshold is not None:
+                    # purging takes long for many crashes, leave it to the
+                    # background job runner
+                    job_id = runner.submit('purge', [str(to_utimestamp(purge_threshold)), 'crashtime'],
+                                           author=req.authname)
+                    add_notice(req, _("Queued maintenance job %(id)i to purge the crashes.", id=job_id))
                 req.redirect(req.href.admin(cat, page))
         else:
             now = datetime.now(req.tz)
@@ -885,6 +1097,8 @@ class CrashDumpModule(Component):
                 'datetime_hint': get_datetime_format_hint(req.lc_time),
                 'purge_threshold': purge_threshold,
                 'purge_crashes': None,
+                'purge_crash_count': 0,
+                'jobs': self._get_admin_jobs(req),
+                'job_names': runner.get_job_names(),
             }
-            print('crashdump_admin_%s.html' % page, data)
             return 'crashdump_admin_%s.html' % page, data
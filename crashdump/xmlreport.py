@@ -11,6 +11,7 @@ from lxml import etree
 
 from exception_info import exception_code_names_per_platform_type, exception_info_per_platform_type
 from utils import format_version_number, format_memory_usagetype
+from storage import open_dump_file
 
 ZERO = timedelta(0)
 
@@ -497,7 +498,12 @@ class XMLReport(object):
 
         if self._filename:
             try:
-                self._xml = etree.parse(self._filename)
+                # the report might be stored compressed
+                fileobj = open_dump_file(self._filename)
+                try:
+                    self._xml = etree.parse(fileobj)
+                finally:
+                    fileobj.close()
             except IOError as e:
                 raise XMLReport.XMLReportIOError(self, str(e))
             except etree.XMLSyntaxError as e:
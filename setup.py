@@ -44,6 +44,10 @@ setup(
             'crashdump.web_ui = crashdump.web_ui',
             'crashdump.submit = crashdump.submit',
             'crashdump.api = crashdump.api',
+            'crashdump.admin = crashdump.admin',
+            'crashdump.retention = crashdump.retention',
+            'crashdump.jobs = crashdump.jobs',
+            'crashdump.scrub = crashdump.scrub',
         ]
     }
 )